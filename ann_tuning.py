@@ -0,0 +1,204 @@
+# ann_tuning.py – pick vector index + search parameters by measured recall
+"""
+`seed_table` used to train the vector index with LanceDB defaults
+whatever the table size, and searches never set `nprobes` or
+`refine_factor`. This tool measures the trade‑off instead:
+
+    1. ground truth: exact top‑k (flat scan, `bypass_vector_index`) for a
+       sample of query vectors – rows of the table plus noise, or the
+       labeled texts of eval_retrieval.py with --queries
+    2. tables up to ANN_FLAT_MAX_ROWS rows: flat search, no sweep (exact
+       and fast enough at that size; --sweep anyway to compare)
+    3. otherwise sweep index types and build parameters (IVF_PQ
+       partitions × sub‑vectors, IVF_HNSW_SQ partitions), and for each
+       built index the search parameters (nprobes × refine factor, ef),
+       measuring recall@k and p50 / p95 latency per setting
+    4. choose the fastest setting (p95) with recall ≥ --target; flat if
+       nothing reaches it or flat is faster
+    5. rebuild the chosen index and write ann_params.json
+       (db_lancedb.ann_params_path()), unless --dry-run
+
+The API applies the "search" section to every vector query
+(retrieval.refresh_ann_params, picked up within
+LOCATION_INDEX_REFRESH_S), and maintenance re‑indexes with the "index"
+section. Re‑run after the table has grown a lot – the partition count
+is tuned to the current size.
+
+The sweep rebuilds the live table's vector index several times; run it
+off‑peak or against a copy (LANCEDB_DIR=...).
+
+Usage:
+    python ann_tuning.py [--k 15] [--sample 200] [--target 0.95]
+                         [--queries data/eval_queries.json] [--sweep] [--dry-run]
+"""
+from __future__ import annotations
+
+import json, math, time
+from pathlib import Path
+
+import numpy as np
+
+import db_lancedb
+import lance_maintenance
+import retrieval
+
+NOISE = 0.05                      # per‑dimension σ added to sampled row vectors
+PQ_SUB_VECTORS = (48, 96)         # 384 / 8 and 384 / 4 dims per code
+NPROBES = (5, 10, 20, 40, 80)
+REFINE = (None, 2, 5, 10)
+HNSW_EF = (20, 40, 80, 160)
+
+
+# ---------- query sample + ground truth ----------
+def sample_queries(tbl, n: int, *, seed: int = 0, texts: list[str] | None = None) -> np.ndarray:
+    """Unit query vectors: embedded `texts`, else `n` noisy copies of random rows."""
+    if texts:
+        vecs = db_lancedb._get_model().encode(texts).astype("float32")
+    else:
+        rows = tbl.count_rows()
+        rng = np.random.default_rng(seed)
+        take = sorted(rng.choice(rows, size=min(n, rows), replace=False).tolist())
+        t = tbl.take_offsets(take).select(["vector"]).to_arrow()
+        base = t["vector"].combine_chunks().flatten().to_numpy().reshape(len(take), -1)
+        vecs = base + rng.normal(0, NOISE, base.shape).astype("float32")
+    return vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+
+
+def _ids(q, k: int) -> list[str]:
+    return q.limit(k).select(["id"]).to_arrow()["id"].to_pylist()
+
+
+def _timed(tbl, vecs: np.ndarray, k: int, configure) -> tuple[list[list[str]], list[float]]:
+    """Top‑k ids and latency (ms) per query, searching like retrieval.search."""
+    found, lat_ms = [], []
+    for v in vecs:
+        t0 = time.perf_counter()
+        found.append(_ids(configure(tbl.search(v).metric("cosine")), k))
+        lat_ms.append((time.perf_counter() - t0) * 1000)
+    return found, lat_ms
+
+
+def _score(found: list[list[str]], truth: list[list[str]], lat_ms: list[float], k: int) -> dict:
+    recall = np.mean([len(set(f) & set(t)) / max(min(len(t), k), 1) for f, t in zip(found, truth)])
+    return {
+        f"recall@{k}": round(float(recall), 4),
+        "p50_ms": round(float(np.percentile(lat_ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(lat_ms, 95)), 2),
+    }
+
+
+# ---------- sweep ----------
+def index_configs(rows: int) -> list[dict]:
+    """create_index kwargs to try, partitions around √rows."""
+    base = max(int(math.sqrt(rows)), 2)
+    parts = sorted({max(2, min(p, rows // 40)) for p in (base // 2, base, base * 2)})
+    out = [{"index_type": "IVF_PQ", "num_partitions": p, "num_sub_vectors": s}
+           for p in parts for s in PQ_SUB_VECTORS]
+    out += [{"index_type": "IVF_HNSW_SQ", "num_partitions": max(1, p // 4)} for p in parts]
+    return out
+
+
+def search_configs(index: dict) -> list[list[dict]]:
+    """
+    Search parameters that mean something for `index`: one group per
+    nprobes, each ordered from cheapest to most thorough.
+    """
+    probes = sorted({min(n, index["num_partitions"]) for n in NPROBES})
+    if index["index_type"].startswith("IVF_HNSW"):
+        return [[{"nprobes": n, "ef": ef} for ef in HNSW_EF] for n in probes]
+    return [[{"nprobes": n, "refine_factor": r} for r in REFINE] for n in probes]
+
+
+def _apply(search: dict):
+    def configure(q):
+        if search.get("flat"):
+            return q.bypass_vector_index()
+        for name in ("nprobes", "refine_factor", "ef"):
+            if search.get(name):
+                q = getattr(q, name)(int(search[name]))
+        return q
+    return configure
+
+
+def tune(tbl, *, k: int = retrieval.SEARCH_LIMIT, sample: int = 200, target: float = 0.95,
+         texts: list[str] | None = None, sweep: bool = False) -> dict:
+    """Measure and choose; returns the report (see `save`)."""
+    rows = tbl.count_rows()
+    vecs = sample_queries(tbl, sample, texts=texts)
+    _timed(tbl, vecs[:10], k, _apply({"flat": True}))                # warm caches
+    truth, lat = _timed(tbl, vecs, k, _apply({"flat": True}))
+    flat = {"index": None, "search": {"flat": True}, **_score(truth, truth, lat, k)}
+    print(f"[INFO] {rows} rows, {len(vecs)} queries – flat p95 {flat['p95_ms']} ms")
+
+    results = [flat]
+    if rows >= lance_maintenance.MIN_INDEX_ROWS and (sweep or rows > retrieval.FLAT_MAX_ROWS):
+        for index in index_configs(rows):
+            t0 = time.perf_counter()
+            try:
+                db_lancedb.build_vector_index(tbl, index)
+            except Exception as e:
+                print(f"[WARN] {index} not built:", e)
+                continue
+            build_s = round(time.perf_counter() - t0, 2)
+            prev: list[float] | None = None
+            for group in search_configs(index):
+                recalls = []
+                for search in group:
+                    found, lat = _timed(tbl, vecs, k, _apply(search))
+                    res = {"index": index, "search": search, "build_s": build_s,
+                           **_score(found, truth, lat, k)}
+                    print(f"[INFO] {index} {search}: recall {res[f'recall@{k}']}, p95 {res['p95_ms']} ms")
+                    results.append(res)
+                    recalls.append(res[f"recall@{k}"])
+                    if recalls[-1] >= target:
+                        break             # more refine / ef only costs latency
+                # more partitions probed stop paying once recall no longer moves
+                if recalls[0] >= target or recalls == prev:
+                    break
+                prev = recalls
+
+    ok = [r for r in results if r[f"recall@{k}"] >= target]
+    best = min(ok, key=lambda r: (r["p95_ms"], -r[f"recall@{k}"])) if ok else flat
+    if rows <= retrieval.FLAT_MAX_ROWS:
+        best = flat                   # below the threshold exact search is the rule
+    return {"rows": rows, "k": k, "target": target, "queries": len(vecs),
+            "chosen": best, "results": results}
+
+
+def save(tbl, report: dict) -> Path:
+    """Rebuild the chosen index (the sweep left the last one) and persist the parameters."""
+    chosen = report["chosen"]
+    index = chosen["index"] or {}
+    if report["results"][1:] or index:     # index was swept or needs the tuned build
+        db_lancedb.build_vector_index(tbl, index)
+    return db_lancedb.save_ann_params({
+        "index": chosen["index"],
+        "search": chosen["search"],
+        "rows": report["rows"],
+        f"recall@{report['k']}": chosen[f"recall@{report['k']}"],
+        "p95_ms": chosen["p95_ms"],
+        "table_version": tbl.version,
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    })
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--k", type=int, default=retrieval.SEARCH_LIMIT)
+    ap.add_argument("--sample", type=int, default=200, help="query vectors sampled from the table")
+    ap.add_argument("--target", type=float, default=0.95, help="minimum recall@k")
+    ap.add_argument("--queries", type=Path, help="eval_retrieval.py query set, embedded instead of sampling")
+    ap.add_argument("--sweep", action="store_true", help="sweep even below ANN_FLAT_MAX_ROWS")
+    ap.add_argument("--dry-run", action="store_true", help="report only; the sweep still rebuilds the index")
+    args = ap.parse_args()
+
+    table = db_lancedb.get_table()
+    texts = [q["query"] for q in json.loads(args.queries.read_text())] if args.queries else None
+    report = tune(table, k=args.k, sample=args.sample, target=args.target, texts=texts, sweep=args.sweep)
+    print(json.dumps(report["chosen"], indent=2))
+    if args.dry_run:
+        if report["results"][1:]:
+            db_lancedb.build_vector_index(table)      # back to the persisted / default index
+    else:
+        print("[INFO] written", save(table, report))
@@ -0,0 +1,60 @@
+# async_exec.py – bounded thread pools for the blocking /query stages
+"""
+The `/query` route is async, but a few of its stages only have blocking
+clients (LanceDB search, the embedding call). Running them straight on the
+event loop stalls every other request in the uvicorn worker, so they are
+pushed onto small per‑stage thread pools instead.
+
+Each stage gets its own pool so a burst of slow searches cannot starve the
+embedding stage (and vice versa). Sizes are read from the environment:
+
+    EMBED_WORKERS    – threads for embed_modal.embed         (default 32)
+    SEARCH_WORKERS   – threads for LanceDB searches          (default 16)
+    (maintenance)    – one thread for lance_maintenance passes
+
+Stages that have a native async client (Modal `.remote.aio`, Gemini
+`generate_content_async`, motor) do not need a pool and are awaited directly.
+
+Usage:
+    vec = await async_exec.run("embed", embed_modal.embed, text)
+"""
+from __future__ import annotations
+
+import asyncio, contextvars, functools, os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+POOL_SIZES = {
+    "embed":  int(os.getenv("EMBED_WORKERS", "32")),
+    "search": int(os.getenv("SEARCH_WORKERS", "16")),
+    "maintenance": 1,
+}
+_POOLS: dict[str, ThreadPoolExecutor] = {}
+
+
+def pool(stage: str) -> ThreadPoolExecutor:
+    """Return (lazily creating) the executor for `stage`."""
+    ex = _POOLS.get(stage)
+    if ex is None:
+        ex = _POOLS[stage] = ThreadPoolExecutor(
+            max_workers=POOL_SIZES.get(stage, 8),
+            thread_name_prefix=f"{stage}-worker",
+        )
+    return ex
+
+
+async def run(stage: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run blocking `fn(*args, **kwargs)` on the `stage` pool and await it,
+    in a copy of the caller's context (trace id, see metrics.py).
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(pool(stage), functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+def shutdown() -> None:
+    """Stop all pools; called from the FastAPI shutdown hook."""
+    for ex in _POOLS.values():
+        ex.shutdown(wait=False, cancel_futures=True)
+    _POOLS.clear()
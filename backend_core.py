@@ -1,11 +1,15 @@
 # backend_core.py
 from dotenv import load_dotenv
-from typing import Annotated, List
+from typing import Annotated, List, Literal
 from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import numpy as np
 import numbers
+import asyncio
+import time
+import orjson
 
 load_dotenv()
 import user_repo
@@ -14,13 +18,25 @@ import db_lancedb
 import location_modal
 import geo_utils
 import postprocess_modal
+import async_exec
+import lance_maintenance
+import location_index
+import retrieval
+import result_cache
+import local_ranker
+import personalize
+import metrics
 import modal
 import os
+from cache_utils import SingleFlight
 
 
 EMBED_DIM = 384
 restaurants_tbl = db_lancedb.get_table()
 DEV_MODE = os.getenv("DEV_MODE")
+BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", "1000"))                   # queries per /query/batch
+BATCH_LLM_CONCURRENCY = int(os.getenv("QUERY_BATCH_LLM_CONCURRENCY", "4"))
+BATCH_LOCATE_CONCURRENCY = int(os.getenv("QUERY_BATCH_LOCATE_CONCURRENCY", "16"))   # NER + geocode calls
 
 # -------------- Pydantic models --------------
 from pydantic import BaseModel
@@ -28,6 +44,12 @@ from pydantic import BaseModel
 class QueryRequest(BaseModel):
     text: str
     location: dict[str, float] | None = None
+    mode: Literal["vector", "keyword", "hybrid"] | None = None   # default: SEARCH_MODE
+    # structured prefilters (scalar‑indexed columns)
+    min_rating: float | None = None
+    min_reviews: int | None = None            # review_amount
+    areas: list[str] | None = None            # exact `area` values
+    deadline_s: float | None = None           # LLM budget, default LLM_DEADLINE_S
 
 class RestaurantOut(BaseModel):
     name:str; photo_url:list|None=None; rating:float|None=None; total_reviews:int|None=None; price:str|None=None; opening_hours:list|None=None
@@ -36,6 +58,13 @@ class RestaurantOut(BaseModel):
 class QueryResponse(BaseModel):
     results: List[RestaurantOut]
 
+class BatchRequest(BaseModel):
+    queries: List[QueryRequest]
+    rank: Literal["local", "llm"] = "local"   # local = NumPy ranker only, no Gemini calls
+
+class BatchResponse(BaseModel):
+    results: List[List[RestaurantOut]]        # one list per query, same order
+
 class UserDoc(BaseModel):
     uid: str
     email: str | None = None
@@ -44,7 +73,27 @@ class UserDoc(BaseModel):
 
 # -------------- FastAPI setup --------------
 app = FastAPI(debug=DEV_MODE)
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
+                   expose_headers=["traceparent"])
+
+
+@app.middleware("http")
+async def _observe(request: Request, call_next):
+    """Request latency by route + W3C trace context (see metrics.py)."""
+    trace = metrics.start_trace(request.headers.get("traceparent"))
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["traceparent"] = trace.traceparent()
+        return response
+    finally:
+        dt = time.perf_counter() - t0
+        route = getattr(request.scope.get("route"), "path", "unmatched")   # bounded label set
+        metrics.observe("request_seconds", dt, buckets=metrics.LATENCY_BUCKETS,
+                        route=route, status=str(status))
+        metrics.log_trace(trace, route, status, dt)
 
 
 # -------------- Helper: prefs → text --------------
@@ -64,7 +113,9 @@ async def save_prefs(prefs: dict, request: Request):
     uid = request.headers.get("uid")
     if not uid:
         raise HTTPException(400, "uid header missing")
-    await user_repo.upsert_prefs(uid, prefs)
+    # embed once here so /query pays nothing for personalization
+    derived = await async_exec.run("embed", personalize.profile, prefs, embed_modal.embed_strict)
+    await user_repo.upsert_prefs(uid, prefs, derived)
     return Response(status_code=204)
 
 # ---------- Endpoint ----------
@@ -74,9 +125,7 @@ async def get_user(request: Request):
     if not uid:
         raise HTTPException(400, "uid header missing")
 
-    doc = await user_repo.get_user(uid)
-    if not doc:
-        doc = await user_repo.create_user(uid=uid, email="", photo_url="", prefs={})
+    doc = await user_repo.get_or_create_user(uid, email="", photo_url="", prefs={})
 
     return UserDoc(
         uid=doc.get("_id"),
@@ -85,86 +134,455 @@ async def get_user(request: Request):
         preferences=doc.get("preferences", {}),
     )
 
-def _sanitize(x):
-    """Recursively turn NumPy containers into vanilla Python types."""
-    if isinstance(x, dict):
-        return {k: _sanitize(v) for k, v in x.items()}
-    if isinstance(x, list):
-        return [_sanitize(v) for v in x]
-    if isinstance(x, np.ndarray):
-        return [_sanitize(v) for v in x.tolist()]
-    if isinstance(x, np.generic):
-        return x.item()
-    return x
+_STATS = {
+    "embed": embed_modal.stats,
+    "geocode": geo_utils.stats,
+    "location_index": location_index.stats,
+    "result_cache": result_cache.stats,
+    "ranking": postprocess_modal.stats,
+    "user_prefs": user_repo.stats,
+}
+for _name, _fn in _STATS.items():
+    metrics.register(_name, _fn)
+
+
+@app.get("/stats")
+async def stats():
+    """Cache counters, for sizing caches in production."""
+    return {name: fn() for name, fn in _STATS.items()}
 
-# -------------- Query route --------------
-@app.post("/query", response_model=QueryResponse)
-async def query(q: QueryRequest, request: Request):
-    uid = request.headers.get("uid")
-    if not uid:
-        raise HTTPException(400, "uid header missing")
 
-    
-    user_doc = await user_repo.get_user(uid) or {}
-    prefs_txt = _prefs_to_text(user_doc.get("preferences", {}))
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Stage latencies, fallbacks, tokens and the /stats counters for Prometheus."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
 
+# -------------- Query stages --------------
+async def _locate_and_embed(q: QueryRequest) -> np.ndarray | None:
+    """NER → geocode → embed. Runs concurrently with the user lookup."""
+    place = await _locate(q)
+    if _mode(q) == "keyword":     # nothing to embed
+        return None
+    embed_text = _embed_text(q, place)
+    metrics.annotate(place=place)
+    with metrics.span("embed"):
+        return await async_exec.run("embed", embed_modal.embed, embed_text)
+
+
+async def _locate(q: QueryRequest) -> str:
+    """Sets `q.location` from a place named in the text; returns the place."""
     # --- 2) try to pull explicit place from query -------------------------
-    lat_lng_txt = ""              # will hold "37.42 -122.08" etc.
     place = ""
     if not q.location:
-        place = location_modal.get_location(q.text)
+        # local dictionary first; only unknown places pay for the NER call
+        place = location_index.match(q.text)
+        if not place:
+            with metrics.span("ner"):
+                place = await location_modal.get_location_async(q.text)
         if place:
-            coords = await geo_utils.geocode(place)      # (lat, lng) | None
+            with metrics.span("geocode"):
+                coords = await geo_utils.geocode(place)      # (lat, lng) | None
             if coords:
                 q.location = {"lat": coords[0], "lng": coords[1]}
+    return place
 
-    if q.location:                # build the numeric string for embedding
-        lat_lng_txt = f"{q.location['lat']:.4f} {q.location['lng']:.4f}"
-            
 
-    # --- 3) build embedding input exactly like make_embedding -------------
+def _embed_text(q: QueryRequest, place: str) -> str:
+    # --- 3) build embedding input like make_embedding (area + text) -------
+    # coordinates are not embedded; retrieval filters on them instead
     embed_parts = [
         place,                        # area unknown at query time
         q.text,                    # treat query text as description proxy
-        lat_lng_txt,
     ]
-    embed_text = " ".join(p for p in embed_parts if p)
-    print("text is: ", embed_text)
-    vec = embed_modal.embed(embed_text)
-
-
-    # --- 4) vector search --------------------------------------------------
-    raw: list[dict] = (
-        restaurants_tbl.search(vec)
-        .metric("cosine")
-        .limit(15)
-        .select([
-            "area","name","address","location",
-            "rating","review_amount",
-            "description",
-            "photos",
-            #"reviews"
-        ])
-        .to_pandas()
-        .to_dict("records")
+    return " ".join(p for p in embed_parts if p)
+
+
+def _mode(q: QueryRequest) -> str:
+    return q.mode or retrieval.SEARCH_MODE
+
+
+def _where(q: QueryRequest, avoid_tags: list[str] | None) -> str | None:
+    return retrieval.filter_where(q.min_rating, q.min_reviews, q.areas, exclude_tags=avoid_tags)
+
+
+def _depth(q: QueryRequest) -> int:
+    # hybrid fuses from deeper lists than we return
+    return retrieval.SEARCH_LIMIT if _mode(q) == "vector" else 2 * retrieval.SEARCH_LIMIT
+
+
+async def _retrieve(q: QueryRequest, vec: np.ndarray | None,
+                    avoid_tags: list[str] | None = None,
+                    dense: list[dict] | None = None) -> list[dict]:
+    """
+    Vector, keyword or both in parallel + reciprocal‑rank fusion. Rows
+    carry ids and scores only (phase one, see `_hydrate`).
+    `dense` – vector results already fetched by /query/batch.
+    """
+    mode = _mode(q)
+    where = _where(q, avoid_tags)
+
+    async def vector():
+        if dense is not None:
+            return dense
+        return await async_exec.run("search", retrieval.search, restaurants_tbl, vec,
+                                    location=q.location, where=where, limit=_depth(q),
+                                    columns=retrieval.ID_COLUMNS)
+
+    if mode == "vector":
+        return await vector()
+    if mode == "keyword":
+        return await async_exec.run("search", retrieval.keyword_search, restaurants_tbl, q.text,
+                                    location=q.location, where=where, columns=retrieval.ID_COLUMNS)
+
+    dense, sparse = await asyncio.gather(
+        vector(),
+        async_exec.run("search", retrieval.keyword_search, restaurants_tbl, q.text,
+                       location=q.location, where=where, limit=_depth(q),
+                       columns=retrieval.ID_COLUMNS),
+        return_exceptions=True,
     )
+    if isinstance(dense, BaseException):
+        raise dense
+    if isinstance(sparse, BaseException):     # e.g. table without the FTS index yet
+        print("[WARN] keyword search failed, using vector results only:", sparse)
+        return dense[:retrieval.SEARCH_LIMIT]
+    return retrieval.rrf([dense, sparse])
 
-    photo_map = { r["name"]: r.get("photos", []) for r in raw }
-    light_raw = [
-        {k: v for k, v in r.items() if k != "photos"}   # drop photos from payload
-        for r in raw
-    ]
+
+# -------------- Query route --------------
+async def _prepare(q: QueryRequest, request: Request) -> tuple[np.ndarray | None, str, str, dict]:
+    """
+    Steps 1–3 shared by /query and /query/stream
+    → (blended vec, prefs_txt, cache key, {"prefs_vec", "avoid_tags"}).
+    """
+    uid = request.headers.get("uid")
+    if not uid:
+        raise HTTPException(400, "uid header missing")
+
+    # --- 1) user prefs and location/embedding are independent -------------
+    profile, vec = await asyncio.gather(
+        _profile(uid),                   # cached; Mongo only on a miss
+        _locate_and_embed(q),
+    )
+    prefs_txt, personal = _personalize(profile)
+    vec = personalize.blend(vec, personal["prefs_vec"])
+    return vec, prefs_txt, _query_key(q, vec, prefs_txt), personal
+
+
+_backfills = SingleFlight()
+
+
+async def _profile(uid: str) -> dict:
+    with metrics.span("profile"):
+        profile = await user_repo.get_profile(uid)
+        if profile["backfill"]:      # saved before vectors were stored
+            profile = await _backfills.do(uid, lambda: _backfill_profile(uid, profile["preferences"]))
+        return profile
+
+
+async def _backfill_profile(uid: str, prefs: dict) -> dict:
+    """Derived fields for a legacy doc, computed and stored once like POST /user/prefs."""
+    derived = await async_exec.run("embed", personalize.profile, prefs, embed_modal.embed_strict)
+    try:
+        return await user_repo.backfill_prefs(uid, prefs, derived)
+    except Exception as e:
+        print("[WARN] storing backfilled preference vectors failed:", e)
+        return {"preferences": prefs, **derived}
+
+
+def _personalize(profile: dict) -> tuple[str, dict]:
+    """prefs_txt for the prompt + {"prefs_vec", "avoid_tags"} for retrieval."""
+    # --- 3a) personalization: precomputed on POST /user/prefs -------------
+    # no stored vector (restrictions only, failed embed) = no blending
+    prefs = profile["preferences"]
+    prefs_txt = _prefs_to_text(prefs)
+    prefs_vec = profile["prefs_vec"]
+    return prefs_txt, {
+        "prefs_vec": None if prefs_vec is None else np.asarray(prefs_vec, dtype="float32"),
+        "avoid_tags": profile["avoid_tags"] or personalize.avoid_tags(prefs),
+    }
+
+
+def _query_key(q: QueryRequest, vec: np.ndarray | None, prefs_txt: str) -> str:
+    options = q.model_dump(include={"mode", "min_rating", "min_reviews", "areas"})
+    options["mode"] = _mode(q)
+    return result_cache.query_key(vec, q.text, q.location, options, prefs_txt)
+
+
+@app.post("/query", response_model=QueryResponse)
+async def query(q: QueryRequest, request: Request):
+    vec, prefs_txt, key, personal = await _prepare(q, request)
+
+    # --- 3b) result cache pre‑check; identical requests share one run -----
+    results = result_cache.get_query(key)
+    if results is None:
+        results = await result_cache.coalesce(key, lambda: _search_and_rank(q, vec, prefs_txt, key, personal))
+    # result dicts are already RestaurantOut‑shaped; skip per‑field model building
+    return _json({"results": [_out(r) for r in results]})
+
+
+async def _search_and_rank(q: QueryRequest, vec: np.ndarray | None, prefs_txt: str,
+                           query_key: str, personal: dict) -> list[dict]:
+    # --- 4) retrieval (vector / keyword / hybrid) -------------------------
+    raw, order = await _retrieve_and_order(q, vec, personal)
+    return await _rank(q, raw, order, prefs_txt, query_key)
+
+
+async def _rank(q: QueryRequest, raw: list[dict], order: list[int], prefs_txt: str,
+                query_key: str) -> list[dict]:
+    ranked_key = result_cache.candidates_key([r["id"] for r in raw], prefs_txt)
+    results = result_cache.get_ranked(ranked_key)
+    if results is not None:
+        result_cache.put(query_key, None, results)
+        return results
+
+    # --- 5) LLM ranking (ids + generated fields, rebuilt from `raw`) -----
+    # unenriched rows are described to the model by description + review snippets
+    await _hydrate([r for r in raw if not r.get("summary")], retrieval.PROMPT_COLUMNS)
+    with metrics.span("llm"):
+        results = await postprocess_modal.rank_and_format_async(
+            prefs_txt, raw, order=order, deadline_s=_deadline(q))
+    await _display(results, raw)
+
+    if not isinstance(results, postprocess_modal.Fallback):
+        result_cache.put(query_key, ranked_key, results)
+    return results
+
+def _deadline(q: QueryRequest) -> float:
+    return q.deadline_s if q.deadline_s is not None else postprocess_modal.LLM_DEADLINE_S
+
+
+async def _retrieve_and_order(q: QueryRequest, vec: np.ndarray | None, personal: dict,
+                              dense: list[dict] | None = None) -> tuple[list[dict], list[int]]:
+    """Candidates plus their local ranking (fallback / fill order for the LLM)."""
+    with metrics.span("search"):
+        raw = await _retrieve(q, vec, personal["avoid_tags"], dense)
+    metrics.observe("candidates", len(raw))
+    columns = retrieval.RANK_COLUMNS
+    if personal["prefs_vec"] is not None:      # only the prefs feature reads vectors
+        columns = columns + ["vector"]
+    await _hydrate(raw, columns)
+    with metrics.span("local_rank"):
+        order = local_ranker.rank(raw, location=q.location, prefs_vec=personal["prefs_vec"])
+    return raw, order
+
+
+async def _hydrate(rows: list[dict], columns: list[str]) -> None:
+    """Phase two: load `columns` for exactly these rows (no‑op if present)."""
+    if rows:
+        with metrics.span("hydrate"):
+            await async_exec.run("search", retrieval.hydrate, restaurants_tbl, rows, columns)
+
+
+async def _display(results: list[dict], raw: list[dict]) -> list[dict]:
+    """Photos and long text for the rows that made the final list."""
+    by_id = {r["id"]: r for r in raw}
+    await _hydrate([by_id[r["id"]] for r in results if r.get("id") in by_id],
+                   retrieval.DISPLAY_COLUMNS)
+    return postprocess_modal.add_display(results, by_id)
+
+
+def _json(content: dict) -> Response:
+    """orjson body; `response_model` stays on the route for the OpenAPI schema."""
+    return Response(orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY),
+                    media_type="application/json")
+
+
+def _ndjson(event: dict) -> bytes:
+    return orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+
+
+_OUT_FIELDS = tuple(RestaurantOut.model_fields)
+
+
+def _out(r: dict) -> dict:
+    """Public RestaurantOut fields of an internal result dict."""
+    return {k: r.get(k) for k in _OUT_FIELDS}
+
+
+@app.post("/query/stream")
+async def query_stream(q: QueryRequest, request: Request):
+    """
+    Same pipeline as /query, as NDJSON events:
+        {"type": "candidates", "results": [...]}   local top 10, right after retrieval
+        {"type": "result", "rank": i, "result": {...}}   one per ranked item,
+                                                         as Gemini writes it
+        {"type": "done", "cached": bool}
+    """
+    vec, prefs_txt, key, personal = await _prepare(q, request)
+
+    async def events():
+        cached = result_cache.get_query(key)
+        if cached is not None:
+            for i, r in enumerate(cached):
+                yield _ndjson({"type": "result", "rank": i, "result": _out(r)})
+            yield _ndjson({"type": "done", "cached": True})
+            return
+
+        raw, order = await _retrieve_and_order(q, vec, personal)
+        top = [raw[i] for i in order[:postprocess_modal.TOP_N]]
+        await _hydrate(top, retrieval.DISPLAY_COLUMNS)
+        yield _ndjson({"type": "candidates",
+                       "results": [_out(postprocess_modal.result_from_row(r)) for r in top]})
+
+        await _hydrate([r for r in raw if not r.get("summary")], retrieval.PROMPT_COLUMNS)
+        results, generated = [], True
+        with metrics.span("llm"):     # whole stream, client writes included
+            async for r, from_model in postprocess_modal.rank_and_format_stream(
+                    prefs_txt, raw, order=order, deadline_s=_deadline(q)):
+                await _display([r], raw)      # no‑op unless outside the local top 10
+                generated &= from_model
+                yield _ndjson({"type": "result", "rank": len(results), "result": _out(r)})
+                results.append(r)
+        if generated and results:
+            ranked_key = result_cache.candidates_key([r["id"] for r in raw], prefs_txt)
+            result_cache.put(key, ranked_key, results)
+        yield _ndjson({"type": "done", "cached": False})
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+# -------------- Batch queries --------------
+_NO_PROFILE = {"preferences": {}, "prefs_vec": None, "avoid_tags": []}
+
+
+@app.post("/query/batch", response_model=BatchResponse)
+async def query_batch(b: BatchRequest, request: Request):
+    """
+    Many queries in one call (partner integrations, cache warming). The
+    `uid` header is optional; without it the queries are not personalized.
+    """
+    if len(b.queries) > BATCH_MAX:
+        raise HTTPException(413, f"at most {BATCH_MAX} queries per batch")
+    results = await run_batch(b.queries, uid=request.headers.get("uid"), rank=b.rank)
+    return _json({"results": [[_out(r) for r in rs] for rs in results]})
+
+
+async def run_batch(queries: list[QueryRequest], *, uid: str | None = None,
+                    rank: str = "local") -> list[list[dict]]:
+    """
+    Python entry point behind /query/batch. Same stages as /query, batched:
+    one profile lookup, one `embed_many` call for every text, one
+    multi‑vector ANN pass per distinct filter for queries without a
+    location (the rest fan out on the search pool), then the local ranker
+    or at most BATCH_LLM_CONCURRENCY Gemini calls at a time. At most
+    BATCH_LOCATE_CONCURRENCY place lookups run at once; a query whose
+    lookup fails is searched without a place.
+    """
+    locating = asyncio.Semaphore(BATCH_LOCATE_CONCURRENCY)
+
+    async def locate(q: QueryRequest) -> str:
+        async with locating:
+            try:
+                return await _locate(q)
+            except Exception as e:
+                print(f"[WARN] locating {q.text!r} failed – searching without a place:", e)
+                metrics.inc("fallbacks_total", stage="locate")
+                return ""
+
+    profile = await _profile(uid) if uid else _NO_PROFILE
+    prefs_txt, personal = _personalize(profile)
+    places = await asyncio.gather(*(locate(q) for q in queries))
+
+    vecs: list[np.ndarray | None] = [None] * len(queries)
+    need = [i for i, q in enumerate(queries) if _mode(q) != "keyword"]
+    if need:
+        texts = [_embed_text(queries[i], places[i]) for i in need]
+        with metrics.span("embed"):
+            embedded = await async_exec.run("embed", embed_modal.embed_many, texts)
+        for i, v in zip(need, embedded):
+            vecs[i] = personalize.blend(v, personal["prefs_vec"])
+
+    keys = [_query_key(q, v, prefs_txt) for q, v in zip(queries, vecs)]
+    results: list[list[dict] | None] = [result_cache.get_query(k) for k in keys]
+    todo = [i for i, r in enumerate(results) if r is None]
+
+    # vector side for every query without a location, grouped by filter
+    groups: dict[tuple, list[int]] = {}
+    for i in todo:
+        q = queries[i]
+        if vecs[i] is not None and not q.location:
+            groups.setdefault((_where(q, personal["avoid_tags"]), _depth(q)), []).append(i)
+    dense: dict[int, list[dict]] = {}
+    with metrics.span("search_many"):
+        found = await asyncio.gather(*(
+            async_exec.run("search", retrieval.search_many, restaurants_tbl, [vecs[i] for i in idx],
+                           where=where, limit=depth, columns=retrieval.ID_COLUMNS)
+            for (where, depth), idx in groups.items()))
+    for idx, rows in zip(groups.values(), found):
+        dense.update(zip(idx, rows))
+
+    llm = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+    async def finish(i: int) -> list[dict]:
+        q = queries[i]
+        raw, order = await _retrieve_and_order(q, vecs[i], personal, dense.get(i))
+        if rank == "local":
+            return await _display(postprocess_modal.rank_local(raw, order), raw)
+        async with llm:
+            return await result_cache.coalesce(keys[i], lambda: _rank(q, raw, order, prefs_txt, keys[i]))
+
+    for i, r in zip(todo, await asyncio.gather(*(finish(i) for i in todo))):
+        results[i] = r
+    return results
+
+
+def query_many(queries: list[str | dict], *, uid: str | None = None,
+               rank: str = "local") -> list[list[dict]]:
+    """Blocking `run_batch` for scripts: plain texts or QueryRequest dicts."""
+    qs = [QueryRequest(text=x) if isinstance(x, str) else QueryRequest(**x) for x in queries]
+
+    async def main():
+        await geo_utils.startup()
+        try:
+            return await run_batch(qs, uid=uid, rank=rank)
+        finally:
+            await geo_utils.shutdown()
+
+    return asyncio.run(main())
+
+# -------------- Startup: shared clients + background maintenance --------------
+_bg_tasks: list[asyncio.Task] = []
+
+def _build_place_indices() -> None:
+    n = location_index.build(restaurants_tbl)
+    if geo_utils.USE_GAZETTEER:
+        geo_utils.build_gazetteer(restaurants_tbl)
+    print(f"[INFO] place indices rebuilt: {n} names")
 
 
-    # --- 5) LLM post‑processing (Gemini or Modal) -------------------------
-    results = postprocess_modal.rank_and_format(prefs_txt, light_raw)
+async def _place_index_loop():
+    """
+    Rebuild the place matcher + gazetteer whenever the table version moves;
+    pick up re‑tuned ANN search parameters.
+    """
+    version = None
+    while True:
+        try:
+            retrieval.refresh_ann_params(restaurants_tbl)     # ann_tuning.py may have written new ones
+            if restaurants_tbl.version != version:
+                if version is not None:
+                    result_cache.clear()      # cached rankings show stale rows
+                version = restaurants_tbl.version
+                await async_exec.run("search", _build_place_indices)
+        except Exception as e:
+            print("[WARN] place index rebuild failed:", e)
+        await asyncio.sleep(location_index.REFRESH_S)
 
-    for item in results:
-        item["photo_url"] = photo_map.get(item["name"], [])[:4]   # keep ≤4 URLs
 
-    return QueryResponse(results=results)
+@app.on_event("startup")
+async def _startup():
+    await geo_utils.startup()
+    _bg_tasks.append(asyncio.create_task(_place_index_loop()))
+    if lance_maintenance.MAINT_INTERVAL_S > 0:
+        _bg_tasks.append(asyncio.create_task(lance_maintenance.maintenance_loop(restaurants_tbl)))
+    if user_repo.PREFS_WATCH:
+        _bg_tasks.append(asyncio.create_task(user_repo.watch_prefs()))
 
 # -------------- Graceful shutdown --------------
 @app.on_event("shutdown")
 async def _shutdown():
-    if _mongo: _mongo.close()
+    for t in _bg_tasks:
+        t.cancel()
+    await geo_utils.shutdown()
+    async_exec.shutdown()
+    user_repo.close()
@@ -0,0 +1,98 @@
+# batching.py – micro‑batching dispatcher for blocking batch functions
+"""
+Callers `submit()` single items from any thread and get a `Future` back.
+A collector thread groups items that arrive within `max_wait` seconds (or
+until `max_batch` items are queued), hands the batch to `batch_fn` on a
+small dispatch pool, and fans the results back out to the waiting callers.
+
+Identical items inside one batch are sent once. If `batch_fn` raises, every
+caller in that batch receives the exception. With `with_tags=True` callers
+may submit a tag alongside the item, and `batch_fn(items, tags)` also gets
+the batch's distinct tags (embed_modal passes trace ids this way).
+"""
+from __future__ import annotations
+
+import queue, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Sequence
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        batch_fn: Callable[[list], Sequence[Any]],
+        *,
+        max_batch: int = 32,
+        max_wait: float = 0.005,
+        max_inflight: int = 8,
+        name: str = "batcher",
+        with_tags: bool = False,
+    ):
+        self.batch_fn = batch_fn
+        self.with_tags = with_tags
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self._q: queue.Queue[tuple[Hashable, Future, Any]] = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix=f"{name}-dispatch")
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self.batches = self.items = 0
+
+    def submit(self, item: Hashable, tag: Any = None) -> Future:
+        self._ensure_started()
+        fut: Future = Future()
+        self._q.put((item, fut, tag))
+        return fut
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._collect, name=f"{self.name}-collector", daemon=True)
+                    self._thread.start()
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list[tuple[Hashable, Future, Any]]) -> None:
+        waiters: dict[Hashable, list[Future]] = {}
+        for item, fut, _tag in batch:
+            waiters.setdefault(item, []).append(fut)
+        items = list(waiters)
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            if self.with_tags:
+                tags = list(dict.fromkeys(tag for _, _, tag in batch if tag is not None))
+                results = self.batch_fn(items, tags)
+            else:
+                results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name}: got {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for futs in waiters.values():
+                for fut in futs:
+                    fut.set_exception(e)
+            return
+        for item, res in zip(items, results):
+            for fut in waiters[item]:
+                fut.set_result(res)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+        }
@@ -0,0 +1,548 @@
+# bench.py – offline end‑to‑end /query benchmark
+"""
+Drives the FastAPI app in‑process (httpx ASGI transport, no sockets) with
+a concurrent load generator. Every external service is replaced by a
+local stand‑in with a configurable latency distribution and error rate,
+so runs are repeatable on a laptop or in CI:
+
+    embed     Modal embedding     → token‑hashing embedder (or a local
+                                    EMBED_BACKEND model with --embed)
+    ner       Modal location NER  → "in / near <place>" pattern
+    geocode   Mapbox              → area centroids of the dataset
+    llm       Gemini              → ranks candidates by rating, streams
+                                    when asked
+    mongo     user documents      → in‑memory collection
+
+Latency per call is log‑normal from p50 / p95 (`DEFAULT_PROFILE`,
+overridden per stage with --profile JSON). An error raises inside the
+stand‑in, so the app's own fallbacks (or 500s) are what gets measured.
+
+Datasets of each --sizes are synthesized from the rows of the source
+table (repeated with jittered location and rating) and seeded, indexed
+and stub‑enriched with the normal ingestion code under --workdir. They
+are reused on later runs.
+
+Reported per size: end‑to‑end and per‑stage p50 / p95 / p99, throughput,
+HTTP errors and the LLM fallback rate. The report is saved as JSON with
+the git commit, so runs can be diffed:
+
+    python bench.py run [--sizes 1000 10000] [--requests 500] [--concurrency 16]
+    python bench.py compare data/bench/OLD.json data/bench/NEW.json
+
+Result and embedding caches are disabled unless --cache is given, so
+repeated query texts measure the full pipeline.
+"""
+from __future__ import annotations
+
+import asyncio, hashlib, json, os, random, re, subprocess, sys, time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+EMBED_DIM = 384
+OUT_DIR = Path("./data/bench")
+DEFAULT_QUERIES = Path(__file__).parent / "data" / "eval_queries.json"
+DEFAULT_PROFILE = {
+    "embed":   {"p50_ms": 25,   "p95_ms": 60,   "error_rate": 0.0},
+    "ner":     {"p50_ms": 60,   "p95_ms": 150,  "error_rate": 0.0},
+    "geocode": {"p50_ms": 80,   "p95_ms": 200,  "error_rate": 0.0},
+    "llm":     {"p50_ms": 1800, "p95_ms": 3500, "error_rate": 0.02},
+    "mongo":   {"p50_ms": 2,    "p95_ms": 6,    "error_rate": 0.0},
+}
+LANDMARKS = ["union square", "the ferry building", "stanford campus", "the ballpark"]
+CUISINES = ["thai", "ramen", "sushi", "tacos", "pizza", "italian", "indian", "korean", "french"]
+RESTRICTIONS = ["vegetarian", "vegan", "no alcohol", "no seafood"]
+
+# stage → durations (ms); appended from the event loop and from pool threads
+timings: dict[str, list[float]] = defaultdict(list)
+
+
+class StandInError(RuntimeError):
+    pass
+
+
+# ---------- latency ----------
+class Latency:
+    """Log‑normal latency with the given p50 / p95, plus an error rate."""
+
+    def __init__(self, p50_ms: float = 0, p95_ms: float = 0, error_rate: float = 0.0,
+                 rng: random.Random | None = None):
+        self.mu = np.log(max(p50_ms, 1e-6) / 1000)
+        self.sigma = max(np.log(max(p95_ms, p50_ms, 1e-6) / max(p50_ms, 1e-6)) / 1.645, 0.0)
+        self.zero = p50_ms <= 0
+        self.error_rate = error_rate
+        self.rng = rng or random.Random()
+
+    def sample(self) -> float:
+        return 0.0 if self.zero else float(np.exp(self.rng.gauss(self.mu, self.sigma)))
+
+    def fail(self) -> bool:
+        return self.rng.random() < self.error_rate
+
+    async def wait(self, stage: str) -> None:
+        t0 = time.perf_counter()
+        await asyncio.sleep(self.sample())
+        timings[stage].append((time.perf_counter() - t0) * 1000)
+        if self.fail():
+            raise StandInError(f"{stage} stand‑in error")
+
+    def block(self, stage: str) -> None:
+        t0 = time.perf_counter()
+        time.sleep(self.sample())
+        timings[stage].append((time.perf_counter() - t0) * 1000)
+        if self.fail():
+            raise StandInError(f"{stage} stand‑in error")
+
+
+# ---------- stand‑ins ----------
+class HashEmbedder:
+    """Signed token hashing into EMBED_DIM, L2‑normalized; deterministic, no model files."""
+
+    def encode(self, texts, batch_size: int | None = None, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        out = np.zeros((1 if single else len(texts), EMBED_DIM), dtype="float32")
+        for row, text in zip(out, [texts] if single else texts):
+            for tok in re.findall(r"\w+", text.lower()):
+                h = int.from_bytes(hashlib.blake2b(tok.encode(), digest_size=8).digest(), "little")
+                row[h % EMBED_DIM] += 1.0 if h >> 63 else -1.0
+            n = np.linalg.norm(row)
+            if n:
+                row /= n
+            else:
+                row[0] = 1.0
+        return out[0] if single else out
+
+
+class LocalEmbedder:
+    """embed_local backend with the SentenceTransformer‑style `encode` ingestion uses."""
+
+    def __init__(self, name: str):
+        import embed_local
+        self.backend = embed_local.load(name)
+
+    def encode(self, texts, batch_size: int | None = None, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        out = np.asarray(self.backend.encode([texts] if single else list(texts)), dtype="float32")
+        return out[0] if single else out
+
+
+class FakeGemini:
+    """`generate_content_async` over the ranking prompt: top candidates by rating."""
+
+    def __init__(self, latency: Latency, top_n: int):
+        self.latency, self.top_n = latency, top_n
+
+    def _answer(self, contents) -> str:
+        prompt = contents[0]["parts"][0] if isinstance(contents, list) else str(contents)
+        m = re.search(r"^(\[.*\])$", prompt, flags=re.M)
+        cands = json.loads(m.group(1)) if m else []
+        cands.sort(key=lambda c: -(c.get("rating") or 0))
+        out = []
+        for c in cands[:self.top_n]:
+            item = {"id": c["id"], "summary": f"Good fit: {c.get('name')}."}
+            if c.get("needs_tags"):
+                item.update(tags=["Restaurant"], review_summary="Reviewers like it.")
+            out.append(item)
+        return json.dumps(out)
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False,
+                                     request_options=None):
+        text = self._answer(contents)
+        total = self.latency.sample()
+        failed = self.latency.fail()
+        t0 = time.perf_counter()
+
+        def done():
+            timings["llm"].append((time.perf_counter() - t0) * 1000)
+            if failed:
+                raise StandInError("llm stand‑in error")
+
+        if not stream:
+            await asyncio.sleep(total)
+            done()
+            return _Text(text)
+
+        await asyncio.sleep(total * 0.4)            # time to first token
+        pieces = [text[i:i + 80] for i in range(0, len(text), 80)] or [""]
+
+        async def chunks():
+            for p in pieces:
+                await asyncio.sleep(total * 0.6 / len(pieces))
+                yield _Text(p)
+            done()
+
+        return chunks()
+
+
+class _Text:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class MemoryUsers:
+    """The slice of the motor collection API user_repo uses, in memory."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.docs: dict[str, dict] = {}
+
+    @staticmethod
+    def _project(doc: dict | None, projection: dict | None) -> dict | None:
+        if doc is None or not projection:
+            return None if doc is None else dict(doc)
+        out = {k: doc[k] for k, v in projection.items() if v and k in doc}
+        if projection.get("_id", 1):
+            out["_id"] = doc["_id"]
+        return out
+
+    def _apply(self, uid: str, update: dict, upsert: bool) -> dict | None:
+        doc = self.docs.get(uid)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = self.docs[uid] = {"_id": uid, **update.get("$setOnInsert", {})}
+        doc.update(update.get("$set", {}))
+        return doc
+
+    async def find_one(self, filter: dict, projection: dict | None = None, comment=None):
+        await self.latency.wait("mongo")
+        return self._project(self.docs.get(filter["_id"]), projection)
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, comment=None):
+        await self.latency.wait("mongo")
+        self._apply(filter["_id"], update, upsert)
+
+    async def find_one_and_update(self, filter: dict, update: dict, upsert: bool = False,
+                                  return_document=None, comment=None):
+        await self.latency.wait("mongo")
+        return dict(self._apply(filter["_id"], update, upsert) or {}) or None
+
+
+# ---------- instrumentation ----------
+def _timed(stage: str, fn):
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[stage].append((time.perf_counter() - t0) * 1000)
+    return wrapper
+
+
+def _atimed(stage: str, fn):
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            timings[stage].append((time.perf_counter() - t0) * 1000)
+    return wrapper
+
+
+def install(profile: dict, embedder, *, embed_latency: bool, seed: int):
+    """Swap every external call for its stand‑in and time the local stages."""
+    import backend_core, embed_modal, geo_utils, local_ranker, location_modal
+    import postprocess_modal, retrieval, user_repo
+
+    rng = random.Random(seed)
+    lat = {stage: Latency(**cfg, rng=random.Random(rng.random())) for stage, cfg in profile.items()}
+
+    def encode(texts, traceparents=()):
+        if embed_latency:
+            lat["embed"].block("embed")
+        return list(embedder.encode(list(texts)))
+    embed_modal._encoder = lambda: encode
+
+    async def ner(query: str) -> str | None:
+        await lat["ner"].wait("ner")
+        m = re.search(r"\b(?:in|near) (.+)$", query, flags=re.I)
+        return m.group(1).strip() if m else None
+    location_modal.get_location_async = ner
+
+    async def mapbox(place: str):
+        await lat["geocode"].wait("geocode")
+        h = int(hashlib.sha1(place.encode()).hexdigest()[:8], 16)
+        return 37.4 + (h % 1000) / 2500, -122.45 + (h // 1000 % 1000) / 2500
+    geo_utils._mapbox = mapbox
+    geo_utils.MAPBOX_TOKEN = "bench"
+    geo_utils.CACHE_PATH = ""
+
+    postprocess_modal.model = FakeGemini(lat["llm"], postprocess_modal.TOP_N)
+    postprocess_modal._USING_FAKE = False
+
+    users = MemoryUsers(lat["mongo"])
+    user_repo._db = lambda: type("DB", (), {"users": users})
+
+    # local stages, timed where /query calls them
+    for name in ("search", "keyword_search", "search_many", "hydrate"):
+        setattr(retrieval, name, _timed(name, getattr(retrieval, name)))
+    local_ranker.rank = _timed("local_rank", local_ranker.rank)
+    user_repo.get_profile = _atimed("profile", user_repo.get_profile)
+    backend_core._locate = _atimed("locate", backend_core._locate)
+    postprocess_modal.rank_and_format_async = _atimed("rank", postprocess_modal.rank_and_format_async)
+    return backend_core
+
+
+# ---------- datasets ----------
+_SOURCE_COLUMNS = ["name", "area", "address", "location", "rating", "review_amount",
+                   "description", "reviews", "photos"]
+
+
+def source_records(source_dir: str) -> list[dict]:
+    """Raw NDJSON‑shaped records from an existing table (read only)."""
+    import lancedb
+    tbl = lancedb.connect(source_dir).open_table("restaurants")
+    cols = [c for c in _SOURCE_COLUMNS if c in tbl.schema.names]
+    out = []
+    for r in tbl.search().select(cols).limit(None).to_arrow().to_pylist():
+        r["user_ratings_total"] = r.pop("review_amount", 0)
+        r["photo_urls"] = r.pop("photos", None) or []
+        r["reviews"] = r.get("reviews") or []
+        out.append(r)
+    return out
+
+
+def synthesize(records: list[dict], n: int, seed: int) -> list[dict]:
+    """`n` records: the source rows, then jittered copies of them."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        r = dict(records[i % len(records)])
+        copy = i // len(records)
+        if copy:
+            r["name"] = f"{r['name']} {copy + 1}"
+            loc = r.get("location") or {"lat": 0.0, "lng": 0.0}
+            r["location"] = {"lat": loc["lat"] + rng.uniform(-0.01, 0.01),
+                             "lng": loc["lng"] + rng.uniform(-0.01, 0.01)}
+            r["rating"] = round(min(5.0, max(1.0, (r.get("rating") or 4.0) + rng.uniform(-0.3, 0.3))), 1)
+        out.append(r)
+    return out
+
+
+def dataset(records: list[dict], n: int, workdir: Path, tag: str, seed: int, enrich_rows: bool):
+    """Seeded + indexed (+ stub‑enriched) table of `n` rows, reused when present."""
+    import lancedb
+    import db_lancedb, enrich
+    path = workdir / f"{tag}-{n}"
+    db = lancedb.connect(str(path))
+    try:
+        tbl = db.open_table("restaurants")
+        if tbl.count_rows() == n:
+            print(f"[INFO] reusing dataset {path}")
+            return tbl
+    except (FileNotFoundError, ValueError):
+        pass
+    path.mkdir(parents=True, exist_ok=True)
+    ndjson = path / "restaurants.ndjson"
+    with ndjson.open("w") as f:
+        for r in synthesize(records, n, seed):
+            f.write(json.dumps(r) + "\n")
+    tbl = db.create_table("restaurants", schema=db_lancedb.arrow_schema, mode="overwrite")
+    db_lancedb.seed_table(tbl, ndjson)
+    if enrich_rows:
+        enrich.run(tbl, backend="stub")
+    return tbl
+
+
+# ---------- load ----------
+def queries(labeled: list[dict], areas: list[str], n: int, rng: random.Random) -> list[str]:
+    """Eval query texts; some name a known area (local match), some a landmark (NER + geocode)."""
+    texts = [q["query"] for q in labeled]
+    out = []
+    for _ in range(n):
+        t, p = rng.choice(texts), rng.random()
+        if p < 0.3 and areas:
+            t = f"{t} in {rng.choice(areas)}"
+        elif p < 0.45:
+            t = f"{t} near {rng.choice(LANDMARKS)}"
+        out.append(t)
+    return out
+
+
+async def _drive(client, jobs: list[tuple[str, dict]], concurrency: int) -> dict:
+    latencies, errors = [], defaultdict(int)
+    queue: asyncio.Queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    async def worker():
+        while not queue.empty():
+            uid, body = queue.get_nowait()
+            t0 = time.perf_counter()
+            try:
+                r = await client.post("/query", json=body, headers={"uid": uid})
+                status = r.status_code
+            except Exception as e:
+                status = type(e).__name__
+            if status == 200:
+                latencies.append((time.perf_counter() - t0) * 1000)
+            else:
+                errors[str(status)] += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"latencies": latencies, "errors": dict(errors), "elapsed_s": time.perf_counter() - t0}
+
+
+def _pct(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    a = np.asarray(values)
+    return {"count": len(values), "mean": round(float(a.mean()), 2),
+            **{f"p{p}": round(float(np.percentile(a, p)), 2) for p in (50, 95, 99)}}
+
+
+async def run_size(app_mod, tbl, args, labeled: list[dict]) -> dict:
+    import httpx
+    import metrics, postprocess_modal, result_cache, user_repo
+
+    app_mod.restaurants_tbl = tbl
+    app_mod._build_place_indices()
+    result_cache.clear()
+    user_repo._prefs.clear()
+    areas = sorted({a for a in tbl.search().select(["area"]).limit(None).to_arrow()["area"].to_pylist() if a})
+    rng = random.Random(args.seed)
+
+    transport = httpx.ASGITransport(app=app_mod.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        uids = [f"bench-{i}" for i in range(args.users)]
+        for uid in uids:
+            prefs = {"me": {"cuisines": rng.sample(CUISINES, 2),
+                            "restrictions": rng.sample(RESTRICTIONS, rng.randint(0, 1))}}
+            await client.post("/user/prefs", json=prefs, headers={"uid": uid})
+
+        def jobs(n):
+            return [(rng.choice(uids), {"text": t, **({"mode": args.mode} if args.mode else {})})
+                    for t in queries(labeled, areas, n, rng)]
+
+        await _drive(client, jobs(args.warmup), args.concurrency)
+        timings.clear()
+        metrics.reset()                   # /metrics covers the measured requests only
+        for k in postprocess_modal.stats_counters:
+            postprocess_modal.stats_counters[k] = 0
+        res = await _drive(client, jobs(args.requests), args.concurrency)
+
+    ranking = postprocess_modal.stats()
+    ok = len(res["latencies"])
+    return {
+        "rows": tbl.count_rows(),
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "ok": ok,
+        "errors": res["errors"],
+        "throughput_rps": round(ok / res["elapsed_s"], 2) if res["elapsed_s"] else 0.0,
+        "e2e_ms": _pct(res["latencies"]),
+        "stages_ms": {stage: _pct(v) for stage, v in sorted(timings.items())},
+        "llm_fallback_rate": ranking.get("fallback_rate"),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=Path(__file__).parent, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(args) -> dict:
+    # env before the app modules are imported (they read it at import time)
+    if not args.cache:
+        os.environ["RESULT_CACHE_SIZE"] = "0"
+        os.environ["EMBED_CACHE_SIZE"] = "0"
+        os.environ.pop("EMBED_CACHE_DIR", None)
+    os.environ["LANCE_MAINT_INTERVAL_S"] = "0"
+    os.environ["USER_PREFS_WATCH"] = "0"
+    os.environ.setdefault("DEV_MODE", "true")                 # quiet per‑request fallback warnings
+
+    import db_lancedb
+    profile = {k: {**v, **json.loads(args.profile.read_text()).get(k, {})} if args.profile else v
+               for k, v in DEFAULT_PROFILE.items()}
+    embedder = HashEmbedder() if args.embed == "hash" else LocalEmbedder(args.embed)
+    db_lancedb._model = embedder                              # ingestion uses the same vectors
+
+    records = source_records(args.source)
+    labeled = json.loads(args.queries.read_text())
+    tables = {n: dataset(records, n, args.workdir, args.embed, args.seed, not args.no_enrich)
+              for n in args.sizes}
+
+    # backend_core opens LANCEDB_DIR at import; point it at a bench table, never the source
+    db_lancedb.LANCEDB_DIR = str(args.workdir / f"{args.embed}-{args.sizes[0]}")
+    app_mod = install(profile, embedder, embed_latency=args.embed == "hash", seed=args.seed)
+
+    runs = []
+    for n in args.sizes:
+        print(f"[INFO] benchmarking {n} rows: {args.requests} requests, concurrency {args.concurrency}")
+        r = asyncio.run(run_size(app_mod, tables[n], args, labeled))
+        print(f"  - {r['throughput_rps']} req/s, e2e p50 {r['e2e_ms'].get('p50')} ms, "
+              f"p95 {r['e2e_ms'].get('p95')} ms, p99 {r['e2e_ms'].get('p99')} ms, errors {r['errors']}")
+        runs.append(r)
+
+    return {
+        "meta": {"commit": _git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "python": sys.version.split()[0],
+                 "args": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()
+                          if k != "func"}},
+        "profile": profile,
+        "runs": runs,
+    }
+
+
+# ---------- compare ----------
+def compare(old: dict, new: dict) -> list[str]:
+    """One line per size and metric: old → new (Δ%)."""
+    def delta(a, b):
+        if a in (None, 0) or b is None:
+            return f"{a} → {b}"
+        return f"{a} → {b} ({(b - a) / a * 100:+.1f}%)"
+
+    lines = [f"{old['meta'].get('commit')} → {new['meta'].get('commit')}"]
+    by_rows = {r["rows"]: r for r in old["runs"]}
+    for r in new["runs"]:
+        o = by_rows.get(r["rows"])
+        if o is None:
+            continue
+        lines.append(f"[{r['rows']} rows]")
+        lines.append(f"  throughput_rps  {delta(o['throughput_rps'], r['throughput_rps'])}")
+        for p in ("p50", "p95", "p99"):
+            lines.append(f"  e2e {p:<11} {delta(o['e2e_ms'].get(p), r['e2e_ms'].get(p))}")
+        for stage in sorted(set(o["stages_ms"]) | set(r["stages_ms"])):
+            a, b = o["stages_ms"].get(stage, {}), r["stages_ms"].get(stage, {})
+            lines.append(f"  {stage:<15} p95 {delta(a.get('p95'), b.get('p95'))}")
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run")
+    r.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    r.add_argument("--requests", type=int, default=500)
+    r.add_argument("--warmup", type=int, default=20)
+    r.add_argument("--concurrency", type=int, default=16)
+    r.add_argument("--users", type=int, default=50)
+    r.add_argument("--mode", choices=["vector", "keyword", "hybrid"], help="default: SEARCH_MODE")
+    r.add_argument("--embed", default="hash", help="hash | torch | onnx (embed_local backends)")
+    r.add_argument("--profile", type=Path, help="JSON overrides of DEFAULT_PROFILE per stage")
+    r.add_argument("--cache", action="store_true", help="keep result / embedding caches on")
+    r.add_argument("--no-enrich", action="store_true", help="skip stub enrichment of new datasets")
+    r.add_argument("--source", default=os.getenv("LANCEDB_DIR", "./data/lancedb"))
+    r.add_argument("--queries", type=Path, default=DEFAULT_QUERIES)
+    r.add_argument("--workdir", type=Path, default=OUT_DIR / "datasets")
+    r.add_argument("--seed", type=int, default=0)
+    r.add_argument("--out", type=Path)
+    c = sub.add_parser("compare")
+    c.add_argument("old", type=Path)
+    c.add_argument("new", type=Path)
+    args = ap.parse_args()
+
+    if args.cmd == "compare":
+        print("\n".join(compare(json.loads(args.old.read_text()), json.loads(args.new.read_text()))))
+    else:
+        report = run(args)
+        out = args.out or OUT_DIR / f"{report['meta']['commit'] or 'nogit'}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps(report, indent=2))
+        print(f"[INFO] report written to {out}")
@@ -1,18 +1,34 @@
 import os
 import json
+import time
+import hashlib
+import multiprocessing
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator
 
 import lancedb
+import numpy as np
 import pyarrow as pa
-from sentence_transformers import SentenceTransformer
 
 # embedding dimension must match model
 EMBED_DIM = 384
-_model = SentenceTransformer("all-MiniLM-L6-v2")
+_model = None                      # SentenceTransformer, loaded on first use
 # lanceDB storage directory
 LANCEDB_DIR = os.getenv("LANCEDB_DIR", "./data/lancedb")
+# how often an open table checks for versions written by other processes
+# (ingestion, maintenance, other uvicorn workers)
+READ_CONSISTENCY_S = float(os.getenv("LANCE_READ_CONSISTENCY_S", "5"))
 # optional NDJSON path to seed new table
 NDJSON_PATH_ENV = "restaurants.ndjson"
+# bulk ingestion knobs (see seed_table)
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "2048"))     # rows parsed + encoded together
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "128"))      # encode() batch size
+INGEST_WRITE_ROWS = int(os.getenv("INGEST_WRITE_ROWS", "50000"))    # rows per table.add fragment
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0"))              # encoder processes, 0 = in‑process
+# tuned vector index / search parameters (ann_tuning.py); default <LANCEDB_DIR>/ann_params.json
+ANN_PARAMS_PATH = os.getenv("ANN_PARAMS_PATH")
 
 # Arrow schema definitions
 location_type = pa.struct([
@@ -31,47 +47,142 @@ review_type = pa.struct([
 ])
 
 arrow_schema = pa.schema([
+    ("id", pa.utf8()),                 # stable restaurant id, see make_id
     ("area", pa.utf8()),
     ("name", pa.utf8()),
     ("address", pa.utf8()),
     ("location", location_type),
+    ("lat", pa.float64()),             # flat copies of location for scalar
+    ("lng", pa.float64()),             # indexes / geo prefilters
     ("rating", pa.float32()),
     ("review_amount", pa.int32()),
     ("description", pa.utf8()),
     ("reviews", pa.list_(review_type)),
     ("photos", pa.list_(pa.utf8())),
+    ("search_text", pa.utf8()),        # name + description + reviews, FTS‑indexed
+    ("tags", pa.list_(pa.utf8())),     # offline LLM enrichment, see enrich.py
+    ("summary", pa.utf8()),
+    ("review_summary", pa.utf8()),
+    ("enrich_hash", pa.utf8()),        # search_text the enrichment was made from
+    ("content_hash", pa.utf8()),       # hash of the embedding inputs
+    ("row_hash", pa.utf8()),           # hash of all source fields
     ("vector", pa.list_(pa.float32(), EMBED_DIM)),
 ])
 
+# columns that come straight from the source record (everything else is derived)
+BASE_COLUMNS = ["area", "name", "address", "location", "rating", "review_amount",
+                "description", "reviews", "photos"]
+# bump when embedding_text() changes so the next sync re-embeds every row
+# (2: coordinates no longer embedded as text, geo filtering uses lat/lng)
+HASH_VERSION = 2
+EMBED_INPUTS = ["area", "description", "reviews"]     # what embedding_text() reads
+STALE_SAMPLE = 200                                     # rows checked by get_table()
+# scalar indexes: id for upserts / lookups, lat/lng for geo prefilters,
+# rating / review_amount / area for the structured /query filters
+# (bitmap for the low‑cardinality area column, btree for the rest)
+SCALAR_INDEXES = {
+    "id": "BTREE",
+    "lat": "BTREE",
+    "lng": "BTREE",
+    "rating": "BTREE",
+    "review_amount": "BTREE",
+    "area": "BITMAP",
+}
+# full‑text (BM25) index for keyword / hybrid retrieval
+FTS_COLUMN = "search_text"
+# written by enrich.py only; kept across sync so a rating change does not
+# throw away generated text (stale rows are found by enrich_hash)
+ENRICH_COLUMNS = ["tags", "summary", "review_summary", "enrich_hash"]
 
-def make_embedding(record: dict) -> list[float]:
-    """Compute a 384-d embedding over key text fields and location."""
+
+def _get_model():
+    global _model
+    if _model is None:
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer("all-MiniLM-L6-v2")
+    return _model
+
+
+def embedding_text(record: dict) -> str:
+    """
+    Text fed to the encoder: area, description and review texts.
+    Coordinates are not embedded – MiniLM cannot reason about them; search
+    filters on the lat/lng columns instead.
+    """
     parts = [
         record.get("area") or "",
         record.get("description") or "",
-        f"{record.get('location', {}).get('lat', 0.0)} "
-        f"{record.get('location', {}).get('lng', 0.0)}",
     ] + [
         r.get("text", "") or ""  # also guard review texts
-        for r in record.get("reviews", [])
+        for r in record.get("reviews") or []
     ]
-    text = " ".join(parts)
-    vec = _model.encode(text)
+    return " ".join(parts)
+
+
+def make_embedding(record: dict) -> list[float]:
+    """Compute a 384-d embedding over key text fields."""
+    vec = _get_model().encode(embedding_text(record))
     c = vec.astype("float32").tolist()
     return c
 
 
-def make_row(data: dict) -> dict:
+# ---------------------------------------------------------------------------
+# Derived columns: identity + change detection
+# ---------------------------------------------------------------------------
+def _sha1(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def make_id(row: dict) -> str:
+    """Stable id from name + address (the source dump has no place id)."""
+    return _sha1(f"{row.get('name') or ''}|{row.get('address') or ''}")[:16]
+
+
+def search_text(row: dict) -> str:
+    """Text behind the keyword index: name, description and review texts."""
+    parts = [row.get("name") or "", row.get("description") or ""]
+    parts += [r.get("text") or "" for r in row.get("reviews") or []]
+    return " ".join(p for p in parts if p)
+
+
+def content_hash(row: dict) -> str:
+    """Changes iff the text fed to the encoder changes."""
+    return _sha1(f"{HASH_VERSION}|{embedding_text(row)}")
+
+
+def row_hash(row: dict) -> str:
+    base = {k: row.get(k) for k in BASE_COLUMNS}
+    if base["rating"] is not None:          # float32 round trip through Arrow
+        base["rating"] = round(float(base["rating"]), 4)
+    return _sha1(json.dumps(base, sort_keys=True, default=str))
+
+
+def derived_fields(row: dict) -> dict:
+    """Columns computed from the normalized base row, on ingest and on migration."""
+    loc = row.get("location") or {}
     return {
+        "id": make_id(row),
+        "lat": loc.get("lat"),
+        "lng": loc.get("lng"),
+        "search_text": search_text(row),
+        "content_hash": content_hash(row),
+        "row_hash": row_hash(row),
+    }
+
+
+def row_fields(data: dict) -> dict:
+    """Normalized non‑vector columns for one raw restaurant record."""
+    loc = data.get("location") or {}
+    row = {
         "area": data.get("area", ""),
         "name": data.get("name", ""),
         "address": data.get("address", ""),
         "location": {
-            "lat": float(data.get("location", {}).get("lat", 0.0)),
-            "lng": float(data.get("location", {}).get("lng", 0.0)),
+            "lat": float(loc.get("lat") or 0.0),
+            "lng": float(loc.get("lng") or 0.0),
         },
-        "rating": float(data.get("rating", 0.0)),
-        "review_amount": int(data.get("user_ratings_total", 0)),
+        "rating": float(data.get("rating") or 0.0),
+        "review_amount": int(data.get("user_ratings_total") or 0),
         "description": data.get("description", ""),
         "reviews": [
             {
@@ -83,43 +194,428 @@ def make_row(data: dict) -> dict:
                 "text": r.get("text", ""),
                 "time": int(r.get("time", 0)),
             }
-            for r in data.get("reviews", [])
+            for r in data.get("reviews") or []
         ],
-        "photos": data.get("photo_urls", []),
-        "vector": make_embedding(data),
+        "photos": data.get("photo_urls") or [],
     }
+    row.update(derived_fields(row))
+    return row
 
 
-def seed_table(table, ndjson_path: Path) -> None:
-    print(f"[INFO] Seeding 'restaurants' table from {ndjson_path}")
-    batch = []
+def make_row(data: dict, vector: list[float] | None = None) -> dict:
+    row = row_fields(data)
+    row["vector"] = make_embedding(data) if vector is None else vector
+    return row
+
+
+# ---------------------------------------------------------------------------
+# Bulk ingestion
+# ---------------------------------------------------------------------------
+def iter_records(ndjson_path: Path, chunk_rows: int = INGEST_CHUNK_ROWS) -> Iterator[list[dict]]:
+    """Stream NDJSON as lists of parsed records; bad lines are reported and skipped."""
+    chunk = []
     with ndjson_path.open("r", encoding="utf-8") as f:
         for i, line in enumerate(f, start=1):
-            rec = json.loads(line)
+            if not line.strip():
+                continue
             try:
-                batch.append(make_row(rec))
+                chunk.append(json.loads(line))
             except Exception as e:
                 print(f"[ERROR] Error processing line {i}: {e}")
                 continue
-            if i % 100 == 0:
-                table.add(batch)
-                print(f"  - inserted batch up to line {i}")
-                batch.clear()
-    if batch:
-        table.add(batch)
-        print(f"  - inserted final batch of {len(batch)} rows")
-    # build vector index
-    table.create_index(metric="cosine")
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _encode_shard(texts: list[str], batch_size: int) -> np.ndarray:
+    return _get_model().encode(texts, batch_size=batch_size).astype("float32")
+
+
+def encode_texts(texts: list[str], batch_size: int = INGEST_BATCH_SIZE,
+                 pool: ProcessPoolExecutor | None = None, workers: int = 1) -> np.ndarray:
+    """Batched encode → float32 [n, EMBED_DIM], optionally sharded over `pool`."""
+    if pool is None or workers <= 1 or len(texts) < 2 * batch_size:
+        return _encode_shard(texts, batch_size)
+    step = -(-len(texts) // workers)
+    shards = [texts[i:i + step] for i in range(0, len(texts), step)]
+    return np.concatenate(list(pool.map(_encode_shard, shards, [batch_size] * len(shards))))
+
+
+_scalar_schema = pa.schema([f for f in arrow_schema if f.name != "vector"])
+
+
+def build_batch(rows: list[dict], vectors: np.ndarray) -> pa.RecordBatch:
+    """Arrow batch from `row_fields` dicts; vectors go in without a Python round trip."""
+    batch = pa.RecordBatch.from_pylist(rows, schema=_scalar_schema)
+    flat = pa.array(np.ascontiguousarray(vectors, dtype="float32").ravel(), type=pa.float32())
+    return batch.append_column(arrow_schema.field("vector"),
+                               pa.FixedSizeListArray.from_arrays(flat, EMBED_DIM))
+
+
+def _normalize(records: list[dict]) -> list[dict]:
+    """
+    `row_fields` for each record, checked against the schema before anything
+    is encoded; a bad record is reported and skipped, not its whole chunk.
+    """
+    rows = []
+    for rec in records:
+        try:
+            row = row_fields(rec)
+            embedding_text(row)
+            rows.append(row)
+        except Exception as e:
+            print(f"[ERROR] Error processing record {rec.get('name')!r}: {e}")
+    try:
+        pa.RecordBatch.from_pylist(rows, schema=_scalar_schema)     # common case: all fit
+        return rows
+    except Exception:
+        pass
+    ok = []
+    for row in rows:
+        try:
+            pa.RecordBatch.from_pylist([row], schema=_scalar_schema)
+            ok.append(row)
+        except Exception as e:
+            print(f"[ERROR] Error processing record {row.get('name')!r}: {e}")
+    return ok
+
+
+def ann_params_path() -> Path:
+    return Path(ANN_PARAMS_PATH or os.path.join(LANCEDB_DIR, "ann_params.json"))
+
+
+def load_ann_params() -> dict:
+    """
+    {"index": create_index kwargs, "search": {"flat", "nprobes",
+    "refine_factor", "ef"}, ...} written by ann_tuning.py; {} if untuned.
+    """
+    path = ann_params_path()
+    if not path.is_file():
+        return {}
+    try:
+        return json.loads(path.read_text())
+    except Exception as e:
+        print("[WARN] ANN params unreadable, using defaults:", e)
+        return {}
+
+
+def save_ann_params(params: dict) -> Path:
+    path = ann_params_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(params, indent=2))
+    os.replace(tmp, path)                 # atomic; every worker reads it
+    return path
+
+
+def build_vector_index(table, index: dict | None = None) -> None:
+    """
+    (Re)train the cosine vector index over every row – with `index`
+    (create_index kwargs), else the tuned ones from ann_params.json,
+    else the LanceDB defaults.
+    """
+    if index is None:
+        index = load_ann_params().get("index") or {}
+    try:
+        table.create_index(metric="cosine", replace=True, **index)
+    except Exception as e:
+        if not index:
+            raise
+        # e.g. more partitions than the table now has rows
+        print(f"[WARN] tuned vector index {index} failed, using defaults:", e)
+        table.create_index(metric="cosine", replace=True)
+
+
+def build_indices(table) -> None:
+    """Vector index (cosine), SCALAR_INDEXES and the FTS index."""
+    try:
+        build_vector_index(table)
+    except Exception as e:                  # e.g. too few rows to train IVF_PQ
+        print("[WARN] vector index not built:", e)
+    for col, kind in SCALAR_INDEXES.items():
+        table.create_scalar_index(col, index_type=kind)
+    table.create_fts_index(FTS_COLUMN, replace=True)
+
+
+def ensure_scalar_indices(table) -> list[str]:
+    """Create the SCALAR_INDEXES / FTS index a table is missing; returns their columns."""
+    have = {c for ix in table.list_indices() for c in ix.columns}
+    missing = [c for c in SCALAR_INDEXES if c not in have]
+    for col in missing:
+        table.create_scalar_index(col, index_type=SCALAR_INDEXES[col])
+    if FTS_COLUMN not in have:
+        table.create_fts_index(FTS_COLUMN, replace=True)
+        missing.append(FTS_COLUMN)
+    if missing:
+        print(f"[INFO] Built missing indexes on {missing}")
+    return missing
+
+
+def sql_in(column: str, values) -> str:
+    """`column IN (...)` filter with quoted string literals."""
+    quoted = ", ".join("'" + str(v).replace("'", "''") + "'" for v in values)
+    return f"{column} IN ({quoted})"
+
+
+def seed_table(table, ndjson_path: Path, *,
+               chunk_rows: int = INGEST_CHUNK_ROWS,
+               batch_size: int = INGEST_BATCH_SIZE,
+               write_rows: int = INGEST_WRITE_ROWS,
+               workers: int = INGEST_WORKERS) -> dict:
+    """
+    Bulk‑load NDJSON: parse in chunks, encode each chunk in one batched call
+    (optionally across `workers` processes), build Arrow batches directly and
+    write them in large fragments. Writes overlap with encoding of the next
+    chunk. Returns timing stats.
+    """
+    print(f"[INFO] Seeding 'restaurants' table from {ndjson_path}")
+    stats = {"rows": 0, "embed_s": 0.0, "write_s": 0.0}
+    t_start = time.perf_counter()
+
+    def _write(batches: list[pa.RecordBatch]) -> None:
+        t0 = time.perf_counter()
+        table.add(pa.Table.from_batches(batches, schema=arrow_schema))
+        stats["write_s"] += time.perf_counter() - t0
+
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lance-writer")
+    pending, buffered, buffered_rows = None, [], 0
+    try:
+        for records in iter_records(ndjson_path, chunk_rows):
+            rows = _normalize(records)
+            if not rows:
+                continue
+            t0 = time.perf_counter()
+            vectors = encode_texts([embedding_text(r) for r in rows], batch_size, pool, workers)
+            stats["embed_s"] += time.perf_counter() - t0
+            buffered.append(build_batch(rows, vectors))
+            buffered_rows += len(rows)
+            stats["rows"] += len(rows)
+            if buffered_rows >= write_rows:
+                if pending:
+                    pending.result()
+                pending = writer.submit(_write, buffered)
+                print(f"  - writing fragment of {buffered_rows} rows (total {stats['rows']})")
+                buffered, buffered_rows = [], 0
+        if pending:
+            pending.result()
+        if buffered:
+            _write(buffered)
+            print(f"  - inserted final fragment of {buffered_rows} rows")
+    finally:
+        writer.shutdown()
+        if pool:
+            pool.shutdown()
+
+    build_indices(table)
     total = table.count_rows()
-    print(f"[INFO] Seeding complete. Total rows: {total}")
+    elapsed = time.perf_counter() - t_start
+    stats.update(elapsed_s=elapsed, rows_per_s=stats["rows"] / elapsed if elapsed else 0.0)
+    print(f"[INFO] Seeding complete. Total rows: {total} – "
+          f"{stats['rows_per_s']:.0f} rows/s, embed {stats['embed_s']:.1f}s, write {stats['write_s']:.1f}s")
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# Incremental sync
+# ---------------------------------------------------------------------------
+def _known_hashes(table) -> dict[str, tuple[str, str]]:
+    t = table.search().select(["id", "content_hash", "row_hash"]).limit(None).to_arrow()
+    return dict(zip(t["id"].to_pylist(), zip(t["content_hash"].to_pylist(), t["row_hash"].to_pylist())))
+
+
+def fetch_rows(table, ids: list[str], columns: list[str]) -> dict[str, dict]:
+    out = {}
+    for i in range(0, len(ids), 1000):
+        t = (table.search().where(sql_in("id", ids[i:i + 1000]))
+             .select(["id"] + columns).limit(None).to_arrow())
+        for row in t.to_pylist():
+            out[row.pop("id")] = row
+    return out
+
+
+def take_rows(table, row_ids: list[int], columns: list[str]) -> pa.Table:
+    """
+    `columns` (+ id, _rowid) for Lance row ids returned by a search, in one
+    bulk take. Result order is not the request order.
+    """
+    cols = ["id"] + [c for c in columns if c != "id"]
+    return table.take_row_ids(row_ids).select(cols).with_row_id().to_arrow()
+
+
+def _vectors_for(table, ids: list[str]) -> dict[str, np.ndarray]:
+    out = {}
+    for i in range(0, len(ids), 1000):
+        t = (table.search().where(sql_in("id", ids[i:i + 1000]))
+             .select(["id", "vector"]).limit(None).to_arrow())
+        vecs = t["vector"].combine_chunks().values.to_numpy().reshape(-1, EMBED_DIM)
+        out.update(zip(t["id"].to_pylist(), vecs))
+    return out
+
+
+def sync_table(table, ndjson_path: Path, *, prune: bool = False,
+               chunk_rows: int = INGEST_CHUNK_ROWS,
+               batch_size: int = INGEST_BATCH_SIZE,
+               workers: int = INGEST_WORKERS) -> dict:
+    """
+    Incremental refresh from a full NDJSON dump.
+
+    Rows whose `row_hash` and `content_hash` are unchanged are skipped; rows
+    whose embedding inputs (`content_hash`) changed, and new rows, are
+    re‑embedded; rows where
+    only other fields changed keep their stored vector. Enrichment columns
+    are carried over (enrich.py re‑generates stale ones). Everything is
+    written with a merge‑insert on `id`. With `prune`, ids missing from the
+    dump are deleted.
+    """
+    print(f"[INFO] Syncing 'restaurants' table from {ndjson_path}")
+    known = _known_hashes(table)
+    seen: set[str] = set()
+    stats = {"rows": 0, "unchanged": 0, "inserted": 0, "updated": 0, "embedded": 0,
+             "deleted": 0, "embed_s": 0.0, "write_s": 0.0}
+    t_start = time.perf_counter()
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        for records in iter_records(ndjson_path, chunk_rows):
+            rows = {r["id"]: r for r in _normalize(records)}        # last occurrence wins
+            stats["rows"] += len(rows)
+            seen.update(rows)
+            changed = [r for r in rows.values() if known.get(r["id"]) != (r["content_hash"], r["row_hash"])]
+            stats["unchanged"] += len(rows) - len(changed)
+            if not changed:
+                continue
+
+            same_text = [r["id"] for r in changed if known.get(r["id"], (None, None))[0] == r["content_hash"]]
+            vecs = _vectors_for(table, same_text) if same_text else {}
+            to_embed = [r for r in changed if r["id"] not in vecs]
+            if to_embed:
+                t0 = time.perf_counter()
+                fresh = encode_texts([embedding_text(r) for r in to_embed], batch_size, pool, workers)
+                stats["embed_s"] += time.perf_counter() - t0
+                vecs.update(zip((r["id"] for r in to_embed), fresh))
+
+            existing = [r["id"] for r in changed if r["id"] in known]
+            if existing:
+                for rid, enrichment in fetch_rows(table, existing, ENRICH_COLUMNS).items():
+                    rows[rid].update(enrichment)
+
+            batch = build_batch(changed, np.stack([vecs[r["id"]] for r in changed]))
+            t0 = time.perf_counter()
+            (table.merge_insert("id")
+                  .when_matched_update_all()
+                  .when_not_matched_insert_all()
+                  .execute(pa.Table.from_batches([batch])))
+            stats["write_s"] += time.perf_counter() - t0
+
+            new = sum(r["id"] not in known for r in changed)
+            stats["inserted"] += new
+            stats["updated"] += len(changed) - new
+            stats["embedded"] += len(to_embed)
+            known.update((r["id"], (r["content_hash"], r["row_hash"])) for r in changed)
+            print(f"  - upserted {len(changed)} rows ({len(to_embed)} re‑embedded), total seen {stats['rows']}")
+
+        if prune:
+            gone = [i for i in known if i not in seen]
+            for i in range(0, len(gone), 1000):
+                table.delete(sql_in("id", gone[i:i + 1000]))
+            stats["deleted"] = len(gone)
+    finally:
+        if pool:
+            pool.shutdown()
+
+    stats["elapsed_s"] = time.perf_counter() - t_start
+    print(f"[INFO] Sync complete: {stats['inserted']} new, {stats['updated']} updated "
+          f"({stats['embedded']} re‑embedded), {stats['unchanged']} unchanged, {stats['deleted']} deleted "
+          f"in {stats['elapsed_s']:.1f}s")
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# Re‑embedding after an embedding_text() / HASH_VERSION change
+# ---------------------------------------------------------------------------
+def stale_ids(table, limit: int | None = None) -> list[str]:
+    """Ids whose stored vector was not made from the current embedding_text()."""
+    t = table.search().select(["id", "content_hash", *EMBED_INPUTS]).limit(limit).to_arrow()
+    return [r["id"] for r in t.to_pylist() if r["content_hash"] != content_hash(r)]
+
+
+def reembed(table, ids: list[str], *,
+            chunk_rows: int = INGEST_CHUNK_ROWS,
+            batch_size: int = INGEST_BATCH_SIZE) -> int:
+    """New vectors + content_hash for `ids` from the rows already in the table."""
+    columns = [f.name for f in arrow_schema if f.name != "vector"]
+    for i in range(0, len(ids), chunk_rows):
+        rows = (table.search().where(sql_in("id", ids[i:i + chunk_rows]))
+                .select(columns).limit(None).to_arrow().to_pylist())
+        for r in rows:
+            r["content_hash"] = content_hash(r)
+        vectors = encode_texts([embedding_text(r) for r in rows], batch_size)
+        (table.merge_insert("id")
+              .when_matched_update_all()
+              .execute(pa.Table.from_batches([build_batch(rows, vectors)])))
+        print(f"  - re‑embedded {min(i + chunk_rows, len(ids))}/{len(ids)} rows")
+    return len(ids)
+
+
+def _warn_stale(tbl) -> None:
+    n = len(stale_ids(tbl, limit=STALE_SAMPLE))
+    if n:
+        print(f"[WARN] {n} of {min(tbl.count_rows(), STALE_SAMPLE)} sampled rows have vectors from an "
+              f"older embedding_text() (HASH_VERSION {HASH_VERSION}) – run `python db_lancedb.py --reembed`")
+
+
+def migrate_table(db, tbl):
+    """Rewrite an existing table to the current `arrow_schema`, keeping its vectors."""
+    old = tbl.to_arrow()
+    missing = [f.name for f in arrow_schema if f.name not in old.schema.names]
+    print(f"[INFO] Migrating 'restaurants' table, adding columns: {missing}")
+    rows = old.select([c for c in BASE_COLUMNS if c in old.schema.names]).to_pylist()
+    derived = [derived_fields(r) for r in rows]
+    if "content_hash" in missing:
+        # stored vectors came from an unknown embedding_text(); let the next sync redo them
+        for d in derived:
+            d["content_hash"] = None
+    cols = []
+    for field in arrow_schema:
+        if field.name in old.schema.names:
+            cols.append(old.column(field.name).cast(field.type))
+        else:
+            cols.append(pa.array([d.get(field.name) for d in derived], type=field.type))
+    new = pa.Table.from_arrays(cols, schema=arrow_schema)
+
+    # ids must be unique for merge‑insert; keep the first copy of duplicates
+    first, keep = set(), []
+    for d in derived:
+        keep.append(d["id"] not in first)
+        first.add(d["id"])
+    if not all(keep):
+        print(f"[WARN] dropping {keep.count(False)} duplicate rows (same name + address)")
+        new = new.filter(pa.array(keep))
+
+    tbl = db.create_table("restaurants", new, schema=arrow_schema, mode="overwrite")
+    build_indices(tbl)
+    return tbl
+
+
+def connect():
+    return lancedb.connect(LANCEDB_DIR, read_consistency_interval=timedelta(seconds=READ_CONSISTENCY_S))
 
 
 def get_table():
     """
     Returns a LanceTable named 'restaurants'.
-    If missing or schema mismatched, recreates it, and optionally seeds from NDJSON.
+    If missing, creates it and optionally seeds from NDJSON; if columns are
+    missing, migrates it in place (see migrate_table); scalar indexes added
+    since the table was built are created on open.
     """
-    db = lancedb.connect(LANCEDB_DIR)
+    db = connect()
     try:
         tbl = db.open_table("restaurants")
     except (FileNotFoundError, ValueError):
@@ -133,4 +629,62 @@ def get_table():
                 seed_table(tbl, path)
             else:
                 print(f"[WARN] {NDJSON_PATH_ENV}='{ndjson_path}' not found or not a file")
+    else:
+        if _needs_migration(tbl):
+            tbl = _migrate_locked(db)
+        elif tbl.count_rows():
+            ensure_scalar_indices(tbl)
+        if tbl.count_rows():
+            _warn_stale(tbl)
     return tbl
+
+
+def _needs_migration(tbl) -> bool:
+    return any(f.name not in tbl.schema.names for f in arrow_schema)
+
+
+def _migrate_locked(db):
+    """
+    migrate_table under the maintenance lock. Every uvicorn worker imports
+    the API, so the others wait here and then find the table migrated.
+    """
+    import lance_maintenance                # imports this module
+    with lance_maintenance.exclusive():
+        tbl = db.open_table("restaurants")  # re‑check: another worker may have done it
+        return migrate_table(db, tbl) if _needs_migration(tbl) else tbl
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Bulk‑load restaurants NDJSON into LanceDB")
+    ap.add_argument("ndjson", type=Path, nargs="?")
+    ap.add_argument("--overwrite", action="store_true", help="drop and recreate the table first")
+    ap.add_argument("--sync", action="store_true", help="incremental upsert into the existing table")
+    ap.add_argument("--prune", action="store_true", help="with --sync: delete rows missing from the dump")
+    ap.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    ap.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    ap.add_argument("--chunk-rows", type=int, default=INGEST_CHUNK_ROWS)
+    ap.add_argument("--write-rows", type=int, default=INGEST_WRITE_ROWS)
+    ap.add_argument("--enrich", action="store_true", help="run the offline LLM enrichment afterwards")
+    ap.add_argument("--reembed", action="store_true",
+                    help="re‑embed rows from an older embedding_text() (HASH_VERSION), no dump needed")
+    args = ap.parse_args()
+    if args.reembed:
+        tbl = get_table()
+        print(json.dumps({"reembedded": reembed(tbl, stale_ids(tbl), chunk_rows=args.chunk_rows,
+                                                batch_size=args.batch_size)}))
+    elif args.ndjson is None:
+        ap.error("ndjson is required (or --reembed)")
+    elif args.sync:
+        tbl = get_table()
+        print(json.dumps(sync_table(tbl, args.ndjson, prune=args.prune, chunk_rows=args.chunk_rows,
+                                    batch_size=args.batch_size, workers=args.workers)))
+    else:
+        db = connect()
+        tbl = db.create_table("restaurants", schema=arrow_schema,
+                              mode="overwrite" if args.overwrite else "create")
+        print(json.dumps(seed_table(tbl, args.ndjson, chunk_rows=args.chunk_rows, batch_size=args.batch_size,
+                                    write_rows=args.write_rows, workers=args.workers)))
+    if args.enrich:
+        import enrich
+        print(json.dumps(enrich.run(tbl)))
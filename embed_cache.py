@@ -0,0 +1,155 @@
+# embed_cache.py – two‑tier cache in front of embed_modal.embed
+"""
+Popular queries ("ramen in palo alto") are embedded over and over, so
+vectors are cached by *normalized* embed text:
+
+    tier 1  in‑process TTL/LRU (`cache_utils.TTLCache`)
+    tier 2  optional on‑disk store shared by all uvicorn workers:
+              <dir>/vectors.f32    mmap'd float32 matrix  [slots × EMBED_DIM]
+              <dir>/index.sqlite   key → slot (WAL mode, safe across processes)
+
+The disk tier is a ring buffer: once every slot is used the oldest entry is
+overwritten (and counted as an eviction). It survives restarts.
+
+Env vars:
+    EMBED_CACHE_SIZE        – in‑memory entries            (default 10000)
+    EMBED_CACHE_TTL         – seconds, both tiers          (default 86400)
+    EMBED_CACHE_DIR         – enable disk tier at this dir (default off)
+    EMBED_CACHE_DISK_SLOTS  – disk tier capacity           (default 100000)
+"""
+from __future__ import annotations
+
+import hashlib, os, sqlite3, threading, time
+from pathlib import Path
+
+import numpy as np
+
+from cache_utils import TTLCache
+
+EMBED_DIM = 384
+CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", "86400"))
+CACHE_DIR = os.getenv("EMBED_CACHE_DIR")
+DISK_SLOTS = int(os.getenv("EMBED_CACHE_DISK_SLOTS", "100000"))
+
+
+def normalize(text: str) -> str:
+    """Cache key for an embed text: lower‑cased, whitespace collapsed."""
+    return " ".join(text.lower().split())
+
+
+# ---------------------------------------------------------------------------
+# Disk tier
+# ---------------------------------------------------------------------------
+class DiskVectorStore:
+    def __init__(self, root: str | Path, slots: int = DISK_SLOTS, dim: int = EMBED_DIM,
+                 ttl: float | None = CACHE_TTL):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.slots, self.dim, self.ttl = slots, dim, ttl
+        self.hits = self.misses = self.evictions = 0
+
+        vec_path = self.root / "vectors.f32"
+        nbytes = slots * dim * 4
+        if not vec_path.exists() or vec_path.stat().st_size != nbytes:
+            with vec_path.open("wb") as f:      # sparse file, pages filled lazily
+                f.truncate(nbytes)
+        self._vecs = np.memmap(vec_path, dtype="float32", mode="r+", shape=(slots, dim))
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.root / "index.sqlite", timeout=10,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries"
+                         " (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, created REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER)")
+        self._db.execute("INSERT OR IGNORE INTO meta VALUES ('next_slot', 0)")
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, text: str) -> np.ndarray | None:
+        with self._lock:
+            row = self._db.execute("SELECT slot, created FROM entries WHERE key=?",
+                                   (self._key(text),)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.array(self._vecs[row[0]])       # copy out of the mmap
+
+    def put(self, text: str, vec: np.ndarray) -> None:
+        key = self._key(text)
+        with self._lock:
+            # reserve a slot (and drop whoever owned it) in one write txn
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                nxt = self._db.execute("SELECT v FROM meta WHERE k='next_slot'").fetchone()[0]
+                slot = nxt % self.slots
+                self._db.execute("UPDATE meta SET v=? WHERE k='next_slot'", (nxt + 1,))
+                cur = self._db.execute("DELETE FROM entries WHERE slot=? OR key=?", (slot, key))
+                if nxt >= self.slots and cur.rowcount:
+                    self.evictions += 1
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._vecs[slot] = vec[: self.dim]
+            self._vecs.flush()
+            # publish only after the vector bytes are in place
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                             (key, slot, time.time()))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self),
+            "slots": self.slots,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Public API
+# ---------------------------------------------------------------------------
+_mem = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_disk: DiskVectorStore | None = None
+if CACHE_DIR:
+    try:
+        _disk = DiskVectorStore(CACHE_DIR)
+    except Exception as e:
+        print("[WARN] embedding disk cache disabled:", e)
+
+
+def get(key: str) -> np.ndarray | None:
+    """Look up a normalized embed text in memory, then on disk."""
+    vec = _mem.get(key)
+    if vec is not None:
+        return vec
+    if _disk is not None:
+        vec = _disk.get(key)
+        if vec is not None:
+            vec.setflags(write=False)
+            _mem.put(key, vec)              # promote to tier 1
+            return vec
+    return None
+
+
+def put(key: str, vec: np.ndarray) -> None:
+    vec.setflags(write=False)               # shared between callers
+    _mem.put(key, vec)
+    if _disk is not None:
+        try:
+            _disk.put(key, vec)
+        except Exception as e:
+            print("[WARN] embedding disk cache write failed:", e)
+
+
+def stats() -> dict:
+    return {"memory": _mem.stats(), "disk": _disk.stats() if _disk else None}
@@ -0,0 +1,174 @@
+# embed_local.py – in‑process embedding backends (alternative to Modal)
+"""
+Same model as the Modal function and `db_lancedb` ingestion
+(`all-MiniLM-L6-v2`, 384‑d, mean pooling + L2 norm), run inside the API
+process so a short query costs no network hop.
+
+Backends (selected in embed_modal via EMBED_BACKEND):
+    torch   – SentenceTransformer on CPU
+    onnx    – int8 dynamically‑quantized ONNX export run by onnxruntime
+
+Usage:
+    python embed_local.py export ./data/minilm-onnx   # one‑off, needs torch
+    python embed_local.py parity                      # compare to reference
+    python embed_local.py bench                       # per‑query latency
+
+Env vars:
+    EMBED_MODEL      – HF model id        (default sentence-transformers/all-MiniLM-L6-v2)
+    EMBED_ONNX_DIR   – exported model dir (default ./data/minilm-onnx)
+    EMBED_THREADS    – intra‑op threads for onnxruntime (default 0 = auto)
+"""
+from __future__ import annotations
+
+import os, time
+from pathlib import Path
+
+import numpy as np
+
+EMBED_DIM = 384
+MAX_SEQ_LEN = 256                      # SentenceTransformer default for MiniLM
+MODEL_NAME = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+ONNX_DIR = os.getenv("EMBED_ONNX_DIR", "./data/minilm-onnx")
+ONNX_FILE = "model_quantized.onnx"
+THREADS = int(os.getenv("EMBED_THREADS", "0"))
+
+PARITY_TEXTS = [
+    "ramen in palo alto",
+    "cheap tacos open late mission district",
+    "Palo Alto Japanese noodle chain outpost offering customizable ramen bowls 37.4455 -122.1607",
+    "quiet vegetarian brunch spot with outdoor seating",
+    "best birria tacos",
+]
+
+
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        from sentence_transformers import SentenceTransformer
+        self._model = SentenceTransformer(model_name, device="cpu")
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        return self._model.encode(texts, batch_size=64).astype("float32")
+
+
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_dir: str | Path = ONNX_DIR):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_dir = Path(model_dir)
+        self._tok = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self._tok.enable_truncation(MAX_SEQ_LEN)
+        self._tok.enable_padding()
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = THREADS
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._sess = ort.InferenceSession(str(model_dir / ONNX_FILE), opts,
+                                          providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self._sess.get_inputs()}
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        encs = self._tok.encode_batch(texts)
+        ids = np.array([e.ids for e in encs], dtype="int64")
+        mask = np.array([e.attention_mask for e in encs], dtype="int64")
+        feed = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self._inputs:
+            feed["token_type_ids"] = np.zeros_like(ids)
+        hidden = self._sess.run(None, feed)[0]                 # [n, seq, dim]
+        m = mask[..., None].astype("float32")
+        pooled = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype("float32")
+
+
+BACKENDS = {"torch": TorchBackend, "onnx": OnnxBackend}
+
+
+def load(name: str):
+    return BACKENDS[name]()
+
+
+# ---------------------------------------------------------------------------
+# Export / parity
+# ---------------------------------------------------------------------------
+def export_onnx(out_dir: str | Path = ONNX_DIR, model_name: str = MODEL_NAME) -> Path:
+    """Export the HF encoder to ONNX and write an int8 dynamic‑quantized copy."""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    tok = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    class _Encoder(torch.nn.Module):            # pin the forward() signature
+        def __init__(self, m):
+            super().__init__()
+            self.m = m
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.m(input_ids=input_ids, attention_mask=attention_mask,
+                          token_type_ids=token_type_ids).last_hidden_state
+
+    enc = tok(["hello world"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    axes = {n: {0: "batch", 1: "seq"} for n in names + ["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(
+            _Encoder(model), tuple(enc[n] for n in names), str(out / "model.onnx"),
+            input_names=names, output_names=["last_hidden_state"],
+            dynamic_axes=axes, opset_version=17, dynamo=False,
+        )
+    tok.save_pretrained(out)                                   # writes tokenizer.json
+    quantize_dynamic(str(out / "model.onnx"), str(out / ONNX_FILE), weight_type=QuantType.QInt8)
+    print(f"[INFO] exported {model_name} → {out / ONNX_FILE}")
+    return out / ONNX_FILE
+
+
+def parity_check(backend, reference=None, texts: list[str] = PARITY_TEXTS,
+                 min_cosine: float = 0.99) -> dict:
+    """
+    Cosine similarity between `backend` and the reference SentenceTransformer
+    on `texts`. Vectors must stay compatible with the stored `vector` column.
+    """
+    reference = reference or TorchBackend()
+    a, b = backend.encode(texts), reference.encode(texts)
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    cos = (a * b).sum(axis=1)
+    return {
+        "backend": backend.name,
+        "min_cosine": float(cos.min()),
+        "mean_cosine": float(cos.mean()),
+        "ok": bool(cos.min() >= min_cosine),
+    }
+
+
+def bench(backend, text: str = PARITY_TEXTS[0], n: int = 200) -> float:
+    """Median single‑query encode latency in milliseconds."""
+    backend.encode([text])                                      # warm‑up
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        backend.encode([text])
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+if __name__ == "__main__":
+    import argparse, json
+    ap = argparse.ArgumentParser()
+    ap.add_argument("cmd", choices=["export", "parity", "bench"])
+    ap.add_argument("out_dir", nargs="?", default=ONNX_DIR)
+    ap.add_argument("--backend", choices=list(BACKENDS), default="onnx")
+    args = ap.parse_args()
+    if args.cmd == "export":
+        export_onnx(args.out_dir)
+    elif args.cmd == "parity":
+        print(json.dumps(parity_check(load(args.backend))))
+    else:
+        print(json.dumps({args.backend: {"p50_ms": bench(load(args.backend))}}))
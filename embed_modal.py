@@ -10,14 +10,31 @@ Modal details:
     * The function runs inside a slim container with `sentence-transformers`.
     * Model: `all-MiniLM-L6-v2` (384‑dim).
     * Concurrency capped at 100 (adjust as needed).
+    * `compute_embeddings` takes a list; concurrent `embed()` calls are
+      micro‑batched into it (EMBED_BATCH_MAX items or EMBED_BATCH_WAIT_MS).
+
+Backend:
+    EMBED_BACKEND=modal|torch|onnx picks where vectors are computed; the
+    local ones live in `embed_local.py`. EMBED_PARITY_CHECK=true compares a
+    local backend to the reference model at load time and falls back to
+    Modal if the vectors diverge.
 """
 from __future__ import annotations
 
-import hashlib, os, numpy as np
+import functools, hashlib, os, numpy as np
 import modal
 
+import embed_cache
+import metrics
+from batching import MicroBatcher
+
 EMBED_DIM = 384
 DEV_MODE = os.getenv("DEV_MODE", "false").lower() == "true"
+BACKEND = os.getenv("EMBED_BACKEND", "modal").lower()
+PARITY_CHECK = os.getenv("EMBED_PARITY_CHECK", "false").lower() == "true"
+BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "32"))
+BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+BATCH_INFLIGHT = int(os.getenv("EMBED_BATCH_INFLIGHT", "8"))
 
 # ---------------------------------------------------------------------------
 # Modal definition (executed once at import‑time)
@@ -29,41 +46,135 @@ image = (
     .pip_install("sentence-transformers==2.5.1", "torch", "transformers", "accelerate")
 )
 
-@app.function(image=image, max_containers=100, cpu=2)
-def compute_embedding(text: str) -> list[float]:
+def _load_model():
     from sentence_transformers import SentenceTransformer
     global _model
     if "_model" not in globals():
         _model = SentenceTransformer("all-MiniLM-L6-v2")
-    emb = _model.encode(text)       # <‑‑ drop normalize_embeddings=True
+    return _model
+
+
+@app.function(image=image, max_containers=100, cpu=2)
+def compute_embedding(text: str) -> list[float]:
+    emb = _load_model().encode(text)       # <‑‑ drop normalize_embeddings=True
     return emb.tolist()
 
+
+@app.function(image=image, max_containers=100, cpu=2)
+def compute_embeddings(texts: list[str], traceparents: list[str] | None = None) -> list[list[float]]:
+    """Batched variant: one `encode` call for the whole list."""
+    if traceparents:                       # the API requests this batch serves
+        print(f"[INFO] {len(texts)} texts for traceparent", " ".join(traceparents))
+    embs = _load_model().encode(texts, batch_size=64)
+    return embs.tolist()
+
 # ---------------------------------------------------------------------------
 # Local helper
 # ---------------------------------------------------------------------------
 
 def _fallback(text: str) -> np.ndarray:
     """Deterministic pseudo‑random vector so tests remain stable offline."""
+    metrics.inc("fallbacks_total", stage="embed")
     seed = int(hashlib.sha256(text.encode()).hexdigest(), 16) % 2**32
     rng = np.random.default_rng(seed)
     return rng.random(EMBED_DIM, dtype="float32")
 
 
+@functools.lru_cache(maxsize=1)
+def _embed_fn():
+    """Resolve the deployed function once; failures are retried next call."""
+    return modal.Function.lookup("pairfecto-embeddings", "compute_embeddings")
+
+
+def _to_vec(vec: list[float]) -> np.ndarray:
+    arr = np.array(vec[:EMBED_DIM], dtype="float32")
+    if arr.shape[0] < EMBED_DIM:
+        arr = np.pad(arr, (0, EMBED_DIM - arr.shape[0]))
+    return arr
+
+
+@functools.lru_cache(maxsize=1)
+def _encoder():
+    """Batch encode function for the configured EMBED_BACKEND."""
+    if BACKEND != "modal":
+        try:
+            import embed_local
+            backend = embed_local.load(BACKEND)
+            if PARITY_CHECK:
+                report = embed_local.parity_check(backend)
+                print("[INFO] embedding parity:", report)
+                if not report["ok"]:
+                    raise RuntimeError("vectors diverge from the reference model")
+            return lambda texts, traceparents=(): list(backend.encode(texts))
+        except Exception as e:
+            print(f"[WARN] EMBED_BACKEND={BACKEND} unavailable – using Modal:", e)
+    return lambda texts, traceparents=(): [
+        _to_vec(v) for v in _embed_fn().remote(texts, traceparents=list(traceparents) or None)]
+
+
+def _embed_batch(texts: list[str], traceparents: list[str] = ()) -> list[np.ndarray]:
+    """Encode a list of (already normalized) texts in one call."""
+    return _encoder()(texts, traceparents)
+
+
+_batcher = MicroBatcher(
+    _embed_batch,
+    max_batch=BATCH_MAX,
+    max_wait=BATCH_WAIT_MS / 1000,
+    max_inflight=BATCH_INFLIGHT,
+    name="embed",
+    with_tags=True,                        # trace ids of the requests in a batch
+)
+
+
+def embed_strict(text: str) -> np.ndarray:
+    """Like `embed`, but raises instead of returning a fallback vector."""
+    key = embed_cache.normalize(text)
+    cached = embed_cache.get(key)
+    if cached is not None:
+        return cached
+    arr = _batcher.submit(key, metrics.traceparent()).result()   # blocks until the batch returns
+    embed_cache.put(key, arr)
+    return arr
+
+
 # embed_modal.py  – patch embed()
 def embed(text: str) -> np.ndarray:
+    """Return the (read‑only, possibly cached) vector for `text`."""
     try:
-        fn = modal.Function.lookup("pairfecto-embeddings", "compute_embedding")
-
-        vec = fn.remote(text)                 # blocks, returns list[float]
-
-        arr = np.array(vec[:EMBED_DIM], dtype="float32")
-        if arr.shape[0] < EMBED_DIM:
-            arr = np.pad(arr, (0, EMBED_DIM - arr.shape[0]))
-        return arr
+        return embed_strict(text)
     except Exception as e:
         if not DEV_MODE:
-            print("[WARN] Modal embedding failed – using fallback:", e)
-        return _fallback(text)
+            print("[WARN] embedding failed – using fallback:", e)
+        return _fallback(text)                # never cache fallback vectors
+
+
+def embed_many(texts: list[str]) -> list[np.ndarray]:
+    """Embed a list in as few remote calls as possible (cache‑aware)."""
+    keys = [embed_cache.normalize(t) for t in texts]
+    out: list[np.ndarray | None] = [embed_cache.get(k) for k in keys]
+    missing = list(dict.fromkeys(k for k, v in zip(keys, out) if v is None))
+    fresh: dict[str, np.ndarray] = {}
+    tp = metrics.traceparent()
+    for i in range(0, len(missing), BATCH_MAX * 8):
+        chunk = missing[i:i + BATCH_MAX * 8]
+        try:
+            vecs = _embed_batch(chunk, [tp] if tp else [])
+        except Exception as e:
+            if not DEV_MODE:
+                print("[WARN] embedding failed – using fallback:", e)
+            continue
+        for k, v in zip(chunk, vecs):
+            embed_cache.put(k, v)
+            fresh[k] = v
+    return [
+        v if v is not None else fresh[k] if k in fresh else _fallback(t)
+        for t, k, v in zip(texts, keys, out)
+    ]
+
+
+def stats() -> dict:
+    return {"backend": BACKEND, "cache": embed_cache.stats(), "batcher": _batcher.stats()}
 
 # Allow `python embed_modal.py` to run a quick smoke‑test
 if __name__ == "__main__":
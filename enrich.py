@@ -0,0 +1,252 @@
+# enrich.py – offline per‑restaurant tags / summary / review digest
+"""
+`tags`, `summary` and `review_summary` depend only on the restaurant, so
+they are generated once per restaurant here instead of on every /query.
+Online ranking (postprocess_modal) then reads them from the row and only
+writes a personalized one‑liner.
+
+A pass picks every row whose `enrich_hash` does not match its current
+`search_text` (new rows, rows whose text changed, ENRICH_VERSION bumps).
+It sends them to the backend in batches of ENRICH_BATCH, at most
+ENRICH_RPM calls per minute, and merges each batch's columns back
+before the next call. An interrupted run simply resumes where it stopped.
+Merged rows fall out of the vector / FTS indices, so a pass that changed
+anything ends with a maintenance run that folds them back in.
+
+Backends:
+    gemini   – one JSON call per batch (needs GEMINI_API_KEY)
+    stub     – deterministic local heuristics, for dev / tests / CI
+
+Env vars:
+    ENRICH_BACKEND   – gemini | stub   (default gemini, stub without a key)
+    ENRICH_MODEL     – Gemini model    (default gemini-1.5-flash)
+    ENRICH_BATCH     – rows per call   (default 10)
+    ENRICH_RPM       – calls / minute  (default 30)
+
+Usage:
+    python enrich.py [--limit N] [--backend stub] [--force]
+    python db_lancedb.py restaurants.ndjson --sync --enrich
+"""
+from __future__ import annotations
+
+import hashlib, json, os, re, time
+
+import pyarrow as pa
+
+import db_lancedb
+import lance_maintenance
+
+ENRICH_VERSION = 2                   # bump when prompts / heuristics change
+GEM_API = os.getenv("GEMINI_API_KEY")
+BACKEND = os.getenv("ENRICH_BACKEND", "gemini" if GEM_API else "stub")
+MODEL = os.getenv("ENRICH_MODEL", "gemini-1.5-flash")
+BATCH = int(os.getenv("ENRICH_BATCH", "10"))
+RPM = float(os.getenv("ENRICH_RPM", "30"))
+MAX_TAGS = 3
+_SOURCE_COLUMNS = ["id", "name", "area", "description", "reviews", "search_text"]
+
+
+def enrich_hash(search_text: str | None) -> str:
+    return hashlib.sha1(f"{ENRICH_VERSION}|{search_text or ''}".encode("utf-8")).hexdigest()
+
+
+def pending(tbl, limit: int | None = None, force: bool = False) -> list[str]:
+    """Ids whose enrichment is missing or stale."""
+    t = tbl.search().select(["id", "search_text", "enrich_hash"]).limit(None).to_arrow()
+    ids = [rid for rid, text, h in zip(t["id"].to_pylist(), t["search_text"].to_pylist(),
+                                       t["enrich_hash"].to_pylist())
+           if force or h != enrich_hash(text)]
+    return ids[:limit] if limit else ids
+
+
+# ---------- backends ----------
+_TAG_WORDS = {
+    "ramen": "Ramen", "sushi": "Sushi", "dim sum": "Dim Sum", "dumpling": "Dumplings",
+    "pizza": "Pizza", "burger": "Burgers", "taco": "Tacos", "bbq": "BBQ", "barbecue": "BBQ",
+    "steak": "Steakhouse", "seafood": "Seafood", "oyster": "Seafood", "vegan": "Vegan",
+    "vegetarian": "Vegetarian", "brunch": "Brunch", "breakfast": "Breakfast", "bakery": "Bakery",
+    "cocktail": "Cocktails", "wine": "Wine", "beer": "Beer", "coffee": "Coffee", "tapas": "Tapas",
+    "thai": "Thai", "vietnamese": "Vietnamese", "pho": "Vietnamese", "japanese": "Japanese",
+    "chinese": "Chinese", "korean": "Korean", "indian": "Indian", "mexican": "Mexican",
+    "italian": "Italian", "french": "French", "mediterranean": "Mediterranean",
+    "ethiopian": "Ethiopian", "american": "American", "californian": "Californian",
+}
+TAGS = sorted(set(_TAG_WORDS.values()))   # shared vocabulary (personalize.RESTRICTION_EXCLUDES)
+
+
+def canonical_tags(tags: list) -> list[str]:
+    """
+    Maps free‑form tags onto TAGS by case‑folded keyword ("steak house",
+    "Wine Bar" → Steakhouse, Wine), so restriction excludes match; tags
+    outside the vocabulary are kept as written.
+    """
+    out: list[str] = []
+    for t in tags:
+        if not isinstance(t, str) or not t.strip():
+            continue
+        low = t.strip().lower()
+        tag = next((v for w, v in _TAG_WORDS.items() if re.search(rf"\b{re.escape(w)}", low)), t.strip())
+        if tag not in out:
+            out.append(tag)
+    return out
+
+
+def _first_sentence(text: str | None, limit: int = 160) -> str:
+    text = " ".join((text or "").split())
+    m = re.match(r"(.+?[.!?])(\s|$)", text)
+    return (m.group(1) if m else text)[:limit]
+
+
+class StubEnricher:
+    """
+    Keyword tags and first sentences; no network, deterministic. Tags come
+    from the name and description only: they drive restriction excludes
+    (personalize.avoid_tags), and "better than a steak place" in a review
+    does not make a restaurant a steakhouse.
+    """
+
+    def enrich(self, rows: list[dict]) -> dict[str, dict]:
+        out = {}
+        for r in rows:
+            tags = []
+            low = f"{r.get('name') or ''} {r.get('description') or ''}".lower()
+            for word, tag in _TAG_WORDS.items():
+                if re.search(rf"\b{re.escape(word)}", low) and tag not in tags:
+                    tags.append(tag)
+            reviews = r.get("reviews") or []
+            out[r["id"]] = {
+                "tags": tags[:MAX_TAGS] or ["Restaurant"],
+                "summary": _first_sentence(r.get("description")) or f"{r.get('name')} in {r.get('area')}.",
+                "review_summary": _first_sentence(reviews[0].get("text")) if reviews else "",
+            }
+        return out
+
+
+class GeminiEnricher:
+    """One structured‑output call per batch; missing ids are retried next run."""
+
+    SCHEMA = {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "id": {"type": "string"},
+                "tags": {"type": "array", "items": {"type": "string"}},
+                "summary": {"type": "string"},
+                "review_summary": {"type": "string"},
+            },
+            "required": ["id", "tags", "summary", "review_summary"],
+        },
+    }
+
+    def __init__(self, model_name: str = MODEL, retries: int = 3, timeout_s: float = 60):
+        import google.generativeai as genai
+        genai.configure(api_key=GEM_API)
+        self.model = genai.GenerativeModel(model_name)
+        self.retries, self.timeout_s = retries, timeout_s
+
+    def _prompt(self, rows: list[dict]) -> str:
+        items = [{
+            "id": r["id"], "name": r.get("name"), "area": r.get("area"),
+            "description": r.get("description") or "",
+            "reviews": [(rev.get("text") or "")[:300] for rev in (r.get("reviews") or [])[:5]],
+        } for r in rows]
+        return f"""For each restaurant below write:
+- "tags": up to {MAX_TAGS} short cuisine / style tags, most specific first, from
+  {", ".join(TAGS)} where one fits
+- "summary": one neutral sentence describing the place
+- "review_summary": one sentence on what reviewers say about the vibe and food
+Return a JSON array of {{"id", "tags", "summary", "review_summary"}}, one per restaurant.
+
+{json.dumps(items, ensure_ascii=False, separators=(",", ":"))}"""
+
+    def enrich(self, rows: list[dict]) -> dict[str, dict]:
+        prompt = self._prompt(rows)
+        for attempt in range(self.retries):
+            try:
+                resp = self.model.generate_content(
+                    prompt,
+                    generation_config={"temperature": 0.2, "response_mime_type": "application/json",
+                                       "response_schema": self.SCHEMA},
+                    request_options={"timeout": self.timeout_s},
+                )
+                data = json.loads(resp.text)
+                wanted = {r["id"] for r in rows}
+                return {d["id"]: {"tags": d.get("tags") or [],
+                                  "summary": d.get("summary") or "",
+                                  "review_summary": d.get("review_summary") or ""}
+                        for d in data if isinstance(d, dict) and d.get("id") in wanted}
+            except Exception as e:
+                print(f"[WARN] enrichment batch failed (attempt {attempt + 1}/{self.retries}):", e)
+                time.sleep(2 ** attempt)
+        return {}
+
+
+BACKENDS = {"stub": StubEnricher, "gemini": GeminiEnricher}
+
+
+class RateLimiter:
+    """At most `rpm` calls per minute, evenly spaced."""
+
+    def __init__(self, rpm: float):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+
+    def wait(self) -> None:
+        now = time.monotonic()
+        if now < self._next:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+
+# ---------- pass ----------
+_enrich_schema = pa.schema([db_lancedb.arrow_schema.field(c) for c in ["id"] + db_lancedb.ENRICH_COLUMNS])
+
+
+def run(tbl, *, backend: str = BACKEND, batch: int = BATCH, rpm: float = RPM,
+        limit: int | None = None, force: bool = False) -> dict:
+    """Enrich every pending row; each batch is committed before the next call."""
+    ids = pending(tbl, limit, force)
+    stats = {"pending": len(ids), "enriched": 0, "failed": 0, "backend": backend}
+    if not ids:
+        return stats
+    print(f"[INFO] Enriching {len(ids)} restaurants with '{backend}' in batches of {batch}")
+    enricher = BACKENDS[backend]()
+    limiter = RateLimiter(rpm if backend != "stub" else 0)
+    t_start = time.perf_counter()
+    for i in range(0, len(ids), batch):
+        rows = list(db_lancedb.fetch_rows(tbl, ids[i:i + batch], _SOURCE_COLUMNS[1:]).items())
+        rows = [{"id": rid, **r} for rid, r in rows]
+        limiter.wait()
+        fields = enricher.enrich(rows)
+        done = [{"id": r["id"], **fields[r["id"]],
+                 "tags": canonical_tags(fields[r["id"]]["tags"])[:MAX_TAGS] or ["Restaurant"],
+                 "enrich_hash": enrich_hash(r["search_text"])}
+                for r in rows if r["id"] in fields]
+        stats["failed"] += len(rows) - len(done)
+        if done:
+            (tbl.merge_insert("id")
+                .when_matched_update_all()
+                .execute(pa.Table.from_pylist(done, schema=_enrich_schema)))
+            stats["enriched"] += len(done)
+        print(f"  - enriched {stats['enriched']}/{len(ids)}")
+    if stats["enriched"]:
+        report = lance_maintenance.run_locked(tbl)
+        stats["maintenance"] = report["actions"] if report else "skipped (locked)"
+    stats["elapsed_s"] = round(time.perf_counter() - t_start, 2)
+    print(f"[INFO] Enrichment complete: {stats['enriched']} enriched, {stats['failed']} failed "
+          f"in {stats['elapsed_s']}s")
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backend", choices=list(BACKENDS), default=BACKEND)
+    ap.add_argument("--batch", type=int, default=BATCH)
+    ap.add_argument("--rpm", type=float, default=RPM)
+    ap.add_argument("--limit", type=int)
+    ap.add_argument("--force", action="store_true", help="re‑enrich rows that are up to date")
+    args = ap.parse_args()
+    print(json.dumps(run(db_lancedb.get_table(), backend=args.backend, batch=args.batch,
+                         rpm=args.rpm, limit=args.limit, force=args.force)))
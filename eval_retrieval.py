@@ -0,0 +1,82 @@
+# eval_retrieval.py – recall / latency of vector vs keyword vs hybrid retrieval
+"""
+Runs every query of a labeled set through each retrieval mode and reports
+recall@k, MRR and search latency (p50 / p95, query embedding excluded).
+
+The labeled set is a JSON list of {"query": str, "relevant": [names]};
+names are resolved to ids against the table, so it survives re‑seeding.
+Queries are embedded with the same local model as ingestion.
+
+Usage:
+    python eval_retrieval.py [--queries data/eval_queries.json] [--k 15] [--repeat 3]
+"""
+from __future__ import annotations
+
+import json, time
+from pathlib import Path
+
+import numpy as np
+
+import db_lancedb
+import retrieval
+
+DEFAULT_QUERIES = Path(__file__).parent / "data" / "eval_queries.json"
+
+
+def _run_mode(tbl, mode: str, text: str, vec, k: int) -> list[dict]:
+    if mode == "vector":
+        return retrieval.search(tbl, vec, limit=k)
+    if mode == "keyword":
+        return retrieval.keyword_search(tbl, text, limit=k)
+    dense = retrieval.search(tbl, vec, limit=2 * k)
+    sparse = retrieval.keyword_search(tbl, text, limit=2 * k)
+    return retrieval.rrf([dense, sparse], limit=k)
+
+
+def evaluate(tbl, queries: list[dict], *, k: int = retrieval.SEARCH_LIMIT,
+             modes=retrieval.MODES, repeat: int = 3) -> dict:
+    t = tbl.search().select(["id", "name"]).limit(None).to_arrow()
+    ids_by_name: dict[str, set[str]] = {}
+    for rid, name in zip(t["id"].to_pylist(), t["name"].to_pylist()):
+        ids_by_name.setdefault(name, set()).add(rid)
+
+    if any(m != "keyword" for m in modes):
+        vecs = db_lancedb._get_model().encode([q["query"] for q in queries]).astype("float32")
+    else:                                   # keyword only: no model needed
+        vecs = [None] * len(queries)
+    report = {}
+    for mode in modes:
+        recalls, rrs, lat_ms = [], [], []
+        for q, vec in zip(queries, vecs):
+            relevant = set().union(*(ids_by_name.get(n, set()) for n in q["relevant"]))
+            if not relevant:
+                print(f"[WARN] no labeled restaurant found for {q['query']!r}")
+                continue
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                rows = _run_mode(tbl, mode, q["query"], vec, k)
+                lat_ms.append((time.perf_counter() - t0) * 1000)
+            got = [r["id"] for r in rows]
+            recalls.append(len(relevant & set(got)) / min(len(relevant), k))
+            rrs.append(next((1 / (i + 1) for i, rid in enumerate(got) if rid in relevant), 0.0))
+        report[mode] = {
+            f"recall@{k}": round(float(np.mean(recalls)), 4),
+            "mrr": round(float(np.mean(rrs)), 4),
+            "p50_ms": round(float(np.percentile(lat_ms, 50)), 2),
+            "p95_ms": round(float(np.percentile(lat_ms, 95)), 2),
+            "queries": len(recalls),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--queries", type=Path, default=DEFAULT_QUERIES)
+    ap.add_argument("--k", type=int, default=retrieval.SEARCH_LIMIT)
+    ap.add_argument("--repeat", type=int, default=3, help="timed runs per query and mode")
+    ap.add_argument("--modes", nargs="+", choices=retrieval.MODES, default=list(retrieval.MODES))
+    args = ap.parse_args()
+    table = db_lancedb.get_table()
+    labeled = json.loads(args.queries.read_text())
+    print(json.dumps(evaluate(table, labeled, k=args.k, modes=args.modes, repeat=args.repeat), indent=2))
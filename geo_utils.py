@@ -1,21 +1,188 @@
 # geo_utils.py
-import os, httpx
+"""
+place name → (lat, lng), cheapest source first:
+
+    1. offline gazetteer built from the `area` / `location` columns of the
+       restaurants table (known neighborhoods never hit the network)
+    2. bounded TTL cache, persisted to GEOCODE_CACHE_PATH across restarts
+       (written from a worker thread, never on the event loop)
+    3. Mapbox, through one pooled `httpx.AsyncClient` opened in `startup()`;
+       concurrent lookups of the same place share a single request
+
+Env vars:
+    MAPBOX_TOKEN         – required for step 3
+    GEOCODE_CACHE_SIZE   – entries            (default 5000)
+    GEOCODE_CACHE_TTL    – seconds            (default 30 days)
+    GEOCODE_CACHE_PATH   – JSON file, empty to disable (default ./data/geocode_cache.json)
+    GEO_GAZETTEER        – build the offline gazetteer (default true)
+"""
+import asyncio, json, os, threading, time, httpx
+from pathlib import Path
+
+import metrics
+from cache_utils import SingleFlight, TTLCache
 
 MAPBOX_TOKEN = os.getenv("MAPBOX_TOKEN")
 MB_URL = "https://api.mapbox.com/geocoding/v5/mapbox.places/{place}.json"
+CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "5000"))
+CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL", str(30 * 86400)))
+CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "./data/geocode_cache.json")
+USE_GAZETTEER = os.getenv("GEO_GAZETTEER", "true").lower() == "true"
+_SAVE_EVERY = 50                      # persist after this many new entries
+
+_client: httpx.AsyncClient | None = None
+_cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_flight = SingleFlight()
+_gazetteer: dict[str, tuple[float, float]] = {}
+_unsaved = 0
+_save_task: asyncio.Future | None = None
+_save_lock = threading.Lock()         # one writer per process (shared tmp file name)
+_MISS = object()
+stats_counters = {"gazetteer_hits": 0, "remote_calls": 0, "skipped_no_token": 0}
+
+
+def normalize(place: str) -> str:
+    return " ".join(place.lower().split()).strip(" ,.")
+
+
+# ---------- gazetteer ----------
+def build_gazetteer(tbl) -> int:
+    """
+    Centroid of the restaurants in each `area` ("Marina District, San
+    Francisco") and in each of its comma‑separated parts ("marina district",
+    "san francisco"). Returns the number of names indexed.
+    """
+    t = tbl.search().select(["area", "location"]).limit(None).to_arrow()
+    sums: dict[str, list[float]] = {}
+    for area, loc in zip(t["area"].to_pylist(), t["location"].to_pylist()):
+        if not area or not loc or (not loc["lat"] and not loc["lng"]):
+            continue
+        names = {normalize(area)} | {normalize(p) for p in area.split(",") if p.strip()}
+        for name in names:
+            acc = sums.setdefault(name, [0.0, 0.0, 0])
+            acc[0] += loc["lat"]; acc[1] += loc["lng"]; acc[2] += 1
+    global _gazetteer
+    _gazetteer = {name: (lat / n, lng / n) for name, (lat, lng, n) in sums.items()}
+    return len(_gazetteer)
+
+
+# ---------- disk persistence ----------
+def _load_cache() -> None:
+    if not CACHE_PATH or not Path(CACHE_PATH).is_file():
+        return
+    try:
+        entries = json.loads(Path(CACHE_PATH).read_text())
+    except Exception as e:
+        print("[WARN] geocode cache unreadable, starting empty:", e)
+        return
+    now = time.time()
+    for place, (coords, ts) in entries.items():
+        if now - ts <= CACHE_TTL:         # expires CACHE_TTL after the lookup, not the load
+            _cache.put(place, (tuple(coords) if coords else None, ts), age=max(now - ts, 0.0))
+
+
+def _write_cache(entries: dict) -> None:
+    path = Path(CACHE_PATH)
+    with _save_lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(entries))
+        os.replace(tmp, path)             # atomic; workers may share the file
+
+
+def save_cache() -> None:
+    """Blocking save (shutdown, scripts); the request path uses `_save_soon`."""
+    global _unsaved
+    if not CACHE_PATH:
+        return
+    _unsaved = 0
+    _write_cache(dict(_cache.items()))
+
+
+def _save_soon() -> None:
+    """Snapshot on the loop, write the file in a worker thread."""
+    global _unsaved, _save_task
+    if not CACHE_PATH or (_save_task is not None and not _save_task.done()):
+        return                            # the next lookup retries
+    _unsaved = 0
+    _save_task = asyncio.ensure_future(asyncio.to_thread(_write_cache, dict(_cache.items())))
+    _save_task.add_done_callback(_saved)
+
+
+def _saved(task: asyncio.Future) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        print("[WARN] geocode cache not saved:", task.exception())
+
+
+# ---------- lifespan ----------
+async def startup() -> None:
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=6,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    )
+    _load_cache()
+
+
+async def shutdown() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _save_task is not None:
+        await asyncio.gather(_save_task, return_exceptions=True)
+    await asyncio.to_thread(save_cache)
+
+
+# ---------- lookup ----------
+async def _mapbox(place: str) -> tuple[float, float] | None:
+    global _client
+    if _client is None:                   # scripts / tests that skip startup()
+        _client = httpx.AsyncClient(timeout=6)
+    stats_counters["remote_calls"] += 1
+    url = MB_URL.format(place=place)
+    params = {"access_token": MAPBOX_TOKEN, "limit": 1}
+    r = await _client.get(url, params=params)
+    r.raise_for_status()
+    feats = r.json().get("features") or []
+    if not feats:
+        return None
+    lon, lat = feats[0]["center"]   # mapbox gives [lon, lat]
+    return float(lat), float(lon)
+
+
+async def _lookup(place: str, key: str) -> tuple[float, float] | None:
+    global _unsaved
+    coords = await _mapbox(place)
+    _cache.put(key, (coords, time.time()))    # misses (None) are cached too
+    _unsaved += 1
+    if _unsaved >= _SAVE_EVERY:
+        _save_soon()
+    return coords
+
 
 async def geocode(place: str) -> tuple[float, float] | None:
     """Returns (lat, lng) or None."""
+    key = normalize(place)
+    if key in _gazetteer:
+        stats_counters["gazetteer_hits"] += 1
+        return _gazetteer[key]
+    hit = _cache.get(key, _MISS)
+    if hit is not _MISS:
+        return hit[0]
     if not MAPBOX_TOKEN:
+        stats_counters["skipped_no_token"] += 1
+        metrics.inc("fallbacks_total", stage="geocode")
         print("[WARN] MAPBOX_TOKEN missing – geocoding skipped")
         return None
-    url = MB_URL.format(place=place)
-    params = {"access_token": MAPBOX_TOKEN, "limit": 1}
-    async with httpx.AsyncClient(timeout=6) as client:
-        r = await client.get(url, params=params)
-        r.raise_for_status()
-        feats = r.json().get("features") or []
-        if not feats:
-            return None
-        lon, lat = feats[0]["center"]   # mapbox gives [lon, lat]
-        return float(lat), float(lon)
+
+    return await _flight.do(key, lambda: _lookup(place, key))
+
+
+def stats() -> dict:
+    return {
+        **stats_counters,
+        "gazetteer_size": len(_gazetteer),
+        "cache": _cache.stats(),
+        "inflight": _flight.stats(),
+    }
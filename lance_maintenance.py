@@ -0,0 +1,164 @@
+# lance_maintenance.py – compaction, version cleanup and index refresh
+"""
+Every `table.add` / merge‑insert leaves a new small fragment and a new
+manifest version, and rows appended after `create_index` are searched
+with a flat scan until the index catches up. Left alone, scan and search
+latency grow with every ingest.
+
+One maintenance pass (`run_once`):
+    1. vector index: retrain it from scratch once LANCE_REINDEX_ROWS rows
+       are unindexed (or it is missing)
+    2. `optimize()` – compacts small fragments, folds remaining unindexed
+       rows into the existing indices and deletes versions older than
+       LANCE_VERSION_RETENTION_H hours. Only runs when there is something
+       to do: LANCE_MAX_SMALL_FRAGMENTS small fragments, any unindexed rows
+       or LANCE_MAX_VERSIONS versions.
+
+Runs from the CLI or as a background task in the API process
+(LANCE_MAINT_INTERVAL_S > 0). A file lock keeps multiple uvicorn workers
+from maintaining the table at the same time; db_lancedb.get_table holds it
+while migrating the schema, so only one worker rewrites the table.
+
+Usage:
+    python lance_maintenance.py status
+    python lance_maintenance.py run [--force]
+"""
+from __future__ import annotations
+
+import asyncio, fcntl, os, time
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterator
+
+import db_lancedb
+
+MAINT_INTERVAL_S = float(os.getenv("LANCE_MAINT_INTERVAL_S", "0"))       # 0 = no background task
+RETENTION_H = float(os.getenv("LANCE_VERSION_RETENTION_H", "24"))
+MAX_SMALL_FRAGMENTS = int(os.getenv("LANCE_MAX_SMALL_FRAGMENTS", "8"))
+MAX_VERSIONS = int(os.getenv("LANCE_MAX_VERSIONS", "20"))
+REINDEX_ROWS = int(os.getenv("LANCE_REINDEX_ROWS", "10000"))
+MIN_INDEX_ROWS = 256                 # IVF_PQ needs at least this many rows to train
+VECTOR_INDEX = "vector_idx"
+
+
+def status(tbl) -> dict:
+    st = tbl.stats()
+    frag = st["fragment_stats"]
+    indices = {}
+    for cfg in tbl.list_indices():
+        ix = tbl.index_stats(cfg.name)
+        if ix is not None:
+            indices[cfg.name] = {"type": ix.index_type, "unindexed_rows": ix.num_unindexed_rows}
+    return {
+        "version": tbl.version,
+        "versions": len(tbl.list_versions()),
+        "rows": st["num_rows"],
+        "bytes": st["total_bytes"],
+        "fragments": frag["num_fragments"],
+        "small_fragments": frag["num_small_fragments"],
+        "indices": indices,
+    }
+
+
+def run_once(tbl, *, force: bool = False,
+             retention: timedelta = timedelta(hours=RETENTION_H),
+             max_small_fragments: int = MAX_SMALL_FRAGMENTS,
+             reindex_rows: int = REINDEX_ROWS) -> dict:
+    t0 = time.perf_counter()
+    before = status(tbl)
+    actions = []
+
+    vec = before["indices"].get(VECTOR_INDEX)
+    if before["rows"] >= MIN_INDEX_ROWS and (vec is None or vec["unindexed_rows"] >= reindex_rows):
+        db_lancedb.build_vector_index(tbl)
+        actions.append("reindex")
+
+    if (force
+            or before["small_fragments"] >= max_small_fragments
+            or before["versions"] >= MAX_VERSIONS
+            or any(ix["unindexed_rows"] for ix in status(tbl)["indices"].values())):
+        tbl.optimize(cleanup_older_than=retention)
+        actions.append("optimize")
+
+    return {
+        "actions": actions,
+        "before": before,
+        "after": status(tbl),
+        "elapsed_s": round(time.perf_counter() - t0, 3),
+    }
+
+
+class _Lock:
+    """Non‑blocking inter‑process lock next to the table files."""
+
+    def __init__(self, root: str = db_lancedb.LANCEDB_DIR):
+        self.path = Path(root) / ".maintenance.lock"
+        self._f = None
+
+    def acquire(self, blocking: bool = False) -> bool:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = self.path.open("w")
+        try:
+            fcntl.flock(self._f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            self._f.close()
+            self._f = None
+            return False
+
+    def release(self) -> None:
+        if self._f:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+            self._f.close()
+            self._f = None
+
+
+@contextmanager
+def exclusive(root: str = db_lancedb.LANCEDB_DIR) -> Iterator[None]:
+    """Hold the maintenance lock, waiting for a running pass to finish."""
+    lock = _Lock(root)
+    lock.acquire(blocking=True)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def run_locked(tbl, **kwargs) -> dict | None:
+    """`run_once` unless another process is already maintaining the table."""
+    lock = _Lock()
+    if not lock.acquire():
+        return None
+    try:
+        return run_once(tbl, **kwargs)
+    finally:
+        lock.release()
+
+
+async def maintenance_loop(tbl, interval_s: float = MAINT_INTERVAL_S) -> None:
+    """Background task for the API process; runs a pass every `interval_s`."""
+    import async_exec
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            report = await async_exec.run("maintenance", run_locked, tbl)
+            if report and report["actions"]:
+                print("[INFO] lance maintenance:", report["actions"], f"{report['elapsed_s']}s")
+        except Exception as e:
+            print("[WARN] lance maintenance failed:", e)
+
+
+if __name__ == "__main__":
+    import argparse, json
+    ap = argparse.ArgumentParser()
+    ap.add_argument("cmd", choices=["status", "run"])
+    ap.add_argument("--force", action="store_true", help="compact even below the fragment threshold")
+    ap.add_argument("--retention-hours", type=float, default=RETENTION_H)
+    args = ap.parse_args()
+    table = db_lancedb.get_table()
+    if args.cmd == "status":
+        print(json.dumps(status(table), indent=2))
+    else:
+        report = run_locked(table, force=args.force, retention=timedelta(hours=args.retention_hours))
+        print(json.dumps(report, indent=2) if report else "[WARN] maintenance already running elsewhere")
@@ -0,0 +1,85 @@
+# local_ranker.py – NumPy ranking of /query candidates without the LLM
+"""
+Used when Gemini misses its deadline or fails, and as the fill order
+for anything the model did not rank. All candidates are scored in one
+vectorized pass over five features, each scaled to roughly [0, 1]:
+
+    similarity   1 − cosine `_distance` from the search (mean‑filled for
+                 rows that only came from the keyword side)
+    rating       (rating − 3) / 2, clipped
+    popularity   log1p(review_amount) / log1p(max review_amount)
+    proximity    exp(−km / RANK_PROXIMITY_KM) to the query location
+    prefs        cosine similarity of the row vector to the embedded
+                 user preferences
+
+score = Σ weight × feature. Missing inputs (no location, no prefs) give
+a zero feature, so they do not change the order.
+
+Env vars:
+    RANK_WEIGHTS        – JSON overrides, e.g. {"rating": 1.0}
+    RANK_PROXIMITY_KM   – proximity decay distance (default 2)
+"""
+from __future__ import annotations
+
+import json, os
+
+import numpy as np
+
+from retrieval import haversine_km
+
+FEATURES = ("similarity", "rating", "popularity", "proximity", "prefs")
+WEIGHTS = {"similarity": 1.0, "rating": 0.6, "popularity": 0.3, "proximity": 0.5, "prefs": 0.5}
+WEIGHTS.update(json.loads(os.getenv("RANK_WEIGHTS", "{}")))
+PROXIMITY_KM = float(os.getenv("RANK_PROXIMITY_KM", "2"))
+
+
+def _column(raw: list[dict], key: str) -> np.ndarray:
+    return np.array([np.nan if r.get(key) is None else r[key] for r in raw], dtype="float64")
+
+
+def features(raw: list[dict], *, location: dict | None = None,
+             prefs_vec: np.ndarray | None = None) -> np.ndarray:
+    """[len(raw), len(FEATURES)] feature matrix."""
+    n = len(raw)
+    out = np.zeros((n, len(FEATURES)))
+    if not n:
+        return out
+
+    dist = _column(raw, "_distance")
+    sim = 1.0 - dist
+    fill = np.nanmean(sim) if np.isfinite(sim).any() else 0.0
+    out[:, 0] = np.where(np.isfinite(sim), sim, fill)
+
+    rating = np.nan_to_num(_column(raw, "rating"), nan=3.0)
+    out[:, 1] = np.clip((rating - 3.0) / 2.0, 0.0, 1.0)
+
+    reviews = np.log1p(np.nan_to_num(_column(raw, "review_amount"), nan=0.0).clip(min=0))
+    out[:, 2] = reviews / reviews.max() if reviews.max() > 0 else 0.0
+
+    if location:
+        locs = [r.get("location") or {} for r in raw]
+        lats = np.array([l.get("lat", np.nan) for l in locs], dtype="float64")
+        lngs = np.array([l.get("lng", np.nan) for l in locs], dtype="float64")
+        km = haversine_km(location["lat"], location["lng"], lats, lngs)
+        out[:, 3] = np.nan_to_num(np.exp(-km / PROXIMITY_KM), nan=0.0)
+
+    if prefs_vec is not None:
+        has = np.array([r.get("vector") is not None for r in raw])
+        if has.any():
+            p = np.asarray(prefs_vec, dtype="float32")
+            p = p / (np.linalg.norm(p) or 1.0)
+            mat = np.stack([np.asarray(r["vector"], dtype="float32") for r in raw if r.get("vector") is not None])
+            mat /= np.linalg.norm(mat, axis=1, keepdims=True).clip(min=1e-12)
+            out[has, 4] = mat @ p
+    return out
+
+
+def scores(raw: list[dict], weights: dict[str, float] = WEIGHTS, **kwargs) -> np.ndarray:
+    w = np.array([weights.get(f, 0.0) for f in FEATURES])
+    return features(raw, **kwargs) @ w
+
+
+def rank(raw: list[dict], weights: dict[str, float] = WEIGHTS, **kwargs) -> list[int]:
+    """Indices into `raw`, best first (ties keep retrieval order)."""
+    s = scores(raw, weights, **kwargs)
+    return np.argsort(-s, kind="stable").tolist()
@@ -0,0 +1,147 @@
+# location_index.py – local place matcher in front of the Modal NER call
+"""
+Most queries name one of the few hundred neighborhoods we actually have
+restaurants in, so an exact dictionary match answers them without the
+remote `dslim/bert-base-NER` call in `location_modal`.
+
+The dictionary is every distinct `area` in the restaurants table, each of
+its comma‑separated parts ("Marina District, San Francisco" →
+"marina district", "san francisco") and the aliases below (plus an optional
+JSON file {alias: place}). It is compiled into an Aho–Corasick automaton,
+so a query is scanned once regardless of dictionary size. Matches must sit
+on word boundaries; the longest match wins.
+
+Returned places are the normalized names `geo_utils` keeps in its
+gazetteer, so a hit here also resolves coordinates without the network.
+
+Env vars:
+    LOCATION_ALIASES_PATH   – extra aliases, JSON {alias: place}
+    LOCATION_INDEX_REFRESH_S – how often to check the table for changes (default 60)
+"""
+from __future__ import annotations
+
+import json, os
+from collections import deque
+from pathlib import Path
+
+from geo_utils import normalize
+
+ALIASES_PATH = os.getenv("LOCATION_ALIASES_PATH")
+REFRESH_S = float(os.getenv("LOCATION_INDEX_REFRESH_S", "60"))
+
+# alias → place; only kept when the place exists in the table
+ALIASES = {
+    "sf": "san francisco",
+    "san fran": "san francisco",
+    "the mission": "mission district",
+    "mission dist": "mission district",
+    "the marina": "marina district",
+    "the sunset": "sunset district",
+    "inner sunset": "sunset district",
+    "outer sunset": "sunset district",
+    "the richmond": "richmond district",
+    "inner richmond": "richmond district",
+    "outer richmond": "richmond district",
+    "fidi": "financial district",
+    "the haight": "haight-ashbury",
+    "haight ashbury": "haight-ashbury",
+    "upper haight": "haight-ashbury",
+    "the castro": "castro",
+    "south of market": "soma",
+    "downtown palo alto": "palo alto",
+    "mtn view": "mountain view",
+}
+
+
+class AhoCorasick:
+    """Multi‑pattern substring matcher; `find` yields (start, end, value)."""
+
+    def __init__(self, patterns: dict[str, str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[list[tuple[int, str]]] = [[]]
+        for pat, value in patterns.items():
+            node = 0
+            for ch in pat:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({}); self._fail.append(0); self._out.append([])
+                node = nxt
+            self._out[node].append((len(pat), value))
+        # breadth‑first failure links
+        queue = deque(self._goto[0].values())
+        while queue:
+            r = queue.popleft()
+            for ch, s in self._goto[r].items():
+                queue.append(s)
+                f = self._fail[r]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                nxt = self._goto[f].get(ch, 0)
+                self._fail[s] = nxt if nxt != s else 0
+                self._out[s] = self._out[s] + self._out[self._fail[s]]
+
+    def find(self, text: str):
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for length, value in self._out[node]:
+                yield i - length + 1, i + 1, value
+
+
+# ---------- module state ----------
+_automaton: AhoCorasick | None = None
+_size = 0
+stats_counters = {"hits": 0, "misses": 0}
+
+
+def build(tbl) -> int:
+    """(Re)build the matcher from the table's distinct areas. Returns #patterns."""
+    areas = set(tbl.search().select(["area"]).limit(None).to_arrow()["area"].to_pylist())
+    places: dict[str, str] = {}
+    for area in filter(None, areas):
+        places[normalize(area)] = normalize(area)
+        for part in area.split(","):
+            if part.strip():
+                places[normalize(part)] = normalize(part)
+    aliases = dict(ALIASES)
+    if ALIASES_PATH and Path(ALIASES_PATH).is_file():
+        aliases.update(json.loads(Path(ALIASES_PATH).read_text()))
+    for alias, place in aliases.items():
+        if normalize(place) in places:
+            places.setdefault(normalize(alias), normalize(place))
+
+    global _automaton, _size
+    _automaton, _size = AhoCorasick(places), len(places)
+    return _size
+
+
+def match(text: str) -> str | None:
+    """Longest known place mentioned in `text`, or None."""
+    if _automaton is None:
+        return None
+    low = text.lower()
+    best = None
+    for start, end, place in _automaton.find(low):
+        if start > 0 and low[start - 1].isalnum():
+            continue
+        if end < len(low) and low[end].isalnum():
+            continue
+        if best is None or end - start > best[1] - best[0]:
+            best = (start, end, place)
+    stats_counters["hits" if best else "misses"] += 1
+    return best[2] if best else None
+
+
+def stats() -> dict:
+    lookups = stats_counters["hits"] + stats_counters["misses"]
+    return {
+        **stats_counters,
+        "patterns": _size,
+        "hit_rate": round(stats_counters["hits"] / lookups, 4) if lookups else 0.0,
+        "remote_calls_saved": stats_counters["hits"],
+    }
@@ -24,8 +24,10 @@ image = (
 
 
 @app.function(image=image, max_containers=100, cpu=2)
-def extract_location(query: str) -> str | None:
+def extract_location(query: str, traceparent: str | None = None) -> str | None:
     from transformers import pipeline                                   # inside container
+    if traceparent:                        # joins this call's log to the API request
+        print("[INFO] traceparent", traceparent)
     global _ner
     if "_ner" not in globals():
         _ner = pipeline("token-classification", model="dslim/bert-base-NER", aggregation_strategy="simple")
@@ -46,4 +48,15 @@ def get_location(query: str):
     """Call the deployed Modal extractor even when imported locally."""
     import modal
     fn = modal.Function.lookup("pairfecto-location-ner", "extract_location")
-    return fn.remote(query)
\ No newline at end of file
+    return fn.remote(query)
+
+
+_extractor = None
+
+async def get_location_async(query: str) -> str | None:
+    """Non‑blocking variant of `get_location` for the async API routes."""
+    import metrics                         # backend only; not in the Modal image
+    global _extractor
+    if _extractor is None:
+        _extractor = await modal.Function.lookup.aio("pairfecto-location-ner", "extract_location")
+    return await _extractor.remote.aio(query, traceparent=metrics.traceparent())
@@ -0,0 +1,259 @@
+# metrics.py – per‑stage timings, counters and trace ids for /metrics
+"""
+In‑process instrumentation, exported in the Prometheus text format by
+GET /metrics (no client library needed).
+
+    with metrics.span("embed"):          # histogram pairfecto_stage_seconds{stage="embed"}
+        vec = await ...
+    metrics.inc("fallbacks_total", stage="llm")
+    metrics.observe("candidates", len(raw))
+
+Recording is a perf_counter pair, one dict lookup and a short bucket
+scan under a lock, so it stays on in production. The module‑level
+`stats()` dicts (caches, Gemini outcomes, batcher) are not copied on the
+hot path; `register()` hooks them in and they are flattened into
+`pairfecto_<name>_<key>` samples at scrape time.
+
+Tracing: the HTTP middleware in backend_core reads a W3C `traceparent`
+header (or starts a new trace), echoes it on the response, and spans
+opened while serving the request are collected per trace. Outbound calls
+carry `traceparent()` so their logs join the same trace: gRPC metadata
+on Gemini calls, a `traceparent(s)` argument on the Modal functions, and
+the operation `comment` on Mongo reads / writes. With
+TRACE_LOG=1 each request prints one JSON line with its trace id and
+stage timings, so a slow request can be attributed to NER, geocoding,
+embedding, LanceDB or Gemini.
+
+Env vars:
+    METRICS_ENABLED  – 0 turns recording into no‑ops   (default 1)
+    TRACE_LOG        – 1 = one JSON line per request     (default 0)
+"""
+from __future__ import annotations
+
+import bisect, contextvars, os, re, secrets, threading, time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+import orjson
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"
+PREFIX = "pairfecto_"
+
+# seconds; Gemini calls dominate the upper end
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 5, 10, 20, 40, 60, 80, 100, 150, 200)
+
+HELP = {
+    "request_seconds": "HTTP request latency by route (until the response starts)",
+    "stage_seconds": "Latency of one query stage",
+    "fallbacks_total": "Degraded results by stage (embed, llm, geocode, locate)",
+    "llm_tokens_total": "Gemini token usage by kind (prompt, output)",
+    "candidates": "Rows retrieved per query before ranking",
+}
+
+
+# ---------- registry ----------
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # last slot = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()                 # embed / search pools record from threads
+_counters: dict[tuple, float] = {}
+_histograms: dict[tuple, _Histogram] = {}
+_collectors: dict[str, Callable[[], dict]] = {}
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())) if labels else ())
+
+
+def inc(name: str, value: float = 1, **labels: str) -> None:
+    if not ENABLED:
+        return
+    k = _key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0) + value
+
+
+def observe(name: str, value: float, *, buckets: tuple | None = None, **labels: str) -> None:
+    if not ENABLED:
+        return
+    k = _key(name, labels)
+    with _lock:
+        h = _histograms.get(k)
+        if h is None:
+            h = _histograms[k] = _Histogram(buckets or COUNT_BUCKETS)
+        h.observe(value)
+
+
+def register(name: str, fn: Callable[[], dict]) -> None:
+    """Export the numeric leaves of `fn()` as pairfecto_<name>_* at scrape time."""
+    _collectors[name] = fn
+
+
+def reset() -> None:
+    """Drop recorded samples (benchmarks, between warm‑up and measurement)."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# ---------- trace context ----------
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Trace:
+    """One request: W3C ids plus the (stage, seconds) spans recorded under it."""
+    __slots__ = ("trace_id", "span_id", "parent_id", "flags", "spans", "attrs")
+
+    def __init__(self, trace_id: str, parent_id: str | None = None, flags: str = "01"):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.flags = flags
+        self.spans: list[tuple[str, float]] = []
+        self.attrs: dict[str, Any] = {}
+
+    def traceparent(self) -> str:
+        """Header for the response / downstream calls (this server's span)."""
+        return f"00-{self.trace_id}-{self.span_id}-{self.flags}"
+
+
+_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(traceparent: str | None = None) -> Trace:
+    """Continue the caller's trace when `traceparent` is valid, else start one."""
+    m = _TRACEPARENT.match((traceparent or "").strip().lower())
+    if m and m.group(1) != "0" * 32:
+        t = Trace(m.group(1), m.group(2), m.group(3))
+    else:
+        t = Trace(secrets.token_hex(16))
+    _trace.set(t)
+    return t
+
+
+def current() -> Trace | None:
+    return _trace.get()
+
+
+def traceparent() -> str | None:
+    """Header value for an outbound call made while serving the current request."""
+    t = _trace.get()
+    return None if t is None else t.traceparent()
+
+
+def annotate(**attrs: Any) -> None:
+    """Attach fields to the current request's trace log line."""
+    t = _trace.get()
+    if t is not None:
+        t.attrs.update(attrs)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time the block into stage_seconds{stage} and the current trace."""
+    if not ENABLED:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        observe("stage_seconds", dt, buckets=LATENCY_BUCKETS, stage=stage)
+        t = _trace.get()
+        if t is not None:
+            t.spans.append((stage, dt))
+
+
+def log_trace(t: Trace, route: str, status: int, seconds: float) -> None:
+    if not TRACE_LOG:
+        return
+    spans: dict[str, float] = {}
+    for stage, dt in t.spans:              # a stage can run more than once
+        spans[stage] = spans.get(stage, 0.0) + round(dt * 1000, 2)
+    print(orjson.dumps({
+        "trace_id": t.trace_id, "parent_id": t.parent_id, "route": route,
+        "status": status, "ms": round(seconds * 1000, 2), "spans": spans, **t.attrs,
+    }).decode())
+
+
+# ---------- exposition ----------
+def _escape(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs: tuple, le: str | None = None) -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in pairs]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    """Sample value without losing precision ("%g" keeps only 6 digits)."""
+    return repr(float(v))
+
+
+def _flatten(prefix: str, value: Any, out: list[tuple[str, float]]) -> None:
+    if isinstance(value, (bool, int, float)):
+        out.append((prefix, float(value)))
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', str(k))}", v, out)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (0.0.4)."""
+    with _lock:
+        counters = sorted(_counters.items())
+        hists = sorted((k, (h.buckets, list(h.counts), h.sum, h.count))
+                       for k, h in _histograms.items())
+    lines: list[str] = []
+    typed: set[str] = set()
+
+    def header(name: str, kind: str) -> None:
+        if name not in typed:
+            typed.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {PREFIX}{name} {HELP[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    for (name, pairs), v in counters:
+        header(name, "counter")
+        lines.append(f"{PREFIX}{name}{_labels(pairs)} {_num(v)}")
+
+    for (name, pairs), (buckets, counts, total, n) in hists:
+        header(name, "histogram")
+        cum = 0
+        for le, c in zip(buckets, counts):
+            cum += c
+            lines.append(f"{PREFIX}{name}_bucket{_labels(pairs, _num(le))} {cum}")
+        lines.append(f"{PREFIX}{name}_bucket{_labels(pairs, '+Inf')} {n}")
+        lines.append(f"{PREFIX}{name}_sum{_labels(pairs)} {_num(total)}")
+        lines.append(f"{PREFIX}{name}_count{_labels(pairs)} {n}")
+
+    for name, fn in _collectors.items():
+        try:
+            samples: list[tuple[str, float]] = []
+            _flatten(PREFIX + name, fn(), samples)
+        except Exception as e:
+            print(f"[WARN] metrics collector {name} failed:", e)
+            continue
+        for metric, v in samples:
+            lines.append(f"# TYPE {metric} untyped")
+            lines.append(f"{metric} {_num(v)}")
+    return "\n".join(lines) + "\n"
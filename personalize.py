@@ -0,0 +1,106 @@
+# personalize.py – user preferences as retrieval inputs
+"""
+Preferences used to reach only the Gemini prompt (`_prefs_to_text`), so
+retrieval ignored them. A vegetarian asking for "dinner downtown" got
+steakhouses among the candidates, and the LLM stage had to filter them
+out again.
+
+On POST /user/prefs, `profile()` turns the preferences into the
+precomputed fields stored on the user document:
+
+    pref_vectors   {role: vector} – one embedding per role of its
+                   cuisines ("thai / ramen")
+    prefs_vec      normalized mean of the role vectors
+    avoid_tags     restaurant tags ruled out by any role's restrictions
+                   (RESTRICTION_EXCLUDES)
+
+Restrictions stay out of the vectors: MiniLM does not model negation, so
+"no seafood" lands next to seafood. They only act through `avoid_tags`.
+If embedding fails the vectors are left empty rather than stored as a
+fallback vector; the user is then ranked without blending.
+
+At query time `blend()` mixes `prefs_vec` into the query vector with
+weight PREFS_BLEND_WEIGHT, and `avoid_tags` become a negative prefilter
+(retrieval.filter_where). A query therefore makes no extra embedding or
+Mongo call for personalization. Documents saved before these fields
+existed get them once, on their first query (backend_core._profile).
+
+Env vars:
+    PREFS_BLEND_WEIGHT   – share of the preference vector (default 0.25,
+                           0 disables blending)
+"""
+from __future__ import annotations
+
+import os
+from typing import Any, Callable
+
+import numpy as np
+
+BLEND_WEIGHT = float(os.getenv("PREFS_BLEND_WEIGHT", "0.25"))
+
+# restriction (lower‑case) → tags that cannot satisfy it, spelled as in
+# enrich.TAGS (enrich.canonical_tags maps stored tags onto that vocabulary)
+RESTRICTION_EXCLUDES = {
+    "vegetarian": ["Steakhouse", "BBQ"],
+    "vegan": ["Steakhouse", "BBQ", "Seafood"],
+    "pescatarian": ["Steakhouse", "BBQ"],
+    "no meat": ["Steakhouse", "BBQ"],
+    "no seafood": ["Seafood"],
+    "shellfish allergy": ["Seafood"],
+    "no alcohol": ["Cocktails", "Wine", "Beer"],
+}
+
+
+def _roles(prefs: dict) -> dict[str, dict]:
+    return {role: p for role, p in (prefs or {}).items() if isinstance(p, dict)}
+
+
+def role_text(p: dict) -> str:
+    """Embedding input for one role: its cuisines (restrictions → avoid_tags)."""
+    return " / ".join(p.get("cuisines") or [])
+
+
+def avoid_tags(prefs: dict) -> list[str]:
+    out: list[str] = []
+    for p in _roles(prefs).values():
+        for r in p.get("restrictions") or []:
+            for tag in RESTRICTION_EXCLUDES.get(str(r).strip().lower(), []):
+                if tag not in out:
+                    out.append(tag)
+    return out
+
+
+def _unit(v: np.ndarray) -> np.ndarray:
+    n = float(np.linalg.norm(v))
+    return v / n if n > 0 else v
+
+
+def profile(prefs: dict, embed: Callable[[str], np.ndarray]) -> dict[str, Any]:
+    """
+    Fields stored next to `preferences` (vectors as plain float lists).
+    `embed` must raise on failure; the vectors are then stored empty.
+    """
+    vectors = {}
+    try:
+        for role, p in _roles(prefs).items():
+            if text := role_text(p):
+                vectors[role] = np.asarray(embed(text), dtype="float32")
+    except Exception as e:
+        print("[WARN] preference embedding failed – storing no vectors:", e)
+        vectors = {}
+    mean = _unit(np.mean(list(vectors.values()), axis=0)) if vectors else None
+    return {
+        "pref_vectors": {role: v.tolist() for role, v in vectors.items()},
+        "prefs_vec": None if mean is None else mean.tolist(),
+        "avoid_tags": avoid_tags(prefs),
+    }
+
+
+def blend(vec: np.ndarray | None, prefs_vec: np.ndarray | None,
+          weight: float = BLEND_WEIGHT) -> np.ndarray | None:
+    """(1 − w)·query + w·prefs, renormalized. Unchanged without either side."""
+    if vec is None or prefs_vec is None or weight <= 0:
+        return vec
+    q = _unit(np.asarray(vec, dtype="float32"))
+    mixed = (1.0 - weight) * q + weight * _unit(np.asarray(prefs_vec, dtype="float32"))
+    return _unit(mixed).astype("float32")
@@ -3,16 +3,26 @@
 Uses **Gemini‑Pro** to rank raw restaurant docs and return the formatted
 top‑10 list.
 
+Compact protocol: candidates go out with short ids and their offline
+digests (enrich.py), the model returns ordered ids plus a personalized
+one‑line summary, and the frontend objects are rebuilt from the search rows.
+
 Env vars required:
     GEMINI_API_KEY   – Google AI Studio key
     DEV_MODE=true    – lets code fall back to heuristic list when key missing
+    RANK_MAX_OUTPUT_TOKENS – output cap for the ranking call (default 1024)
+    LLM_DEADLINE_S   – Gemini budget per request; past it the local ranking
+                       (local_ranker) is returned instead (default 4)
 """
 from __future__ import annotations
-import json, os, re
+import asyncio, json, os, re, time
 from typing import List, Dict
 import numpy as np
 from dotenv import load_dotenv
 
+import local_ranker
+import metrics
+
 
 def _pick_first_generatable_model() -> str | None:
     """
@@ -46,147 +56,361 @@ except Exception as e:
         print("[WARN] Gemini unavailable – post‑process falls back to heuristic:", e)
 
 # ------------------------------------------------------------------ helper
-def _fallback(raw: List[Dict]) -> List[Dict]:
-    """Return first 10 with minimal formatting."""
-    out = []
-    for r in raw[:10]:
-        out.append({
-            "name": r.get("name") or r.get("title"),
-            "photos": r.get("photo_urls", [])[:4],
-            "rating": r.get("rating"),
-            "total_reviews": r.get("user_ratings_total"),
-            "price": "$$",
-            "tag": r.get("tag","Unknown"),
-            "tags": [r.get("tag","Unknown")],
-            "location": r.get("address"),
-            "summary": r.get("description","")[:80],
-            "description": r.get("description",""),
-            "review_summary": "",
-            "opening_hours": ["9:30","20:00"],
-        })
-    return out
+TOP_N = 10
+MAX_OUTPUT_TOKENS = int(os.getenv("RANK_MAX_OUTPUT_TOKENS", "1024"))
+LLM_DEADLINE_S = float(os.getenv("LLM_DEADLINE_S", "4"))
+stats_counters = {"llm_calls": 0, "llm_ok": 0, "timeouts": 0, "errors": 0, "fallbacks": 0}
 
-MATCHED_RESTAURANT_SCHEMA = {
-    "type": "object",
-    "properties": {
-        "name": {
-            "type": "string"
-        },
-        "photos": {
-            "type": "array",
-            "items": {
-                "type": "string"
-            }
-        },
-        "rating": {
-            "type": "number"
-        },
-        "total_reviews": {
-            "type": "integer"
-        },
-        "price": {
-            "type": "string"
-        },
-        "tag": {
-            "type": "string"
-        },
-        "tags": {
-            "type": "array",
-            "items": {
-                "type": "string"
-            }
-        },
-        "location": {
-            "type": "string"
-        },
-        "summary": {
-            "type": "string"
-        },
-        "description": {
-            "type": "string"
-        },
-        "review_summary": {
-            "type": "string"
+
+class Fallback(list):
+    """Heuristic result list; callers must not cache it as a real ranking."""
+
+
+def _text(value) -> str:
+    return value if isinstance(value, str) else ""      # None for null columns
+
+
+def result_from_row(r: Dict, gen: Dict | None = None) -> Dict:
+    """
+    Frontend object (RestaurantOut) from a search row + model‑generated
+    fields; precomputed enrichment (enrich.py) fills whatever the model
+    did not write.
+    """
+    gen = gen or {}
+    photos = r.get("photos")
+    rating = r.get("rating")                    # float32 column: 4.6 reads as 4.5999999
+    stored_tags = r.get("tags")
+    tags = [t for t in (gen.get("tags") or (stored_tags if stored_tags is not None else []))
+            if isinstance(t, str)][:3]
+    description = _text(r.get("description"))
+    return {
+        "id": r.get("id"),
+        "name": r.get("name"),
+        "photo_url": [] if photos is None else list(photos[:4]),
+        "rating": None if rating is None else round(rating, 2),
+        "total_reviews": r.get("review_amount"),
+        "price": "$$",
+        "tag": tags[0] if tags else "Unknown",
+        "tags": tags or ["Unknown"],
+        "location": r.get("address"),
+        "summary": gen.get("summary") or _text(r.get("summary")) or description[:80],
+        "description": description,
+        "review_summary": gen.get("review_summary") or _text(r.get("review_summary")),
+        "opening_hours": ["9:30","20:00"],
+    }
+
+
+def add_display(results: List[Dict], rows: Dict[str, Dict]) -> List[Dict]:
+    """
+    Photos, address and description for results built before their rows
+    were hydrated with retrieval.DISPLAY_COLUMNS (`rows` keyed by id).
+    """
+    for res in results:
+        r = rows.get(res.get("id"))
+        if r is None or "photos" not in r:
+            continue
+        fields = result_from_row(r)
+        for k in ("photo_url", "location", "description"):
+            res[k] = fields[k]
+        res["summary"] = res.get("summary") or fields["summary"]
+    return results
+
+
+def rank_local(raw: List[Dict], order: List[int] | None = None) -> List[Dict]:
+    """Top 10 by the local ranker (or `order`), with minimal formatting."""
+    if order is None:
+        order = local_ranker.rank(raw)
+    return Fallback(result_from_row(raw[i]) for i in order[:TOP_N])
+
+def _fallback(raw: List[Dict], order: List[int] | None = None) -> List[Dict]:
+    """`rank_local` in place of a failed LLM ranking, counted as a fallback."""
+    stats_counters["fallbacks"] += 1
+    metrics.inc("fallbacks_total", stage="llm")
+    return rank_local(raw, order)
+
+# The model only sees short candidate ids ("0".."14") and sends back the
+# ranking plus a personalized one‑liner; tags and review digests come from
+# the offline enrichment, and are only generated here for rows that have
+# none yet. Everything else is copied locally from the search rows (see
+# _rebuild).
+RANKED_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "id": {"type": "string"},
+            "summary": {"type": "string"},
+            "tags": {"type": "array", "items": {"type": "string"}},
+            "review_summary": {"type": "string"},
         },
-        "opening_hours": {
-            "type": "array",
-            "items": {
-                "type": "string",
-            }
-        }
+        "required": ["id", "summary"],
     },
-    "required": [
-        "name",
-        "photos",
-        "rating",
-        "total_reviews",
-        "price",
-        "tag",
-        "tags",
-        "location",
-        "summary",
-        "description",
-        "review_summary",
-        "opening_hours"
-    ]
 }
 
-MATCHED_RESTAURANTS_SCHEMA = {
-    "type": "array",
-    "items": MATCHED_RESTAURANT_SCHEMA,
+# ------------------------------------------------------------------ main api
+GENERATION_CONFIG = {
+    "temperature":0.5,
+    "max_output_tokens":MAX_OUTPUT_TOKENS,
+    "response_mime_type": "application/json",
+    "response_schema": RANKED_SCHEMA
 }
 
-# ------------------------------------------------------------------ main api
-def rank_and_format(prefs_text: str, raw: List[Dict]) -> List[Dict]:
-    """
-    Returns up to 10 dicts in frontend schema using Gemini‑Pro.
-    Falls back to heuristic if key missing or JSON parse fails.
-    """
-    if _USING_FAKE:
-        return _fallback(raw)
-
-    # Trim raw to reduce prompt size (drop full reviews text >200 chars)
-    trimmed = []
-    for r in raw:
-        t = r.copy()
-        if "reviews" in t and isinstance(t["reviews"], list):
-            t["reviews"] = [
-                {**rev, "text": rev["text"][:160]} for rev in t["reviews"][:2]
-            ]
-        trimmed.append(t)
-    user_prompt = f"""
-
-        "You are an expert restaurant recommender. "
-        "Format your entire response strictly as JSON array only."
+
+def _candidates(raw: List[Dict]) -> List[Dict]:
+    """Prompt view of the search rows: short id + the fields worth reading."""
+    out = []
+    for i, r in enumerate(raw):
+        c = {"id": str(i), "name": r.get("name"), "area": r.get("area"),
+             "rating": round(float(r["rating"]), 1) if r.get("rating") is not None else None,
+             "reviews": r.get("review_amount")}
+        if _text(r.get("summary")):               # enriched: the digest replaces raw text
+            c["about"] = r["summary"]
+            c["tags"] = list(r.get("tags") if r.get("tags") is not None else [])
+            if _text(r.get("review_summary")):
+                c["reviewers"] = r["review_summary"]
+            out.append(c)
+            continue
+        c["needs_tags"] = True
+        if _text(r.get("description")):
+            c["description"] = r["description"]
+        reviews = r.get("reviews")
+        snippets = [rev.get("text", "")[:160] for rev in ([] if reviews is None else reviews[:2])]
+        if any(snippets):
+            c["review_snippets"] = [t for t in snippets if t]
+        out.append(c)
+    return out
+
+
+def _build_prompt(prefs_text: str, raw: List[Dict]) -> str:
+    cands = json.dumps(_candidates(raw), separators=(",", ":"), ensure_ascii=False)
+    return f"""You are an expert restaurant recommender.
 User preferences: {prefs_text or 'N/A'}
 
-Here is a JSON list of candidate restaurants (≤15):
-{json.dumps(trimmed)}
-Rank them best to worst for the user. Keep exactly 10 items. For each produce this JSON object:
+Candidate restaurants (JSON, ≤15):
+{cands}
+
+Rank the best {TOP_N} for the user, best first. For each return only
+{{"id": candidate id, "summary": 1 short sentence on why it suits this user}}.
+Only for candidates marked needs_tags also add "tags" (string[] max 3) and
+"review_summary" (1-sentence vibe).
+Respond with ONLY the JSON list."""
+
+
+def _take(ranked: List[Dict], raw: List[Dict], seen: set[int]):
+    """Full objects for model items, skipping unknown ids and ids in `seen`."""
+    for item in ranked:
+        try:
+            i = int(str(item.get("id")).strip())
+        except (AttributeError, ValueError):
+            continue
+        if 0 <= i < len(raw) and i not in seen:
+            seen.add(i)
+            yield result_from_row(raw[i], item)
+
+
+def _rebuild(ranked: List[Dict], raw: List[Dict], order: List[int] | None = None) -> List[Dict]:
+    """Full objects in model order; unknown / repeated ids dropped, short lists topped up."""
+    seen: set[int] = set()
+    out = list(_take(ranked, raw, seen))
+    for i in (range(len(raw)) if order is None else order):
+        if len(out) >= TOP_N:
+            break
+        if i not in seen:
+            out.append(result_from_row(raw[i]))
+    return out[:TOP_N]
+
+
+def _request_options(timeout: float | None = None) -> dict:
+    """Per‑call options: the deadline, and the request's traceparent as gRPC metadata."""
+    opts = {} if timeout is None else {"timeout": timeout}
+    if tp := metrics.traceparent():
+        opts["metadata"] = [("traceparent", tp)]
+    return opts
+
+
+def _count_tokens(resp) -> None:
+    """Gemini usage metadata → llm_tokens_total{kind}; absent on some errors."""
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is None:
+        return
+    metrics.inc("llm_tokens_total", getattr(usage, "prompt_token_count", 0) or 0, kind="prompt")
+    metrics.inc("llm_tokens_total", getattr(usage, "candidates_token_count", 0) or 0, kind="output")
 
-{{ "name": string, "photos": string[] max 4 (use photo_urls), "rating": number, "total_reviews": number, "price": "$$", "tag": string (first in tags or 'Unknown'), "tags": string[] max 3, "location": string (address), "summary": string (1 sentence, personal), "description": string (copy original description), "review_summary": string (1‑sentence vibe), "opening_hours": ["9:30","20:00"] }}
 
-Respond with ONLY the JSON list – no markdown, no explanations. """
+def _parse(text: str, raw: List[Dict], order: List[int] | None = None) -> List[Dict]:
+    text = text.strip()
+    # strip fences if model adds them
+    text = re.sub(r"^```json|```$", "", text, flags=re.S).strip()
+    data = json.loads(text)
+    if not isinstance(data, list) or not data:
+        return _fallback(raw, order)
+    stats_counters["llm_ok"] += 1
+    return _rebuild([d for d in data if isinstance(d, dict)], raw, order)
+
+
+def rank_and_format(prefs_text: str, raw: List[Dict], *, order: List[int] | None = None,
+                    deadline_s: float = LLM_DEADLINE_S) -> List[Dict]:
+    """
+    Returns up to 10 dicts in frontend schema, ranked by Gemini.
+    Falls back to the local ranking (`order`, default local_ranker.rank)
+    if the key is missing, the call fails or JSON parse fails.
+    """
+    if _USING_FAKE:
+        return _fallback(raw, order)
+
+    user_prompt = _build_prompt(prefs_text, raw)
+    stats_counters["llm_calls"] += 1
     try:
         resp = model.generate_content(
             [
             {"role":"user",   "parts":[user_prompt]} ],
-            generation_config = {
-                "temperature":0.5,
-                "max_output_tokens":40000,
-                "response_mime_type": "application/json",
-                "response_schema": MATCHED_RESTAURANTS_SCHEMA
-            },
+            generation_config = GENERATION_CONFIG,
+            request_options = _request_options(deadline_s),
         )
-        text = resp.text.strip()
-        # strip fences if model adds them
-        text = re.sub(r"^```json|```$", "", text, flags=re.S).strip()
-        data = json.loads(text)
-        return data[:10] if isinstance(data, list) else _fallback(raw)
+        _count_tokens(resp)
+        return _parse(resp.text, raw, order)
     except Exception as e:
+        stats_counters["errors"] += 1
         if not DEV_MODE:
             print("[WARN] Gemini post‑process failed, using fallback:", e)
-        return _fallback(raw)
+        return _fallback(raw, order)
+
+
+async def rank_and_format_async(prefs_text: str, raw: List[Dict], *, order: List[int] | None = None,
+                                deadline_s: float = LLM_DEADLINE_S) -> List[Dict]:
+    """
+    Same as `rank_and_format` but awaits Gemini instead of blocking the
+    loop; past `deadline_s` the call is abandoned and the local ranking
+    returned.
+    """
+    if _USING_FAKE:
+        return _fallback(raw, order)
+
+    user_prompt = _build_prompt(prefs_text, raw)
+    stats_counters["llm_calls"] += 1
+    try:
+        resp = await asyncio.wait_for(model.generate_content_async(
+            [
+            {"role":"user",   "parts":[user_prompt]} ],
+            generation_config = GENERATION_CONFIG,
+            request_options = _request_options(),
+        ), timeout=deadline_s)
+        _count_tokens(resp)
+        return _parse(resp.text, raw, order)
+    except asyncio.TimeoutError:
+        stats_counters["timeouts"] += 1
+        print(f"[WARN] Gemini missed its {deadline_s}s deadline, using local ranking")
+        return _fallback(raw, order)
+    except Exception as e:
+        stats_counters["errors"] += 1
+        if not DEV_MODE:
+            print("[WARN] Gemini post‑process failed, using fallback:", e)
+        return _fallback(raw, order)
+
+
+# ------------------------------------------------------------------ streaming
+class _ArrayItems:
+    """Incremental parser: feed chunks of a JSON array, get its objects as they close."""
+
+    def __init__(self):
+        self._buf = []
+        self._depth = 0
+        self._in_str = self._esc = False
+
+    def feed(self, chunk: str) -> List[Dict]:
+        done = []
+        for ch in chunk:
+            if self._depth >= 1:
+                self._buf.append(ch)
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch in "[{":
+                self._depth += 1
+                if self._depth == 2 and ch == "{":
+                    self._buf = ["{"]
+            elif ch in "]}":
+                self._depth -= 1
+                if self._depth == 1 and ch == "}":
+                    try:
+                        item = json.loads("".join(self._buf))
+                        if isinstance(item, dict):
+                            done.append(item)
+                    except ValueError:
+                        pass
+                    self._buf = []
+        return done
+
+
+async def rank_and_format_stream(prefs_text: str, raw: List[Dict], *, order: List[int] | None = None,
+                                 deadline_s: float = LLM_DEADLINE_S):
+    """
+    Async generator over the same results as `rank_and_format_async`, each
+    yielded as soon as Gemini has finished writing its JSON object, as
+    (result, generated) pairs. Whatever the model did not deliver by
+    `deadline_s` is filled in local ranking order with generated=False.
+    """
+    seen: set[int] = set()
+    count, complete = 0, False
+    if not _USING_FAKE:
+        stats_counters["llm_calls"] += 1
+        parser = _ArrayItems()
+        deadline = time.monotonic() + deadline_s
+        try:
+            resp = await asyncio.wait_for(model.generate_content_async(
+                [
+                {"role":"user",   "parts":[_build_prompt(prefs_text, raw)]} ],
+                generation_config = GENERATION_CONFIG,
+                stream = True,
+                request_options = _request_options(),
+            ), timeout=deadline_s)
+            chunks, chunk = aiter(resp), None
+            while count < TOP_N:
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks), timeout=deadline - time.monotonic())
+                except StopAsyncIteration:
+                    break
+                for out in _take(parser.feed(chunk.text), raw, seen):
+                    count += 1
+                    yield out, True
+                    if count >= TOP_N:
+                        break
+            complete = count > 0
+            _count_tokens(chunk)          # the last chunk read carries the running usage
+        except asyncio.TimeoutError:
+            stats_counters["timeouts"] += 1
+            print(f"[WARN] Gemini stream missed its {deadline_s}s deadline after {count} items")
+        except Exception as e:
+            stats_counters["errors"] += 1
+            if not DEV_MODE:
+                print("[WARN] Gemini streaming post‑process failed, using fallback:", e)
+
+    stats_counters["llm_ok" if complete else "fallbacks"] += 1
+    if not complete:
+        metrics.inc("fallbacks_total", stage="llm")
+    for i in (local_ranker.rank(raw) if order is None else order):
+        if count >= TOP_N:
+            break
+        if i not in seen:
+            seen.add(i)
+            count += 1
+            yield result_from_row(raw[i]), False
+
+
+def stats() -> dict:
+    """LLM outcome counters; `fallback_rate` = share of rankings served locally."""
+    served = stats_counters["llm_ok"] + stats_counters["fallbacks"]
+    return {
+        **stats_counters,
+        "deadline_s": LLM_DEADLINE_S,
+        "fallback_rate": round(stats_counters["fallbacks"] / served, 4) if served else 0.0,
+    }
 
 
 if __name__ == "__main__":
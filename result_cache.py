@@ -0,0 +1,101 @@
+# result_cache.py – cache of ranked /query results in front of the Gemini stage
+"""
+Gemini ranking takes seconds and dominates /query latency, while many
+queries repeat ("ramen in palo alto" from different users in the same
+area). Two TTL/LRU tiers short‑circuit the pipeline:
+
+    pre‑check   key = quantized query vector (or keyword text) + ~1 km
+                location cell + filters + hash(prefs_txt).
+                Checked right after embedding and skips search and ranking.
+    ranked      key = sorted candidate ids + hash(prefs_txt).
+                Checked after retrieval. It catches different queries
+                that retrieve the same candidates.
+
+Both tiers store the final result list (photos included). Concurrent
+identical requests are coalesced with `SingleFlight`, so only one of
+them runs search + Gemini and the others await its result. Fallback
+rankings (Gemini down / unparsable output) are never cached.
+
+Env vars:
+    RESULT_CACHE_SIZE    – entries per tier          (default 2000)
+    RESULT_CACHE_TTL     – seconds                   (default 900)
+    RESULT_CACHE_QUANT   – vector quantization steps per unit (default 20)
+    RESULT_CACHE_CELL    – location cell size, degrees (default 0.01)
+"""
+from __future__ import annotations
+
+import hashlib, json, os
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+
+from cache_utils import SingleFlight, TTLCache
+
+CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "2000"))
+CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "900"))
+QUANT = float(os.getenv("RESULT_CACHE_QUANT", "20"))
+CELL_DEG = float(os.getenv("RESULT_CACHE_CELL", "0.01"))
+
+_precheck = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_ranked = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_flight = SingleFlight()
+
+
+def _digest(*parts: Any) -> str:
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else json.dumps(p, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# ---------- keys ----------
+def query_key(vec: np.ndarray | None, text: str, location: dict | None,
+              options: dict, prefs_txt: str) -> str:
+    """
+    Pre‑check key. Each vector component is rounded to 1/QUANT, so
+    near‑identical query vectors usually share a key. Without a vector
+    (keyword mode), the normalized text is used instead.
+    """
+    if vec is not None:
+        q = np.clip(np.round(np.asarray(vec, dtype="float32") * QUANT), -127, 127).astype("int8").tobytes()
+    else:
+        q = " ".join(text.lower().split()).encode()
+    cell = None
+    if location:
+        cell = (round(location["lat"] / CELL_DEG), round(location["lng"] / CELL_DEG))
+    return _digest(q, cell, options, prefs_txt)
+
+
+def candidates_key(ids: list[str], prefs_txt: str) -> str:
+    return _digest(sorted(ids), prefs_txt)
+
+
+# ---------- lookups ----------
+def get_query(key: str) -> list[dict] | None:
+    return _precheck.get(key)
+
+
+def get_ranked(key: str) -> list[dict] | None:
+    return _ranked.get(key)
+
+
+def put(query: str | None, ranked: str | None, results: list[dict]) -> None:
+    if query:
+        _precheck.put(query, results)
+    if ranked:
+        _ranked.put(ranked, results)
+
+
+async def coalesce(key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """Run `fn` once for all concurrent callers with the same key."""
+    return await _flight.do(key, fn)
+
+
+def clear() -> None:
+    _precheck.clear()
+    _ranked.clear()
+
+
+def stats() -> dict:
+    return {"precheck": _precheck.stats(), "ranked": _ranked.stats(), "inflight": _flight.stats()}
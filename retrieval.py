@@ -0,0 +1,301 @@
+# retrieval.py – candidate retrieval for /query on top of the LanceDB table
+"""
+Vector, keyword (BM25) and hybrid search with spatial prefiltering.
+
+When the query location is known, the search is restricted to a bounding
+box around it (`lat` / `lng` btree‑indexed columns, applied as a Lance
+prefilter) and then to the exact great‑circle radius. If fewer than
+GEO_MIN_RESULTS restaurants fall inside, the radius doubles up to
+GEO_MAX_RADIUS_KM; if there is still nothing, the geo filter is dropped.
+
+Structured constraints (minimum rating, minimum review count, areas) are
+SQL prefilters on scalar‑indexed columns (see db_lancedb.SCALAR_INDEXES),
+so a filtered query still returns `limit` matching rows from one ANN pass
+and is never relaxed. Dietary restrictions arrive as excluded `tags`
+(see personalize.py) and are applied the same way.
+
+The /query pipeline searches with ID_COLUMNS only and then `hydrate`s
+what each stage reads: RANK_COLUMNS for every candidate, PROMPT_COLUMNS
+for unenriched ones going to Gemini, DISPLAY_COLUMNS for the final 10.
+
+Hybrid mode runs the vector search and a full‑text search over
+`search_text` (name, description, reviews) side by side and merges the two
+rankings with reciprocal‑rank fusion: score(id) = Σ 1 / (RRF_K + rank).
+Exact names and dish keywords ("Ramen Nagi", "birria tacos") come from
+the keyword side, vague intent ("cozy date night") from the vector side.
+
+Vector searches use the parameters chosen by ann_tuning.py (nprobes,
+refine factor, or an exact flat scan for small tables), read from
+db_lancedb.ann_params_path(). `refresh_ann_params` picks up a new file;
+the API calls it from its index refresh loop. Flat search is dropped
+again once the table outgrows ANN_FLAT_MAX_ROWS. Without a file LanceDB's
+defaults apply.
+
+Env vars:
+    SEARCH_MODE         – vector | keyword | hybrid (default hybrid)
+    RRF_K               – fusion constant   (default 60)
+    GEO_RADIUS_KM       – initial radius       (default 3)
+    GEO_MAX_RADIUS_KM   – widening stops here  (default 25)
+    GEO_MIN_RESULTS     – widen below this     (default 10)
+    ANN_FLAT_MAX_ROWS   – largest table searched without the index (default 5000)
+"""
+from __future__ import annotations
+
+import math, os
+
+import numpy as np
+import pyarrow as pa
+
+import db_lancedb
+from db_lancedb import sql_in
+
+SEARCH_LIMIT = 15
+MODES = ("vector", "keyword", "hybrid")
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+RRF_K = int(os.getenv("RRF_K", "60"))
+GEO_RADIUS_KM = float(os.getenv("GEO_RADIUS_KM", "3"))
+GEO_MAX_RADIUS_KM = float(os.getenv("GEO_MAX_RADIUS_KM", "25"))
+GEO_MIN_RESULTS = int(os.getenv("GEO_MIN_RESULTS", "10"))
+FLAT_MAX_ROWS = int(os.getenv("ANN_FLAT_MAX_ROWS", "5000"))
+EARTH_RADIUS_KM = 6371.0
+
+# two‑phase retrieval: search returns ids only, `hydrate` adds columns per stage
+ID_COLUMNS = ["id"]                        # + _distance / _score and _rowid
+RANK_COLUMNS = [                           # local ranker + Gemini prompt
+    "area","name","location",
+    "rating","review_amount",
+    "tags","summary","review_summary",     # offline enrichment (enrich.py)
+]
+PROMPT_COLUMNS = ["description","reviews"]              # unenriched rows sent to Gemini
+DISPLAY_COLUMNS = ["address","description","photos"]    # final results only
+COLUMNS = ID_COLUMNS + RANK_COLUMNS + DISPLAY_COLUMNS + [
+    "vector",          # local_ranker: similarity to the user's preferences
+]
+
+
+# ---------- geometry ----------
+def haversine_km(lat: float, lng: float, lats, lngs) -> np.ndarray:
+    """Great‑circle distance from (lat, lng) to each of `lats`/`lngs`, vectorized."""
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(np.asarray(lats, dtype="float64")), np.radians(np.asarray(lngs, dtype="float64"))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def geo_where(lat: float, lng: float, radius_km: float) -> str:
+    """Bounding box around (lat, lng) as a Lance SQL filter."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    return (f"lat BETWEEN {lat - dlat:.6f} AND {lat + dlat:.6f} "
+            f"AND lng BETWEEN {lng - dlng:.6f} AND {lng + dlng:.6f}")
+
+
+def filter_where(min_rating: float | None = None, min_reviews: int | None = None,
+                 areas: list[str] | None = None,
+                 exclude_tags: list[str] | None = None) -> str | None:
+    """
+    Structured /query constraints as a Lance SQL filter (None = no filter).
+    `exclude_tags` drops enriched rows carrying any of them; rows without
+    tags yet are kept.
+    """
+    clauses = []
+    if min_rating is not None:
+        # rating is float32: 4.6 is stored as 4.5999999
+        clauses.append(f"rating >= {float(min_rating) - 1e-4:.4f}")
+    if min_reviews is not None:
+        clauses.append(f"review_amount >= {int(min_reviews)}")
+    if areas:
+        clauses.append(sql_in("area", areas))
+    if exclude_tags:
+        tags = ", ".join("'" + str(t).replace("'", "''") + "'" for t in exclude_tags)
+        clauses.append(f"tags IS NULL OR NOT array_has_any(tags, [{tags}])")
+    return _and(*clauses)
+
+
+def _and(*clauses: str | None) -> str | None:
+    clauses = [c for c in clauses if c]
+    return " AND ".join(f"({c})" for c in clauses) if clauses else None
+
+
+# ---------- ANN parameters ----------
+_ann: dict = {}                  # "search" section of ann_params.json, as applied
+_ann_mtime: float | None = None
+
+
+def refresh_ann_params(tbl=None) -> dict:
+    """
+    Reload the tuned search parameters when the file changed. With `tbl`,
+    a flat‑search choice is ignored once the table has grown past
+    FLAT_MAX_ROWS.
+    """
+    global _ann, _ann_mtime
+    path = db_lancedb.ann_params_path()
+    mtime = path.stat().st_mtime if path.is_file() else None
+    if mtime != _ann_mtime:
+        _ann_mtime = mtime
+        _ann = dict(db_lancedb.load_ann_params().get("search") or {})
+        if _ann:
+            print("[INFO] ANN search params:", _ann)
+    if _ann.get("flat") and tbl is not None and tbl.count_rows() > FLAT_MAX_ROWS:
+        print(f"[WARN] table outgrew ANN_FLAT_MAX_ROWS={FLAT_MAX_ROWS}, using the vector index; re‑run ann_tuning.py")
+        _ann["flat"] = False
+    return _ann
+
+
+def _vector_query(tbl, vec):
+    q = tbl.search(vec).metric("cosine").with_row_id(True)
+    p = _ann
+    if p.get("flat"):
+        return q.bypass_vector_index()
+    if p.get("nprobes"):
+        q = q.nprobes(int(p["nprobes"]))
+    if p.get("refine_factor"):
+        q = q.refine_factor(int(p["refine_factor"]))
+    if p.get("ef"):
+        q = q.ef(int(p["ef"]))
+    return q
+
+
+refresh_ann_params()
+
+
+# ---------- search ----------
+def arrow_rows(t: pa.Table) -> list[dict]:
+    """
+    Arrow result → row dicts without pandas: plain Python lists for list
+    columns, None for nulls, and one float32 NumPy block for `vector`
+    (each row holds a view of it).
+    """
+    vecs = None
+    if "vector" in t.column_names:
+        col = t["vector"].combine_chunks()
+        vecs = col.flatten().to_numpy(zero_copy_only=False).reshape(-1, col.type.list_size)
+        t = t.drop_columns(["vector"])
+    out = t.to_pylist()
+    if vecs is not None:
+        for r, v in zip(out, vecs):
+            r["vector"] = v
+    return out
+
+
+def _run(tbl, vec, where: str | None, limit: int, columns: list[str]) -> list[dict]:
+    q = _vector_query(tbl, vec)
+    if where:
+        q = q.where(where, prefilter=True)
+    return arrow_rows(q.limit(limit).select(columns).to_arrow())
+
+
+def _near(rows: list[dict], lat: float, lng: float, radius_km: float) -> list[dict]:
+    if not rows:
+        return rows
+    dist = haversine_km(lat, lng, [r["location"]["lat"] for r in rows],
+                        [r["location"]["lng"] for r in rows])
+    return [r for r, d in zip(rows, dist) if d <= radius_km]
+
+
+def _drop_location(rows: list[dict], cols: list[str], columns: list[str]) -> list[dict]:
+    if cols is not columns:
+        for r in rows:
+            r.pop("location", None)
+    return rows
+
+
+def search(tbl, vec, *, location: dict | None = None, where: str | None = None,
+           limit: int = SEARCH_LIMIT, columns: list[str] = COLUMNS,
+           radius_km: float = GEO_RADIUS_KM,
+           max_radius_km: float = GEO_MAX_RADIUS_KM,
+           min_results: int = GEO_MIN_RESULTS) -> list[dict]:
+    """Top `limit` rows by cosine distance matching `where`, near `location` when given."""
+    if not location:
+        return _run(tbl, vec, where, limit, columns)
+
+    lat, lng = location["lat"], location["lng"]
+    cols = columns if "location" in columns else columns + ["location"]
+    rows: list[dict] = []
+    while True:
+        rows = _near(_run(tbl, vec, _and(where, geo_where(lat, lng, radius_km)), limit, cols),
+                     lat, lng, radius_km)
+        if len(rows) >= min(min_results, limit) or radius_km >= max_radius_km:
+            break
+        radius_km = min(radius_km * 2, max_radius_km)
+
+    if not rows:
+        return _run(tbl, vec, where, limit, columns)
+    return _drop_location(rows, cols, columns)
+
+
+def search_many(tbl, vecs: list, *, where: str | None = None, limit: int = SEARCH_LIMIT,
+                columns: list[str] = COLUMNS) -> list[list[dict]]:
+    """
+    `search` without a location for several vectors sharing `where`, as one
+    multi‑vector ANN pass (rows come back tagged with `query_index`).
+    """
+    if len(vecs) < 2:
+        return [_run(tbl, v, where, limit, columns) for v in vecs]
+    q = _vector_query(tbl, [np.asarray(v, dtype="float32") for v in vecs])
+    if where:
+        q = q.where(where, prefilter=True)
+    out: list[list[dict]] = [[] for _ in vecs]
+    for r in arrow_rows(q.limit(limit).select(columns).to_arrow()):
+        out[r.pop("query_index")].append(r)
+    return out
+
+
+def keyword_search(tbl, text: str, *, location: dict | None = None, where: str | None = None,
+                   limit: int = SEARCH_LIMIT, columns: list[str] = COLUMNS,
+                   radius_km: float = GEO_MAX_RADIUS_KM) -> list[dict]:
+    """
+    BM25 matches for `text` over `search_text`. Near `location` the whole
+    widening radius is searched at once – keyword hits are sparse, and the
+    fused ranking still prefers the vector side's nearby rows.
+    """
+    q = tbl.search(text, query_type="fts", fts_columns="search_text").with_row_id(True)
+    if not location:
+        if where:
+            q = q.where(where, prefilter=True)
+        return arrow_rows(q.limit(limit).select(columns).to_arrow())
+    lat, lng = location["lat"], location["lng"]
+    cols = columns if "location" in columns else columns + ["location"]
+    found = arrow_rows(q.where(_and(where, geo_where(lat, lng, radius_km)), prefilter=True)
+                       .limit(limit).select(cols).to_arrow())
+    return _drop_location(_near(found, lat, lng, radius_km), cols, columns)
+
+
+def hydrate(tbl, rows: list[dict], columns: list[str]) -> list[dict]:
+    """
+    Phase two: add `columns` to search rows in place, with one bulk take by
+    `_rowid`. Row ids are only valid for the table version that was
+    searched. Rows whose id no longer matches (compaction in between), or
+    all of them if the take itself fails, are fetched by `id` through the
+    btree index instead.
+    """
+    need = [c for c in columns if any(c not in r for r in rows)]
+    if not rows or not need:
+        return rows
+    row_ids = [r["_rowid"] for r in rows if r.get("_rowid") is not None]
+    got = {}
+    if row_ids:
+        try:
+            got = {g["_rowid"]: g for g in arrow_rows(db_lancedb.take_rows(tbl, row_ids, need))}
+        except Exception as e:            # row ids gone after compaction / cleanup
+            print("[WARN] take by row id failed – fetching by id:", e)
+    stale = [r["id"] for r in rows if got.get(r.get("_rowid"), {}).get("id") != r["id"]]
+    by_id = db_lancedb.fetch_rows(tbl, stale, need) if stale else {}
+    for r in rows:
+        g = got.get(r.get("_rowid"))
+        r.update(g if g is not None and g["id"] == r["id"] else by_id.get(r["id"], {}))
+    return rows
+
+
+def rrf(rankings: list[list[dict]], *, k: int = RRF_K, limit: int = SEARCH_LIMIT,
+        key: str = "id") -> list[dict]:
+    """Reciprocal‑rank fusion of several ranked row lists, deduped on `key`."""
+    scores: dict = {}
+    rows: dict = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            rid = row[key]
+            scores[rid] = scores.get(rid, 0.0) + 1.0 / (k + rank + 1)
+            rows.setdefault(rid, row)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [rows[rid] for rid in best]
@@ -0,0 +1,69 @@
+"""
+Restriction excludes end to end: enrich tags → personalize.avoid_tags →
+retrieval.filter_where against a real LanceDB table.
+
+    python -m unittest discover tests
+"""
+import tempfile
+import unittest
+
+import lancedb
+import pyarrow as pa
+
+import enrich
+import personalize
+import retrieval
+
+ROWS = [
+    {"id": "steak", "name": "Prime Steakhouse", "area": "SoMa",
+     "description": "Dry-aged steaks and a long bar.", "reviews": [], "search_text": ""},
+    {"id": "noodles", "name": "Golden Noodle", "area": "Sunset",
+     "description": "Hand-pulled noodles and dumplings.",
+     "reviews": [{"text": "Better than a steak place, and the wine list was short."}],
+     "search_text": "Golden Noodle. Better than a steak place, and the wine list was short."},
+    {"id": "new", "name": "Not Enriched Yet", "area": "Mission",
+     "description": "", "reviews": [], "search_text": ""},
+]
+
+
+def _ids(tags_by_id: dict[str, list[str] | None], prefs: dict) -> set[str]:
+    where = retrieval.filter_where(exclude_tags=personalize.avoid_tags(prefs))
+    with tempfile.TemporaryDirectory() as d:
+        tbl = lancedb.connect(d).create_table("t", pa.Table.from_pylist(
+            [{"id": rid, "tags": tags} for rid, tags in tags_by_id.items()],
+            schema=pa.schema([("id", pa.utf8()), ("tags", pa.list_(pa.utf8()))])))
+        q = tbl.search()
+        if where:
+            q = q.where(where)
+        return set(q.select(["id"]).limit(None).to_arrow()["id"].to_pylist())
+
+
+def _stub_tags() -> dict[str, list[str] | None]:
+    out = enrich.StubEnricher().enrich(ROWS[:2])
+    return {**{rid: f["tags"] for rid, f in out.items()}, "new": None}
+
+
+class RestrictionFilterTest(unittest.TestCase):
+    def test_review_mentions_do_not_exclude(self):
+        tags = _stub_tags()
+        self.assertEqual(_ids(tags, {"me": {"restrictions": ["Vegetarian"]}}), {"noodles", "new"})
+        self.assertEqual(_ids(tags, {"me": {"restrictions": ["no alcohol"]}}), {"steak", "noodles", "new"})
+        self.assertEqual(_ids(tags, {"me": {"cuisines": ["thai"]}}), {"steak", "noodles", "new"})
+
+    def test_free_form_tags_are_canonicalized(self):
+        tags = {"a": enrich.canonical_tags(["steak house", "Wine Bar"]),
+                "b": enrich.canonical_tags(["noodle bar", "DUMPLINGS"])}
+        self.assertEqual(tags, {"a": ["Steakhouse", "Wine"], "b": ["noodle bar", "Dumplings"]})
+        self.assertEqual(_ids(tags, {"me": {"restrictions": ["vegetarian"]}}), {"b"})
+        self.assertEqual(_ids(tags, {"me": {"restrictions": ["No Alcohol"]}}), {"b"})
+
+    def test_excludes_use_canonical_tags(self):
+        for restriction, excluded in personalize.RESTRICTION_EXCLUDES.items():
+            self.assertEqual(restriction, restriction.lower())
+            for tag in excluded:
+                self.assertIn(tag, enrich.TAGS, restriction)
+                self.assertEqual(enrich.canonical_tags([tag.lower()]), [tag])
+
+
+if __name__ == "__main__":
+    unittest.main()
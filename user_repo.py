@@ -1,19 +1,44 @@
-# user_repo.py  – simple MongoDB wrapper for user docs
+# user_repo.py  – simple MongoDB wrapper for user docs
 """
 Front‑end now authenticates with Firebase; the backend only receives a
 `UID` header.
 
 This helper module:
     • connects to Mongo once (lazy singleton)
-    • offers `get_user(uid)`  → dict | None
+    • offers `get_profile(uid)`  → dict   (cached, used on every /query)
+    • offers `get_or_create_user(uid, ...)`  → dict   (one atomic upsert)
     • offers `upsert_prefs(uid, prefs_dict)`  → None
+    • offers `backfill_prefs(uid, prefs, derived)`  → dict   (legacy docs)
+    • offers `get_user(uid)`  → dict | None
+
+`/query` only needs `preferences` and the vectors precomputed from them
+(personalize.py), so `get_profile` projects those fields and keeps them
+in an in‑process TTL cache. Concurrent misses for the same
+uid share one read. `upsert_prefs` and `get_or_create_user` refresh
+the entry in this worker. Other workers see the change after
+USER_PREFS_TTL seconds, or right away with USER_PREFS_WATCH=1. That
+setting starts a change stream on `users` which evicts updated uids.
+Change streams need a replica set. On a standalone mongod the watcher
+logs a warning and stops, and the TTL is the bound again. Reads and
+writes carry the request's `traceparent` as the operation comment, so
+they show up under it in the Mongo profiler / slow‑query log.
+
+Env vars:
+    USER_PREFS_CACHE_SIZE  – cached users per worker        (default 10000)
+    USER_PREFS_TTL         – seconds                        (default 300)
+    USER_PREFS_WATCH       – 1 = change‑stream invalidation (default 0)
 """
 
 from __future__ import annotations
-import os, time
+import asyncio, os, time
 from typing import Any, Dict
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+import metrics
+from cache_utils import SingleFlight, TTLCache
 
 # ---------- DB connection ----------
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongo:27017/pairfecto")
@@ -27,31 +52,154 @@ def _db():
     return _DB["pairfecto"]
 
 
+def close() -> None:
+    global _DB
+    if _DB is not None:
+        _DB.close()
+        _DB = None
+
+
+# ---------- preference cache ----------
+PREFS_CACHE_SIZE = int(os.getenv("USER_PREFS_CACHE_SIZE", "10000"))
+PREFS_TTL = float(os.getenv("USER_PREFS_TTL", "300"))
+PREFS_WATCH = os.getenv("USER_PREFS_WATCH", "0") == "1"
+
+_prefs = TTLCache(maxsize=PREFS_CACHE_SIZE, ttl=PREFS_TTL)
+_flight = SingleFlight()
+_writes = 0                      # bumped on every local invalidation
+_counters = {"reads": 0, "invalidations": 0}
+PROFILE_FIELDS = ("preferences", "prefs_vec", "avoid_tags")
+
+
+def _profile(doc: Dict[str, Any] | None) -> Dict[str, Any]:
+    doc = doc or {}
+    prefs = doc.get("preferences") or {}
+    return {
+        "preferences": prefs,
+        "prefs_vec": doc.get("prefs_vec"),
+        "avoid_tags": doc.get("avoid_tags") or [],
+        # saved before the derived fields existed (personalize.profile always sets prefs_vec)
+        "backfill": bool(prefs) and "prefs_vec" not in doc,
+    }
+
+
+def _remember(uid: str, profile: Dict[str, Any] | None) -> None:
+    global _writes
+    _writes += 1
+    if profile is None:
+        _prefs.pop(uid)
+    else:
+        _prefs.put(uid, profile)
+
+
+def invalidate(uid: str) -> None:
+    _counters["invalidations"] += 1
+    _remember(uid, None)
+
+
 # ---------- public helpers ----------
+async def get_profile(uid: str) -> Dict[str, Any]:
+    """
+    {"preferences", "prefs_vec", "avoid_tags", "backfill"} of `uid` (empty
+    for unknown users), from cache when possible.
+    """
+    profile = _prefs.get(uid)
+    if profile is not None:
+        return profile
+
+    async def load():
+        _counters["reads"] += 1
+        seen = _writes
+        doc = await _db().users.find_one({"_id": uid}, {**dict.fromkeys(PROFILE_FIELDS, 1), "_id": 0},
+                                         comment=metrics.traceparent())
+        value = _profile(doc)
+        if seen == _writes:      # no upsert landed while we were reading
+            _prefs.put(uid, value)
+        return value
+
+    return await _flight.do(uid, load)
+
+
+async def get_prefs(uid: str) -> Dict[str, Any]:
+    return (await get_profile(uid))["preferences"]
+
+
 async def get_user(uid: str) -> Dict[str, Any] | None:
     """
     Returns full user document or None if not found.
     """
-    return await _db().users.find_one({"_id": uid})
+    return await _db().users.find_one({"_id": uid}, comment=metrics.traceparent())
 
 
-async def upsert_prefs(uid: str, prefs: Dict[str, Any]) -> None:
+async def upsert_prefs(uid: str, prefs: Dict[str, Any],
+                       derived: Dict[str, Any] | None = None) -> None:
     """
     Creates user doc if it doesn't exist, or updates preferences field.
+    `derived` (personalize.profile) is stored alongside.
     """
+    now = time.time()
+    derived = derived or {}
     await _db().users.update_one(
         {"_id": uid},
         {
             "$set": {
                 "preferences": prefs,
-                "updated": time.time(),
+                **derived,
+                "updated": now,
             },
             "$setOnInsert": {
-                "created": time.time(),
+                "created": now,
             },
         },
         upsert=True,
+        comment=metrics.traceparent(),
     )
+    _remember(uid, _profile({"preferences": prefs, **derived}))
+
+
+async def backfill_prefs(uid: str, prefs: Dict[str, Any],
+                         derived: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Stores `derived` on a doc saved before it existed and returns the
+    profile. A save that lands meanwhile wins; the next read picks it up.
+    """
+    await _db().users.update_one({"_id": uid, "prefs_vec": {"$exists": False}}, {"$set": derived},
+                                 comment=metrics.traceparent())
+    _remember(uid, None)
+    return _profile({"preferences": prefs, **derived})
+
+
+async def get_or_create_user(
+    uid: str,
+    *,
+    email: str | None = None,
+    photo_url: str | None = None,
+    prefs: Dict[str, Any] | None = None,
+) -> Dict[str, Any]:
+    """
+    Returns the user document, inserting it first if it doesn’t exist.
+    One `find_one_and_update` upsert, so concurrent first logins cannot
+    race into a duplicate‑key error.
+    """
+    now = time.time()
+    doc = await _db().users.find_one_and_update(
+        {"_id": uid},
+        {
+            "$setOnInsert": {
+                "email": email,
+                "photo_url": photo_url,
+                "preferences": prefs or {},
+                "created": now,
+                "updated": now,
+            },
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        comment=metrics.traceparent(),
+    )
+    _remember(uid, _profile(doc))
+    return doc
+
 
 async def create_user(
     uid: str,
@@ -64,19 +212,30 @@ async def create_user(
     Insert a brand‑new user document if it doesn’t exist.
     Returns the resulting document (existing or newly created).
     """
-    coll = _db().users
-
-    doc = await coll.find_one({"_id": uid})
-    if doc:
-        return doc  # already present
-
-    doc = {
-        "_id": uid,
-        "email": email,
-        "photo_url": photo_url,
-        "preferences": prefs or {},
-        "created": time.time(),
-        "updated": time.time(),
-    }
-    await coll.insert_one(doc)
-    return doc
+    return await get_or_create_user(uid, email=email, photo_url=photo_url, prefs=prefs)
+
+
+# ---------- cross‑worker invalidation ----------
+async def watch_prefs() -> None:
+    """Background task: evict uids whose document changed in any worker."""
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+    while True:
+        try:
+            async with _db().users.watch(pipeline) as stream:
+                print("[INFO] watching users for preference changes")
+                async for change in stream:
+                    invalidate(change["documentKey"]["_id"])
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            # e.g. "The $changeStream stage is only supported on replica sets"
+            print("[WARN] user change stream unavailable, relying on USER_PREFS_TTL:", e)
+            return
+        except Exception as e:
+            print("[WARN] user change stream dropped, reconnecting:", e)
+            _prefs.clear()       # changes may have been missed meanwhile
+            await asyncio.sleep(5)
+
+
+def stats() -> dict:
+    return {**_prefs.stats(), **_counters, "inflight": _flight.stats()["inflight"]}